@@ -0,0 +1,72 @@
+import pygame
+
+
+def _color_key(color):
+    # pygame.Color is unhashable; names and tuples are used as they are.
+    if isinstance(color, pygame.Color):
+        return tuple(color)
+    return color
+
+
+class SurfaceCache:
+    """
+    Loaded images and rendered text, keyed by what they show and their size.
+    Entries stay cached until invalidate() drops them.
+    """
+
+    def __init__(self):
+        self._surfaces = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, key):
+        surface = self._surfaces.get(key)
+        if surface is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return surface
+
+    def image(self, path, size=None):
+        """pygame.image.load(path), scaled to size if one is given."""
+        if size is not None:
+            size = tuple(size)
+        key = ("image", path, size)
+        surface = self._lookup(key)
+        if surface is None:
+            surface = pygame.image.load(path)
+            if size is not None:
+                surface = pygame.transform.scale(surface, size)
+            self._surfaces[key] = surface
+        return surface
+
+    def text(self, font, text, color, antialias=True):
+        """font.render(text, antialias, color)."""
+        key = ("text", font, text, _color_key(color), antialias)
+        surface = self._lookup(key)
+        if surface is None:
+            surface = font.render(text, antialias, color)
+            self._surfaces[key] = surface
+        return surface
+
+    def invalidate(self, path=None):
+        """Drops every entry, or only the images loaded from path."""
+        if path is None:
+            self._surfaces.clear()
+            return
+        for key in [key for key in self._surfaces if key[:2] == ("image", path)]:
+            del self._surfaces[key]
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __len__(self):
+        return len(self._surfaces)
+
+    def stats(self):
+        return (
+            f"{len(self)} surfaces, {self.hits} hits, {self.misses} misses "
+            f"({self.hit_rate:.1%} hit rate)"
+        )
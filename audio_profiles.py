@@ -0,0 +1,205 @@
+"""
+Audio latency profiles and output buffer tuning.
+
+A profile sets the output buffer (frames per device callback) and how many
+voices may sound at once. A smaller buffer cuts output latency but leaves
+less slack before the device runs dry (an underrun, heard as a click), so
+live play wants a small one and dense MIDI playback a safe one.
+
+The profile comes from --profile, or from the "profile" key of a JSON
+config file, whose "mixer_buffer", "engine_buffer" and "channels" keys
+override the profile's values:
+
+    {"profile": "live", "engine_buffer": 192}
+"""
+
+import json
+import time
+
+import sample_bank
+
+CONFIG_PATH = "arpeggio.json"
+
+# --- Buffer auto-tuning (NumPy engine) ---
+# The buffer is halved after every AUTO_TUNE_SETTLE_SEC without underruns,
+# down to AUTO_TUNE_MIN_FRAMES. On an underrun it is doubled instead, up to
+# AUTO_TUNE_MAX_FRAMES, until it plays AUTO_TUNE_SETTLE_SEC without one, and
+# then kept.
+AUTO_TUNE_MIN_FRAMES = 64
+AUTO_TUNE_MAX_FRAMES = 4096
+AUTO_TUNE_SETTLE_SEC = 2.0
+# A device callback this many periods after the previous one means the
+# device has been playing silence.
+UNDERRUN_PERIODS = 2.0
+
+
+class AudioProfile:
+    def __init__(self, name, mixer_buffer, engine_buffer, channels):
+        self.name = name
+        # Frames per callback for pygame.mixer and for the NumPy engine,
+        # which mixes fast enough to get by with a smaller buffer.
+        self.mixer_buffer = mixer_buffer
+        self.engine_buffer = engine_buffer
+        # Mixer channels, or held voices for the NumPy engine.
+        self.channels = channels
+
+
+PROFILES = {
+    "live": AudioProfile("live", mixer_buffer=256, engine_buffer=128, channels=128),
+    "balanced": AudioProfile(
+        "balanced", mixer_buffer=1024, engine_buffer=256, channels=256
+    ),
+    "dense": AudioProfile("dense", mixer_buffer=2048, engine_buffer=512, channels=512),
+}
+DEFAULT_PROFILE = "dense"
+
+
+def buffer_ms(frames):
+    return frames * 1000 / sample_bank.SAMPLE_RATE
+
+
+def load_profile(name=None, config_path=CONFIG_PATH):
+    """
+    The named profile, or the one set up by the config file (if it exists),
+    or DEFAULT_PROFILE. Returns (profile, config dict).
+    """
+    config = {}
+    try:
+        with open(config_path) as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        print(f"Could not read {config_path}: {e}")
+    if not isinstance(config, dict):
+        print(f"Ignoring {config_path}: expected a JSON object")
+        config = {}
+
+    if name is not None:
+        return PROFILES[name], config
+    profile_name = config.get("profile", DEFAULT_PROFILE)
+    base = PROFILES.get(profile_name) if isinstance(profile_name, str) else None
+    if base is None:
+        print(f"Unknown profile in {config_path}, using {DEFAULT_PROFILE}")
+        base = PROFILES[DEFAULT_PROFILE]
+    profile = AudioProfile(
+        base.name,
+        _positive_int(config, "mixer_buffer", base.mixer_buffer, config_path),
+        _positive_int(config, "engine_buffer", base.engine_buffer, config_path),
+        _positive_int(config, "channels", base.channels, config_path),
+    )
+    return profile, config
+
+
+def _positive_int(config, key, default, config_path):
+    """config[key] if it is a positive whole number, else default (with a warning)."""
+    value = config.get(key, default)
+    # bool is an int too, but true is no buffer size.
+    if isinstance(value, int) and not isinstance(value, bool) and value > 0:
+        return value
+    print(f"Ignoring {key} {value!r} in {config_path}, using {default}")
+    return default
+
+
+class AudioStats:
+    """Output buffer counters, updated from the NumPy engine's audio callback."""
+
+    def __init__(self, buffer_frames=0):
+        self.buffer_frames = buffer_frames
+        self.callbacks = 0
+        self.underruns = 0
+        # Time spent mixing one callback, last and worst, in ms.
+        self.mix_ms = 0.0
+        self.max_mix_ms = 0.0
+        self._last_callback = None
+
+    def callback_started(self, now):
+        """Counts an underrun if the device waited too long for this callback."""
+        period = buffer_ms(self.buffer_frames) / 1000
+        if (
+            self._last_callback is not None
+            and now - self._last_callback > UNDERRUN_PERIODS * period
+        ):
+            self.underruns += 1
+        self._last_callback = now
+        self.callbacks += 1
+
+    def callback_finished(self, mix_sec):
+        self.mix_ms = mix_sec * 1000
+        self.max_mix_ms = max(self.max_mix_ms, self.mix_ms)
+
+    def restart(self, buffer_frames):
+        """After the device was reopened with a new buffer size."""
+        self.buffer_frames = buffer_frames
+        self._last_callback = None
+
+    def report(self):
+        return (
+            f"buffer {self.buffer_frames} frames ({buffer_ms(self.buffer_frames):.1f} "
+            f"ms), {self.underruns} underruns in {self.callbacks} callbacks, "
+            f"mix {self.max_mix_ms:.2f} ms max"
+        )
+
+
+class BufferAutoTuner:
+    """
+    Steps the engine's output buffer down until underruns appear, then up
+    until they stop.
+    """
+
+    def __init__(
+        self,
+        engine,
+        min_frames=AUTO_TUNE_MIN_FRAMES,
+        max_frames=AUTO_TUNE_MAX_FRAMES,
+        settle_sec=AUTO_TUNE_SETTLE_SEC,
+    ):
+        self.engine = engine
+        self.min_frames = min_frames
+        self.max_frames = max_frames
+        self.settle_sec = settle_sec
+        self.done = False
+        # Set once an underrun has been seen; from then on the buffer only grows.
+        self.growing = False
+        # Set on the first update(), so hiccups while starting up don't count.
+        self._underruns = None
+        self._since = None
+
+    def update(self):
+        """Called every frame; reopens the device when it is time for a step."""
+        if self.done:
+            return
+        stats = self.engine.audio_stats
+        frames = self.engine.buffer_frames
+        if self._since is None:
+            self._underruns = stats.underruns
+            self._since = time.perf_counter()
+            return
+        if stats.underruns > self._underruns:
+            self.growing = True
+            if frames * 2 > self.max_frames:
+                self.done = True
+                print(
+                    "Auto-tune: could not stop the underruns, keeping the "
+                    f"largest buffer of {frames} frames"
+                )
+                return
+            self._step(frames * 2, "underrun, trying")
+            return
+        if time.perf_counter() - self._since < self.settle_sec:
+            return
+        if self.growing:
+            self.done = True
+            print(f"Auto-tune: no underruns, keeping a buffer of {frames} frames")
+            return
+        if frames // 2 < self.min_frames:
+            self.done = True
+            print(f"Auto-tune: keeping the minimum buffer of {frames} frames")
+            return
+        self._step(frames // 2, "trying")
+
+    def _step(self, frames, what):
+        self.engine.set_buffer(frames)
+        print(f"Auto-tune: {what} a buffer of {frames} frames")
+        self._underruns = self.engine.audio_stats.underruns
+        self._since = time.perf_counter()
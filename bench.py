@@ -0,0 +1,555 @@
+"""
+Headless benchmarks over the bundled MIDI files, for catching performance
+regressions.
+
+    python bench.py -o before.json
+    python bench.py -o after.json --compare before.json
+
+Every file in assets/MIDI (or the files given) is parsed, prepared for
+playback, sought into and dispatched from start to end by a PlaybackThread
+on a simulated clock. Then main.py plays it for a few seconds with SDL's
+dummy video driver and its --perf-log, for the real render loop's frame
+cost. Peak memory and note density are recorded too.
+
+The NumPy engine's sample bank is also built with every key's sample and
+with sparse sampling (see sample_bank.sparse_sources) at a few settings,
+for its size, load time and the cost of mixing from it.
+
+The timed steps run in several passes over every file and bank, spread
+over the whole run, and each timing is its fastest pass. The frame cost is
+the median frame of the fastest one-second window. How far the median pass
+(or window) was above the fastest is kept as the metric's noise. Results are
+written as JSON. --compare reports every metric that got worse than in an
+earlier results file by more than --threshold and by more than its noise in
+either run, or that could not be measured this time (unless it was skipped
+on purpose, as the frame run with --frame-seconds 0). It exits with status 1
+if any did.
+"""
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import midi_events
+import sample_bank
+import voices
+from mix_engine import MixEngine
+from playback import PlaybackThread
+from timeline import Timeline, find_first_note_after
+
+MIDI_DIR = "assets/MIDI"
+RESULTS_PATH = "bench_results.json"
+RESULTS_VERSION = 1
+
+# Passes over every file and bank. Each step is timed in every pass, and
+# the fastest pass is reported. On a shared machine the same work can take
+# anything up to four times as long for seconds at a time, so runs of a
+# step taken back to back are all slow together; passes minutes apart
+# rarely are. How far the median pass was above the fastest is kept as the
+# metric's noise, which --compare allows for.
+ROUNDS = 5
+# Runs of a timed step within a pass; steps that take well under a
+# millisecond get more.
+REPEATS = 3
+QUICK_REPEATS = 51
+SEEKS = 1000
+SEEK_SEED = 0
+FRAME_SECONDS = 5.0
+# Frames dropped from the start of the frame run, while samples still load.
+WARMUP_FRAMES = 30
+# The frame run is cut into windows of this many frames, which stand in for
+# the passes: the frame metrics are the fastest window's medians.
+FRAME_WINDOW = 60
+DEFAULT_THRESHOLD = 0.25
+# --sparse settings the bank run compares; "1" is the full bank.
+BANK_SETTINGS = ["1", "2", "3", "4"]
+# Voices sounding while a bank's mixing cost is measured, and blocks mixed.
+BANK_VOICES = 256
+BANK_BLOCKS = 200
+
+# Metrics --compare checks; lower is better for all of them.
+COMPARED_METRICS = [
+    "parse_ms",
+    "prepare_ms",
+    "cached_load_ms",
+    "peak_mem_mb",
+    "seek_us",
+    "held_us",
+    "dispatch_ms",
+]
+# Metrics of the frame run, which --frame-seconds 0 skips.
+FRAME_METRICS = ["frame_busy_ms", "draw_keyboard_ms"]
+BANK_METRICS = ["load_ms", "bank_mb", "mix_ms"]
+
+
+def fastest_of(func, repeats=REPEATS):
+    """(last result, fastest run in ms) of calling func repeats times."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return result, min(times) * 1000
+
+
+def prepare(events, sample_lengths_ms):
+    """What playlist.prepare_song() does with parsed notes before packing them."""
+    releases = voices.release_times(events, sample_lengths_ms)
+    note_ends = voices.sounding_ends(events, releases, sample_lengths_ms)
+    return releases, note_ends, Timeline(events, note_ends)
+
+
+def note_density(events):
+    """(mean, peak) notes per second, the peak over any one-second window."""
+    if not len(events):
+        return 0.0, 0
+    times = events.time_ms
+    duration_sec = max(float(times[-1]) / 1000, 1.0)
+    in_window = np.searchsorted(times, times + 1000) - np.arange(len(times))
+    return len(events) / duration_sec, int(in_window.max())
+
+
+def time_seeks(events, timeline, seeks=SEEKS):
+    """Mean µs of find_first_note_after and of Timeline.sounding_at."""
+    end_ms = float(events.time_ms[-1]) if len(events) else 0.0
+    positions = np.random.default_rng(SEEK_SEED).uniform(0, end_ms, seeks).tolist()
+
+    def seek_all():
+        for position_ms in positions:
+            find_first_note_after(events, position_ms)
+
+    def hold_all():
+        for position_ms in positions:
+            timeline.sounding_at(position_ms)
+
+    _, seek_ms = fastest_of(seek_all)
+    _, held_ms = fastest_of(hold_all)
+    return seek_ms * 1000 / seeks, held_ms * 1000 / seeks
+
+
+def time_dispatch(events, releases, note_ends):
+    """
+    Dispatches the whole song through a PlaybackThread (not started) with
+    notes going nowhere, on a clock that jumps ahead by each call's sleep.
+    Returns (fastest ms spent, number of calls).
+    """
+    player = PlaybackThread(lambda *note: None)
+    player.load(events, releases, note_ends)
+    clock = [0.0]
+    player.now_ms = lambda: clock[0]
+
+    def dispatch_all():
+        clock[0] = 0.0
+        player.seek(0.0)
+        player.resume()
+        calls = 0
+        # "Playback finished." is not part of the report.
+        with contextlib.redirect_stdout(io.StringIO()):
+            while player.active:
+                clock[0] += player._dispatch_due() * 1000
+                calls += 1
+        return calls
+
+    calls, dispatch_ms = fastest_of(dispatch_all)
+    return dispatch_ms, calls
+
+
+def run_frames(midi_path, seconds, engine):
+    """
+    Plays midi_path from the start in main.py for `seconds` and returns the
+    records of its --perf-log, or None if it failed.
+    """
+    env = dict(os.environ, SDL_VIDEODRIVER="dummy")
+    # SDL's dummy audio driver only opens one device, and the NumPy engine
+    # needs a second one next to pygame.mixer, so discard the sound instead.
+    env.update(SDL_AUDIODRIVER="disk", SDL_DISKAUDIOFILE=os.devnull)
+    fd, log_path = tempfile.mkstemp(suffix=".jsonl")
+    os.close(fd)
+    command = [
+        sys.executable,
+        "main.py",
+        "--engine",
+        engine,
+        "--midi",
+        midi_path,
+        "--start",
+        "0",
+        "--play-for",
+        str(seconds),
+        "--perf-log",
+        log_path,
+    ]
+    try:
+        subprocess.run(
+            command,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=seconds + 60,
+            check=True,
+        )
+        with open(log_path) as f:
+            return [json.loads(line) for line in f]
+    except (OSError, ValueError, subprocess.SubprocessError) as e:
+        print(f"Frame run failed for {midi_path}: {e}")
+        return None
+    finally:
+        os.remove(log_path)
+
+
+def frame_metrics(records):
+    records = records[WARMUP_FRAMES:]
+    if not records:
+        return {}
+
+    def column(key):
+        return np.array([record.get(key, 0.0) for record in records])
+
+    def window_medians(key):
+        values = column(key)
+        count = max(len(values) // FRAME_WINDOW, 1)
+        return [
+            {key: float(np.median(window))} for window in np.array_split(values, count)
+        ]
+
+    # draw_keyboard is draw_piano, repaint and the display update (see
+    # PerfRecorder.total).
+    busy = fastest_pass(window_medians("busy_ms"))
+    keyboard = fastest_pass(window_medians("draw_keyboard_ms"))
+    return {
+        "frames": len(records),
+        "frame_busy_ms": busy["busy_ms"],
+        "draw_keyboard_ms": keyboard["draw_keyboard_ms"],
+        "draw_keyboard_p99_ms": float(np.percentile(column("draw_keyboard_ms"), 99)),
+        "max_lag_ms": float(column("lag_ms").max()),
+        "dropped_notes": int(column("dropped").max()),
+        "noise": {
+            "frame_busy_ms": busy["noise"]["busy_ms"],
+            "draw_keyboard_ms": keyboard["noise"]["draw_keyboard_ms"],
+        },
+    }
+
+
+def fastest_pass(passes):
+    """
+    The lowest value of every metric over passes (dicts with the same
+    keys), and under "noise" how far each metric's median pass was above
+    its fastest, as a fraction.
+    """
+    metrics = {"noise": {}}
+    for key in passes[0]:
+        values = [timings[key] for timings in passes]
+        metrics[key] = min(values)
+        if metrics[key] > 0:
+            metrics["noise"][key] = float(np.median(values)) / metrics[key] - 1
+    return metrics
+
+
+def bench_file(midi_path, sample_lengths_ms, frame_seconds, engine):
+    """
+    What does not need passes: memory, note density and the frame run.
+    Returns (metrics, parsed events).
+    """
+    tracemalloc.start()
+    events = midi_events.parse_midi_file(midi_path)
+    _, _, timeline = prepare(events, sample_lengths_ms)
+    peak_mem_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    tracemalloc.stop()
+    midi_events.load_midi_events(midi_path)  # make sure the cache is warm
+    notes_per_sec, peak_notes_per_sec = note_density(events)
+
+    result = {
+        "notes": len(events),
+        "duration_s": timeline.duration_ms / 1000,
+        "notes_per_sec": notes_per_sec,
+        "peak_notes_per_sec": peak_notes_per_sec,
+        "peak_mem_mb": peak_mem_mb,
+    }
+    if frame_seconds > 0:
+        records = run_frames(midi_path, frame_seconds, engine)
+        if records is not None:
+            result.update(frame_metrics(records))
+        else:
+            result["error"] = "frame run failed"
+    else:
+        result["skipped"] = FRAME_METRICS
+    return result, events
+
+
+def time_file(midi_path, events, sample_lengths_ms):
+    """One pass over the timed steps of a file, as a dict of their ms (µs)."""
+    _, parse_ms = fastest_of(lambda: midi_events.parse_midi_file(midi_path))
+    (releases, note_ends, timeline), prepare_ms = fastest_of(
+        lambda: prepare(events, sample_lengths_ms)
+    )
+    _, cached_load_ms = fastest_of(
+        lambda: midi_events.load_midi_events(midi_path), QUICK_REPEATS
+    )
+    seek_us, held_us = time_seeks(events, timeline)
+    dispatch_ms, dispatch_calls = time_dispatch(events, releases, note_ends)
+    return {
+        "parse_ms": parse_ms,
+        "prepare_ms": prepare_ms,
+        "cached_load_ms": cached_load_ms,
+        "seek_us": seek_us,
+        "held_us": held_us,
+        "dispatch_ms": dispatch_ms,
+        "dispatch_us_per_call": dispatch_ms * 1000 / max(dispatch_calls, 1),
+    }
+
+
+def bank_sources(setting):
+    """(sources, sorted root sample ids) of a --sparse setting."""
+    sources = sample_bank.sparse_sources(sample_bank.parse_sparse(setting))
+    return sources, sorted({root for root, _ in sources})
+
+
+def load_bank(setting):
+    """The NumPy engine for a --sparse setting, its bank built from the sample cache."""
+    sources, roots = bank_sources(setting)
+    white_samples, black_samples = sample_bank.load_sample_bank(sample_ids=roots)
+    return MixEngine(white_samples + black_samples, sources=sources)
+
+
+def bench_bank(setting):
+    """What does not need passes: the size of a --sparse setting's bank."""
+    tracemalloc.start()
+    engine = load_bank(setting)
+    peak_mem_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    tracemalloc.stop()
+    return {
+        "roots": len(bank_sources(setting)[1]),
+        "bank_mb": engine._bank.nbytes / (1024 * 1024),
+        "peak_mem_mb": peak_mem_mb,
+    }
+
+
+def time_bank(setting):
+    """
+    One pass: loads a --sparse setting's bank and mixes BANK_VOICES random
+    keys from it.
+    """
+    engine, load_ms = fastest_of(lambda: load_bank(setting))
+    rng = np.random.default_rng(SEEK_SEED)
+    for sample_id in rng.integers(
+        0, len(sample_bank.SAMPLE_NAMES), BANK_VOICES
+    ).tolist():
+        engine.play(sample_id, 1 / BANK_VOICES)
+    out = np.zeros((engine.block_size, 2), dtype=np.float32)
+    block_times = []
+    for _ in range(BANK_BLOCKS):
+        start = time.perf_counter()
+        engine.mix_into(out)
+        block_times.append(time.perf_counter() - start)
+    return {"load_ms": load_ms, "mix_ms": min(block_times) * 1000}
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints the metrics that changed by more than threshold and by more than
+    their noise; returns the number of regressions.
+    """
+    regressions = 0
+    for section, metric_names in (
+        ("files", COMPARED_METRICS + FRAME_METRICS),
+        ("banks", BANK_METRICS),
+    ):
+        results_section = results.get(section, {})
+        baseline_section = baseline.get(section, {})
+        limits = noise_limits(
+            [results_section, baseline_section], metric_names, threshold
+        )
+        noisy = [
+            f"{metric} {limits[metric]:.0%}"
+            for metric in metric_names
+            if limits[metric] > threshold
+        ]
+        if noisy:
+            print(f"Allowed for noise in {section}: {', '.join(noisy)}")
+        regressions += _compare_section(
+            results_section, baseline_section, metric_names, limits
+        )
+    print(f"{regressions} regressions beyond {threshold:.0%} or noise, or missing")
+    return regressions
+
+
+def noise_limits(sections, metric_names, threshold):
+    """
+    Per metric, the change that counts: threshold, or the most noise the
+    metric had on any file (or bank) in sections, if that is more. One
+    file's passes can all fall into the same slow stretch and look steady,
+    while the same step on the other files shows what the machine does.
+    """
+    limits = dict.fromkeys(metric_names, threshold)
+    for section in sections:
+        for metrics in section.values():
+            for metric, noise in metrics.get("noise", {}).items():
+                if metric in limits:
+                    limits[metric] = max(limits[metric], noise)
+    return limits
+
+
+def _compare_section(results, baseline, metric_names, limits):
+    regressions = 0
+    for name, metrics in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        for metric in metric_names:
+            old, new = before.get(metric), metrics.get(metric)
+            if not old or metric in metrics.get("skipped", ()):
+                continue
+            if new is None:
+                # A run that failed this time counts against it.
+                regressions += 1
+                reason = metrics.get("error", "not measured")
+                print(f"{'MISSING':>10}  {name}: {metric} {old:.3f} -> ({reason})")
+                continue
+            change = new / old - 1
+            limit = limits[metric]
+            if abs(change) <= limit:
+                continue
+            verdict = "REGRESSION" if change > 0 else "improved"
+            if change > 0:
+                regressions += 1
+            print(
+                f"{verdict:>10}  {name}: {metric} {old:.3f} -> {new:.3f} "
+                f"({change:+.0%}, limit {limit:.0%})"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Arpeggio headless.")
+    parser.add_argument("files", nargs="*", help=f"MIDI files (default: {MIDI_DIR})")
+    parser.add_argument(
+        "-o", "--output", default=RESULTS_PATH, help="results JSON to write"
+    )
+    parser.add_argument("--compare", metavar="JSON", help="earlier results file")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="relative slowdown that counts as a regression (default: 0.25)",
+    )
+    parser.add_argument(
+        "--rounds",
+        type=int,
+        default=ROUNDS,
+        help="passes over the timed steps, the fastest counting; fewer passes "
+        f"see less of the noise (default: {ROUNDS})",
+    )
+    parser.add_argument(
+        "--frame-seconds",
+        type=float,
+        default=FRAME_SECONDS,
+        help="how long main.py plays each file (0 skips the frame run)",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["mixer", "numpy"],
+        default="mixer",
+        help="audio backend for the frame run",
+    )
+    parser.add_argument(
+        "--sparse",
+        action="append",
+        metavar="STEPS",
+        help="sparse sampling setting to build the bank with, as main.py's "
+        f"--sparse (repeatable; default: {', '.join(BANK_SETTINGS)})",
+    )
+    args = parser.parse_args()
+
+    files = args.files or sorted(glob.glob(f"{MIDI_DIR}/*.mid"))
+    sample_lengths_ms = np.array(sample_bank.sample_lengths_ms())
+    results = {
+        "version": RESULTS_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "engine": args.engine,
+        "files": {},
+        "banks": {},
+    }
+    # Name -> (function timing one pass, its arguments, the passes so far),
+    # for every file and bank whose untimed part went well.
+    timed = {}
+    for midi_path in files:
+        name = os.path.basename(midi_path)
+        try:
+            metrics, events = bench_file(
+                midi_path, sample_lengths_ms, args.frame_seconds, args.engine
+            )
+        except Exception as e:
+            print(f"Error benchmarking {midi_path}: {e}")
+            results["files"][name] = {"error": str(e)}
+            continue
+        results["files"][name] = metrics
+        timed[name] = (time_file, (midi_path, events, sample_lengths_ms), [])
+    for setting in args.sparse or BANK_SETTINGS:
+        name = f"sparse {setting}"
+        try:
+            results["banks"][name] = bench_bank(setting)
+        except Exception as e:
+            print(f"Error benchmarking sample bank {setting}: {e}")
+            results["banks"][name] = {"error": str(e)}
+            continue
+        timed[name] = (time_bank, (setting,), [])
+
+    for round_number in range(args.rounds):
+        print(f"Pass {round_number + 1} of {args.rounds}")
+        for name, (time_pass, pass_args, passes) in list(timed.items()):
+            try:
+                passes.append(time_pass(*pass_args))
+            except Exception as e:
+                print(f"Error benchmarking {name}: {e}")
+                del timed[name]
+                section = results["files" if name in results["files"] else "banks"]
+                section[name]["error"] = str(e)
+
+    for name, (_, _, passes) in timed.items():
+        fastest = fastest_pass(passes)
+        section = results["files" if name in results["files"] else "banks"]
+        metrics = section[name]
+        metrics.setdefault("noise", {}).update(fastest.pop("noise"))
+        metrics.update(fastest)
+        if section is results["banks"]:
+            print(
+                f"{name}: {metrics['roots']} samples, "
+                f"{metrics['bank_mb']:.1f} MB, load {metrics['load_ms']:.1f} ms, "
+                f"mix {metrics['mix_ms']:.2f} ms per block"
+            )
+            continue
+        frame_part = ""
+        if "draw_keyboard_ms" in metrics:
+            frame_part = f"draw_keyboard {metrics['draw_keyboard_ms']:.3f} ms, "
+        print(
+            f"{name}: {metrics['notes']} notes, parse {metrics['parse_ms']:.1f} ms, "
+            f"dispatch {metrics['dispatch_ms']:.1f} ms, {frame_part}"
+            f"peak {metrics['peak_mem_mb']:.1f} MB"
+        )
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
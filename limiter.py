@@ -0,0 +1,143 @@
+from math import exp, log10, sqrt
+
+import numpy as np
+
+LIMITER_THRESHOLD = 16
+BASE_NOTE_VOLUME = 0.6
+MAX_CHANNELS = 512
+
+# --- Output limiter (NumPy engine and offline rendering) ---
+# Peak ceiling of the summed output, and how fast gain recovers after a peak.
+LIMITER_CEILING = 0.98
+LIMITER_RELEASE_MS = 250
+LEVEL_BLOCK = 512
+
+
+def velocity_volume(velocity):
+    return BASE_NOTE_VOLUME * velocity / 127.0
+
+
+def limiter_factor(num_playing):
+    """
+    The "soft" dynamic limiter: once more than LIMITER_THRESHOLD notes are
+    sounding, new notes are attenuated by sqrt(threshold / num_playing).
+    Only used where the summed output cannot be measured (pygame.mixer).
+    """
+    if num_playing > LIMITER_THRESHOLD:
+        return sqrt(LIMITER_THRESHOLD / num_playing)
+    return 1.0
+
+
+def note_volume(num_playing, velocity):
+    return velocity_volume(velocity) * limiter_factor(num_playing)
+
+
+def rms_levels(sample, block=LEVEL_BLOCK):
+    """RMS level of every `block` frames of a (frames, channels) sample, as float32."""
+    frames = len(sample) // block * block
+    blocks = np.asarray(sample[:frames], dtype=np.float32).reshape(frames // block, -1)
+    levels = np.sqrt(np.mean(blocks * blocks, axis=1))
+    return np.append(levels, np.float32(0.0)).astype(np.float32)
+
+
+def quietest_voice(levels, positions, gains, block=LEVEL_BLOCK):
+    """
+    Index of the voice that is least audible right now, judged by its gain
+    times its sample's RMS level at its position; ties go to the oldest.
+    levels[i] is rms_levels() of voice i's sample, or None if unknown.
+    """
+    estimate = []
+    for level, pos, gain in zip(levels, positions, gains):
+        if level is not None:
+            gain *= level[min(max(pos, 0) // block, len(level) - 1)]
+        estimate.append(gain)
+    return min(range(len(estimate)), key=lambda i: (estimate[i], -positions[i]))
+
+
+class LimiterStats:
+    """Counters exported by the output limiter and the voice allocator."""
+
+    def __init__(self):
+        self.gain_reduction_db = 0.0
+        self.max_gain_reduction_db = 0.0
+        self.peak = 0.0
+        self.rms = 0.0
+        self.stolen_voices = 0
+        self.dropped_notes = 0
+        self.blocks = 0  # blocks seen by a BlockLimiter
+
+    def snapshot(self):
+        return {
+            "gain_reduction_db": self.gain_reduction_db,
+            "max_gain_reduction_db": self.max_gain_reduction_db,
+            "peak": self.peak,
+            "rms": self.rms,
+            "stolen_voices": self.stolen_voices,
+            "dropped_notes": self.dropped_notes,
+        }
+
+    def report(self):
+        voices = (
+            f"{self.stolen_voices} voices stolen, {self.dropped_notes} notes dropped"
+        )
+        if not self.blocks:
+            return voices
+        return (
+            f"gain reduction {self.gain_reduction_db:.1f} dB "
+            f"(max {self.max_gain_reduction_db:.1f} dB), {voices}"
+        )
+
+
+class BlockLimiter:
+    """
+    Look-ahead peak limiter for a block-wise (frames, 2) stream. Output is
+    delayed by `lookahead` frames, so the gain has already come down by the
+    time a peak leaves the limiter and the ceiling is never exceeded.
+    Blocks must not be longer than lookahead.
+    """
+
+    def __init__(
+        self,
+        lookahead,
+        sample_rate,
+        ceiling=LIMITER_CEILING,
+        release_ms=LIMITER_RELEASE_MS,
+        stats=None,
+    ):
+        self.lookahead = lookahead
+        self.ceiling = ceiling
+        self.stats = stats if stats is not None else LimiterStats()
+        self.gain = 1.0
+        self._release = exp(-1000 / (release_ms * sample_rate))
+        # The delayed frames followed by the newest block.
+        self._buffer = np.zeros((2 * lookahead, 2), dtype=np.float32)
+        self._steps = np.arange(1, lookahead + 1, dtype=np.float32)
+
+    def process(self, block, out):
+        """Writes the next len(block) limited frames into out."""
+        n = len(block)
+        lookahead = self.lookahead
+        buffer = self._buffer[: lookahead + n]
+        buffer[lookahead:] = block
+        peak = max(float(buffer.max()), -float(buffer.min()))
+        target = min(1.0, self.ceiling / peak) if peak > 0 else 1.0
+        if target < self.gain:
+            new_gain = target
+        else:
+            new_gain = target + (self.gain - target) * self._release**n
+        ramp = self._steps[:n] * np.float32((new_gain - self.gain) / n)
+        ramp += np.float32(self.gain)
+        np.multiply(buffer[:n], ramp[:, None], out=out)
+        buffer[:lookahead] = buffer[n:].copy()
+        self.gain = new_gain
+
+        stats = self.stats
+        stats.blocks += 1
+        stats.gain_reduction_db = max(0.0, -20 * log10(new_gain))
+        stats.max_gain_reduction_db = max(
+            stats.max_gain_reduction_db, stats.gain_reduction_db
+        )
+        if n:
+            stats.peak = max(float(out.max()), -float(out.min()))
+            flat = out.reshape(-1)
+            stats.rms = sqrt(float(flat @ flat) / len(flat))
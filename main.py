@@ -1,197 +1,218 @@
-from math import sqrt
-
-import mido
+"""
+Arpeggio: the piano window, its sound and MIDI playback.
+
+Importing this module has no side effects. Arpeggio(args).run() brings the
+app up in stages, timing each one: the window first (with a first frame of
+the keyboard on screen right away), then audio, playback, the playlist and
+MIDI input, then the render loop. mido is only imported once a MIDI file
+actually has to be parsed (on a thread, or in the worker process with
+--playlist) or a MIDI port opened, fonts are loaded on first use, and the sample bank loads in the
+background with pygame.mixer.
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+from array import array
+from functools import cached_property
+
+import numpy as np
 import pygame
 from pygame import mixer
 
+import midi_events
 import piano_lists as pl
-
-pygame.mixer.pre_init(
-    frequency=44100,  # Standard sample rate
-    size=-16,  # 16-bit audio
-    channels=2,  # Stereo
-    buffer=2048,
+import sample_bank
+from asset_cache import SurfaceCache
+from audio_profiles import (
+    CONFIG_PATH,
+    PROFILES,
+    BufferAutoTuner,
+    buffer_ms,
+    load_profile,
 )
+from limiter import (
+    LimiterStats,
+    limiter_factor,
+    note_volume,
+    quietest_voice,
+    rms_levels,
+    velocity_volume,
+)
+from midi_stream import STREAM_MIN_BYTES, MidiStream
+from perf_hud import PerfRecorder
+from playback import PlaybackThread
+from playlist import PLAYLIST_DIR, Playlist, playlist_paths
+from scheduler import LatencyStats, NoteScheduler, OnsetStats
+from voices import RELEASE_MS
+from waterfall import Waterfall
+
+FONT_PATH = "assets/Terserah.ttf"
+FPS = 60
+WIDTH = 52 * 35
+HEIGHT = 640
+
+# --- Keyboard layout ---
+KEY_TOP = HEIGHT - 300
+WHITE_KEY_WIDTH = 35
+BLACK_KEY_WIDTH = 24
+BLACK_KEY_HEIGHT = 200
+# A black key starts this far into the white key on its left.
+BLACK_KEY_OFFSET = 23
+# Frames a key stays lit after it is played. The highlight starts at a
+# brightness set by the note's velocity and fades out over that time, in
+# HIGHLIGHT_LEVELS steps so a lit key is only redrawn a few times.
+HIGHLIGHT_FRAMES = 30
+HIGHLIGHT_LEVELS = 4
+# Outline colour of each level (level 0 is unlit).
+HIGHLIGHT_COLORS = [None] + [
+    (0, 110 + (255 - 110) * (level - 1) // (HIGHLIGHT_LEVELS - 1), 0)
+    for level in range(1, HIGHLIGHT_LEVELS + 1)
+]
+
+PLAYBACK_START_MS = 1000 * 60 * 2 + 15 * 1000
+SEEK_STEP_MS = 5000
+# Playback speed (song tempo times this) range and +/- step.
+SPEED_MIN = 0.2
+SPEED_MAX = 2.0
+SPEED_STEP = 0.1
+MIDI_FILE_PATH = "assets/MIDI/Thomas_Bergersen_-_Made_of_Air_(2_Pianos).mid"
+
+# --- Song timeline (seek/loop bar) ---
+TIMELINE_RECT = pygame.Rect(160, 84, 1140, 10)
+# --- Audio status line (profile, buffer, underruns, latency) ---
+AUDIO_STATUS_RECT = pygame.Rect(160, 70, 760, 13)
+# --- Falling notes, between the title bar and the keyboard ---
+WATERFALL_RECT = pygame.Rect(0, 124, WIDTH, KEY_TOP - 124)
+# --- Performance HUD (--perf) ---
+# The space the panel may take; its height follows the number of lines.
+PERF_HUD_RECT = pygame.Rect(WIDTH - 370, 120, 360, KEY_TOP - 130)
+PERF_HUD_LINE_HEIGHT = 20
+PERF_HUD_REFRESH_FRAMES = 15
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Arpeggio polyphonic piano.")
+    parser.add_argument(
+        "--engine",
+        choices=["mixer", "numpy"],
+        default="mixer",
+        help="audio backend: pygame.mixer channels or the NumPy mixing engine",
+    )
+    parser.add_argument(
+        "--measure-onsets",
+        action="store_true",
+        help="report note onset error against the MIDI timestamps",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="parse MIDI files while playing them "
+        f"(always on for files over {STREAM_MIN_BYTES // (1024 * 1024)} MB)",
+    )
+    parser.add_argument(
+        "--midi-in",
+        nargs="?",
+        const="",
+        metavar="PORT",
+        help="play from a MIDI input port (the first one if PORT is left out)",
+    )
+    parser.add_argument(
+        "--midi-probe",
+        action="store_true",
+        help="measure input to audio latency with test notes sent through a "
+        "loopback virtual MIDI port",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=list(PROFILES),
+        help="audio latency profile: output buffer size and voice count "
+        "(default: from the config file, else dense)",
+    )
+    parser.add_argument(
+        "--config",
+        default=CONFIG_PATH,
+        help=f"JSON file with audio settings (default: {CONFIG_PATH})",
+    )
+    parser.add_argument(
+        "--auto-tune",
+        action="store_true",
+        help="shrink the NumPy engine's output buffer until underruns appear",
+    )
+    parser.add_argument(
+        "--sparse",
+        metavar="STEPS",
+        help="with --engine numpy, load every Nth key's sample and resample the "
+        'keys in between, N for every register ("3") or per register '
+        '("bass=4,middle=2,treble=3")',
+    )
+    parser.add_argument(
+        "--perf",
+        action="store_true",
+        help="show the performance HUD (F3 toggles it)",
+    )
+    parser.add_argument(
+        "--perf-log",
+        metavar="PATH",
+        help="write per-frame timings and counters to PATH as JSON Lines",
+    )
+    parser.add_argument(
+        "--perf-trace",
+        metavar="PATH",
+        help="write a Chrome trace of the whole run to PATH on exit",
+    )
+    parser.add_argument(
+        "--midi",
+        metavar="PATH",
+        help="MIDI file that the spacebar loads",
+    )
+    parser.add_argument(
+        "--playlist",
+        nargs="*",
+        metavar="PATH",
+        help="play MIDI files (and the .mid files in directories) back to back, "
+        "preparing the next one while the current one plays "
+        f"(default: {PLAYLIST_DIR})",
+    )
+    parser.add_argument(
+        "--start",
+        type=float,
+        metavar="SECONDS",
+        help="song position to start playing from "
+        "(default: 2:15, or the start with --playlist)",
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        metavar="FACTOR",
+        help=f"playback speed, from {SPEED_MIN} to {SPEED_MAX} times the song's "
+        "tempo (+/- change it while playing)",
+    )
+    parser.add_argument(
+        "--play-for",
+        type=float,
+        metavar="SECONDS",
+        help="start playing right away and quit after SECONDS (for scripted runs)",
+    )
+    return parser.parse_args(argv)
 
-pygame.init()
-
-pygame.mixer.set_num_channels(512)
 
-font = pygame.font.Font("assets/Terserah.ttf", 48)
-medium_font = pygame.font.Font("assets/Terserah.ttf", 28)
-small_font = pygame.font.Font("assets/Terserah.ttf", 16)
-real_small_font = pygame.font.Font("assets/Terserah.ttf", 10)
-fps = 60
-timer = pygame.time.Clock()
-WIDTH = 52 * 35
-HEIGHT = 400
-screen = pygame.display.set_mode([WIDTH, HEIGHT])
-white_sounds = []
-black_sounds = []
-active_whites = []
-active_blacks = []
-left_oct = 4
-right_oct = 5
-
-g_active_channels = []
-
-playback_messages = []
-playback_start_time = 1000 * 60 * 2 + 15 * 1000
-# playback_start_time = 0
-current_msg_index = 0
-playback_active = False
-
-# --- MIDI Playback/Pause State ---
-midi_loaded = False
-midi_file_path = "assets/MIDI/Thomas_Bergersen_-_Made_of_Air_(2_Pianos).mid"
-
-NOTE_NAMES = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
-
-left_hand = pl.left_hand
-right_hand = pl.right_hand
-piano_notes = pl.piano_notes
-white_notes = pl.white_notes
-black_notes = pl.black_notes
-black_labels = pl.black_labels
-
-
-LIMITER_THRESHOLD = 16
-BASE_NOTE_VOLUME = 0.6
-
-
-for i in range(len(white_notes)):
-    sound = mixer.Sound(f"assets/notes/{white_notes[i]}.wav")
-    white_sounds.append(sound)
-
-for i in range(len(black_notes)):
-    sound = mixer.Sound(f"assets/notes/{black_notes[i]}.wav")
-    black_sounds.append(sound)
-
-pygame.display.set_caption("Arpeggio")
-
-
-white_note_map = {note_name: index for index, note_name in enumerate(white_notes)}
-black_note_map = {note_name: index for index, note_name in enumerate(black_labels)}
-
-
-def midi_to_note_name(midi_num):
-    if not (0 <= midi_num <= 127):
-        return None
-    octave = (midi_num // 12) - 1
-    note_index = midi_num % 12
-    note_name = NOTE_NAMES[note_index]
-    return f"{note_name}{octave}"
-
-
-def load_midi_file(filepath):
-    global playback_messages, current_msg_index, playback_active
-    try:
-        mid = mido.MidiFile(filepath)
-    except Exception as e:
-        print(f"Error loading MIDI file: {e}")
-        return False
-
-    playback_messages = []
-    current_time_sec = 0.0
-
-    for msg in mid:
-        current_time_sec += msg.time
-        if msg.type == "note_on" and msg.velocity > 0:
-            note_name = midi_to_note_name(msg.note)
-            velocity = msg.velocity
-            if note_name:
-                if note_name in black_note_map:
-                    index = black_note_map[note_name]
-                    note_type = "black"
-                    playback_messages.append(
-                        (current_time_sec * 1000, index, note_type, velocity)
-                    )
-                elif note_name in white_note_map:
-                    index = white_note_map[note_name]
-                    note_type = "white"
-                    playback_messages.append(
-                        (current_time_sec * 1000, index, note_type, velocity)
-                    )
-    current_msg_index = 0
-    playback_active = False
-    print(f"Loaded {len(playback_messages)} notes from {filepath}")
-    return True
-
-
-def find_first_note_after(time_ms):
-    """Finds the index of the first note at or after time_ms."""
-    global playback_messages
-    if not playback_messages:
-        return 0
-    # Use enumerate to get both index (i) and message (msg)
-    for i, msg in enumerate(playback_messages):
-        msg_time = msg[0]  # msg[0] is the timestamp
-        if msg_time >= time_ms:
-            return i  # Return the index of the first note found
-    return len(playback_messages)  # No note found, return end of song
-
-
-def play_note_with_limiter(sound_to_play, velocity):
-    """
-    Plays a sound with a more granular "soft" dynamic limiter.
-    Assumes g_active_channels has been pruned *outside* this function.
-    """
-    global g_active_channels
-    num_playing = len(g_active_channels)
-
-    limiter_factor = 1.0
-    if num_playing > LIMITER_THRESHOLD:
-        ratio = LIMITER_THRESHOLD / num_playing
-        limiter_factor = sqrt(ratio)
-
-    velocity_factor = velocity / 127.0
-    final_volume = (BASE_NOTE_VOLUME * limiter_factor) * velocity_factor
-
-    channel = pygame.mixer.find_channel()
-    if channel:
-        channel.set_volume(final_volume)
-        channel.play(sound_to_play)
-        g_active_channels.append(channel)
-    else:
-        print("WARNING: No free channels, note dropped.")
-        pass
-
-
-def draw_piano(whites, blacks):
-    white_rects = []
-    for i in range(52):
-        rect = pygame.draw.rect(screen, "white", [i * 35, HEIGHT - 300, 35, 300], 0, 2)
-        white_rects.append(rect)
-        pygame.draw.rect(screen, "black", [i * 35, HEIGHT - 300, 35, 300], 2, 2)
-        key_label = small_font.render(white_notes[i], True, "black")
-        screen.blit(key_label, (i * 35 + 3, HEIGHT - 20))
+def key_rects():
+    """Screen rects of the 52 white and 36 black keys; the layout never changes."""
+    white_rects = [
+        pygame.Rect(i * WHITE_KEY_WIDTH, KEY_TOP, WHITE_KEY_WIDTH, HEIGHT - KEY_TOP)
+        for i in range(52)
+    ]
     skip_count = 0
     last_skip = 2
     skip_track = 2
     black_rects = []
     for i in range(36):
-        rect = pygame.draw.rect(
-            screen,
-            "black",
-            [23 + (i * 35) + (skip_count * 35), HEIGHT - 300, 24, 200],
-            0,
-            2,
-        )
-        for q in range(len(blacks)):
-            if blacks[q][0] == i:
-                if blacks[q][1] > 0:
-                    pygame.draw.rect(
-                        screen,
-                        "green",
-                        [23 + (i * 35) + (skip_count * 35), HEIGHT - 300, 24, 200],
-                        2,
-                        2,
-                    )
-                    blacks[q][1] -= 1
-
-        key_label = real_small_font.render(black_labels[i], True, "white")
-        screen.blit(key_label, (25 + (i * 35) + (skip_count * 35), HEIGHT - 120))
-        black_rects.append(rect)
+        x = BLACK_KEY_OFFSET + (i + skip_count) * WHITE_KEY_WIDTH
+        black_rects.append(pygame.Rect(x, KEY_TOP, BLACK_KEY_WIDTH, BLACK_KEY_HEIGHT))
         skip_track += 1
         if last_skip == 2 and skip_track == 3:
             last_skip = 3
@@ -201,295 +222,1173 @@ def draw_piano(whites, blacks):
             last_skip = 2
             skip_track = 0
             skip_count += 1
+    return white_rects, black_rects
 
-    for i in range(len(whites)):
-        if whites[i][1] > 0:
-            j = whites[i][0]
-            pygame.draw.rect(screen, "green", [j * 35, HEIGHT - 100, 35, 100], 2, 2)
-            whites[i][1] -= 1
 
-    return white_rects, black_rects, whites, blacks
+def hand_key_table(chars):
+    """
+    [octave][typed character] -> piano key, for a hand whose twelve
+    characters play C to B of its octave (0 to 8).
+    """
+    table = []
+    for octave in range(9):
+        keys = {}
+        for semitone, char in enumerate(chars):
+            key = (octave + 1) * 12 + semitone - midi_events.FIRST_KEY_NOTE
+            if 0 <= key < midi_events.NUM_KEYS:
+                keys[char] = key
+        table.append(keys)
+    return table
+
+
+LEFT_HAND_KEYS = hand_key_table(pl.left_hand)
+RIGHT_HAND_KEYS = hand_key_table(pl.right_hand)
+# Piano key of every white key from left to right, and of every black key.
+WHITE_KEYS = np.flatnonzero(~midi_events.KEY_IS_BLACK).tolist()
+BLACK_KEYS = np.flatnonzero(midi_events.KEY_IS_BLACK).tolist()
+
+
+class Arpeggio:
+    def __init__(self, args):
+        self.args = args
+        self.profile, self.config = load_profile(args.profile, args.config)
+        self.auto_tune = args.auto_tune or bool(self.config.get("auto_tune"))
+        # (root sample id, pitch ratio) of every sample id with --sparse or the
+        # config's "sparse" setting, else None (every key has its own sample).
+        self.sample_sources = None
+        sparse = args.sparse or self.config.get("sparse")
+        if sparse:
+            try:
+                steps = sample_bank.parse_sparse(sparse)
+                self.sample_sources = sample_bank.sparse_sources(steps)
+            except (ValueError, TypeError, AttributeError) as e:
+                print(f"Ignoring sparse sampling setting {sparse!r}: {e}")
+        # (stage name, seconds) of every startup stage run so far.
+        self.startup = []
+
+        self.surface_cache = SurfaceCache()
+        self.timer = pygame.time.Clock()
+        self.screen = None
+        # Per piano key: frames left until its highlight is gone, and the
+        # velocity of the note that lit it. Keys with frames left are also
+        # in self.lighting, so a frame only visits the keys that are lit.
+        self.highlight_frames = array("h", [0] * midi_events.NUM_KEYS)
+        self.highlight_velocity = array("B", [0] * midi_events.NUM_KEYS)
+        self.lighting = set()
+        self.left_oct = 4
+        self.right_oct = 5
+        self.keys_pressed = set()
+
+        self.channel_pool = []
+        self.g_active_channels = []
+        # channel -> (levels, start time, start frame, volume) of the sound it
+        # plays, to find the least audible voice when every channel is busy.
+        self.channel_voices = {}
+        # mixer.Sound -> its rms_levels(), filled in as samples load.
+        self.sound_levels = {}
+        # play_note_with_limiter runs on both the UI and the playback thread.
+        self.channels_lock = threading.Lock()
+        self.engine = None
+        self.scheduler = None
+        self.sample_loader = None
+        self.onset_stats = OnsetStats() if args.measure_onsets else None
+        self.limiter_stats = LimiterStats()
+        self.buffer_tuner = None
+        self.input_latency = None
+        self.player = None
+        self.playlist = None
+        self.live_input = None
+        self.highlight_queues = []
+
+        self.playback_start_time = PLAYBACK_START_MS
+        if args.start is not None:
+            self.playback_start_time = args.start * 1000
+        elif args.playlist is not None:
+            self.playback_start_time = 0.0
+        # --- MIDI Playback/Pause State ---
+        self.midi_loaded = False
+        self.midi_file_path = args.midi or MIDI_FILE_PATH
+        # Playlist index of the song to load and play as soon as the worker
+        # has it ready, or None.
+        self.pending_song = None
+
+        self.left_hand = pl.left_hand
+        self.right_hand = pl.right_hand
+        self.white_notes = pl.white_notes
+        self.black_labels = pl.black_labels
+
+        self.white_keys, self.black_keys = key_rects()
+        # What lights up for each piano key: the bottom of a white key, or
+        # the whole black key.
+        self.highlight_rects = [None] * midi_events.NUM_KEYS
+        for key, rect in zip(WHITE_KEYS, self.white_keys):
+            self.highlight_rects[key] = pygame.Rect(
+                rect.x, HEIGHT - 100, WHITE_KEY_WIDTH, 100
+            )
+        for key, rect in zip(BLACK_KEYS, self.black_keys):
+            self.highlight_rects[key] = rect
+        # Column of every key's falling notes: inside the white key's outline,
+        # or the black key's width. Octave lines go at the left of every C.
+        key_x = [0] * midi_events.NUM_KEYS
+        key_width = [0] * midi_events.NUM_KEYS
+        for key, rect in zip(WHITE_KEYS, self.white_keys):
+            key_x[key] = rect.x + 2
+            key_width[key] = WHITE_KEY_WIDTH - 4
+        for key, rect in zip(BLACK_KEYS, self.black_keys):
+            key_x[key] = rect.x
+            key_width[key] = BLACK_KEY_WIDTH
+        guide_x = [
+            rect.x
+            for rect, name in zip(self.white_keys, self.white_notes)
+            if name.startswith("C")
+        ]
+        self.waterfall = Waterfall(WATERFALL_RECT, key_x, key_width, guide_x)
+        # Song time the waterfall was last drawn at.
+        self.waterfall_ms = 0.0
+        # For hit-testing: the black key starting inside each white key, or -1.
+        self.black_key_after = [-1] * len(self.white_keys)
+        for key, rect in zip(BLACK_KEYS, self.black_keys):
+            self.black_key_after[rect.x // WHITE_KEY_WIDTH] = key
+        # --- Cached layers ---
+        # The screen is composited from a static background (gray + keyboard),
+        # the highlights and hand bars, and the title bar on top, and only the
+        # regions that changed since the last frame are recomposited and pushed.
+        self.background = None
+        self.title_rects = []
+        # Piano key -> highlight level on screen, for the keys that are lit.
+        self.lit = {}
+        self.hand_rects = []
+        self.full_redraw = True
+        self.timeline_state = None
+        self.waterfall_state = None
+        self.scrubbing = False
+        self.loop_start_ms = 0.0
+        self.audio_status = None
+
+        self.perf = None
+        self.perf_hud_visible = False
+        self.perf_hud_panel = None
+        self.perf_notes_seen = 0
+        self.quit_at = None
+
+    # --- Lazily loaded assets ---
+    @cached_property
+    def font(self):
+        return pygame.font.Font(FONT_PATH, 48)
+
+    @cached_property
+    def medium_font(self):
+        return pygame.font.Font(FONT_PATH, 28)
+
+    @cached_property
+    def small_font(self):
+        return pygame.font.Font(FONT_PATH, 16)
+
+    @cached_property
+    def real_small_font(self):
+        return pygame.font.Font(FONT_PATH, 10)
+
+    @cached_property
+    def sample_lengths_ms(self):
+        return np.array(sample_bank.sample_lengths_ms(sources=self.sample_sources))
+
+    # --- Startup ---
+    def run(self):
+        """Starts every subsystem in turn, then runs the UI until it is closed."""
+        if self.args.playlist is not None:
+            # The playlist worker imports this module, and so pygame, again:
+            # keep it from greeting a second time. Set before any thread is
+            # started, as SDL reads the environment from its own threads.
+            os.environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "1"
+        self._stage("display", self.init_display)
+        self._stage("first frame", self.draw_first_frame)
+        self._stage("audio", self.init_audio)
+        self._stage("playback", self.init_playback)
+        self._stage("playlist", self.init_playlist)
+        if self.args.midi_in is not None or self.args.midi_probe:
+            self._stage("midi input", self.init_midi_input)
+        self._stage("ui", self.init_ui)
+        stages = ", ".join(f"{name} {sec * 1000:.0f} ms" for name, sec in self.startup)
+        total_ms = sum(sec for _, sec in self.startup) * 1000
+        print(f"Startup: {stages} ({total_ms:.0f} ms)")
+        try:
+            self.main_loop()
+        finally:
+            self.shutdown()
+
+    def _stage(self, name, init):
+        start = time.perf_counter()
+        init()
+        self.startup.append((name, time.perf_counter() - start))
+
+    def init_display(self):
+        pygame.display.init()
+        pygame.font.init()
+        self.screen = pygame.display.set_mode([WIDTH, HEIGHT])
+        pygame.display.set_caption("Arpeggio")
+
+    def draw_first_frame(self):
+        """Puts the keyboard and title on screen before audio is up."""
+        self.background = pygame.Surface((WIDTH, HEIGHT))
+        self.background.fill("gray")
+        self.draw_keyboard(self.background)
+        self.waterfall.draw(self.background, 0.0)
+        self.screen.blit(self.background, (0, 0))
+        # Measure where the title bar lands, so repaint() only redraws it when
+        # a dirty region touches it.
+        self.title_rects = self.draw_title_bar(self.screen)
+        pygame.display.flip()
+
+    def init_audio(self):
+        profile = self.profile
+        mixer.init(
+            frequency=44100,  # Standard sample rate
+            size=-16,  # 16-bit audio
+            channels=2,  # Stereo
+            buffer=profile.mixer_buffer,
+        )
+        mixer.set_num_channels(profile.channels)
+        # Fixed Channel objects, so a channel can be recognised again when it
+        # has to be stolen (mixer.Channel(i) returns a new wrapper every time).
+        self.channel_pool = [mixer.Channel(i) for i in range(profile.channels)]
+
+        if self.args.engine == "numpy":
+            from mix_engine import MixEngine
+
+            roots = None
+            if self.sample_sources is not None:
+                roots = sorted({root for root, _ in self.sample_sources})
+            white_samples, black_samples = sample_bank.load_sample_bank(
+                sample_ids=roots
+            )
+            engine = MixEngine(
+                white_samples + black_samples,
+                block_size=profile.engine_buffer,
+                max_voices=profile.channels,
+                sources=self.sample_sources,
+            )
+            try:
+                engine.start()
+                self.scheduler = NoteScheduler(engine)
+                engine.onset_stats = self.onset_stats
+                self.engine = engine
+            except RuntimeError as e:
+                print(
+                    f"Could not start NumPy engine ({e}), falling back to pygame.mixer"
+                )
+        if self.engine is not None:
+            self.limiter_stats = self.engine.stats
+
+        if self.auto_tune:
+            if self.engine is not None:
+                self.buffer_tuner = BufferAutoTuner(self.engine)
+            else:
+                print("Auto-tune needs --engine numpy, keeping the profile's buffer")
+
+        if self.args.midi_in is not None or self.args.midi_probe:
+            self.input_latency = LatencyStats(self.output_latency_ms())
+            if self.engine is not None:
+                self.engine.latency_stats = self.input_latency
+
+        if self.engine is None:
+            self._start_sample_loader()
+
+    def _start_sample_loader(self):
+        # Samples load in the background while the window is already up. The
+        # preprocessed cache is only usable if SDL kept the requested format.
+        cached_samples = None
+        if mixer.get_init() == sample_bank.CACHE_FORMAT:
+            cached_samples = sample_bank.open_cache()
+
+        if self.sample_sources is not None:
+            # Every key needs its own full-length Sound here, so resampling
+            # them from fewer roots would save no memory.
+            print("Sparse sampling needs --engine numpy, loading every sample")
+            self.sample_sources = None
+
+        def load_sound(sample_id):
+            if cached_samples is not None:
+                sound = mixer.Sound(
+                    buffer=sample_bank.as_stereo(cached_samples[sample_id])
+                )
+            else:
+                sound = mixer.Sound(
+                    f"assets/notes/{sample_bank.SAMPLE_NAMES[sample_id]}.wav"
+                )
+            if mixer.get_init() == sample_bank.CACHE_FORMAT:
+                raw = np.frombuffer(sound.get_raw(), dtype=np.int16).reshape(-1, 2)
+                self.sound_levels[sound] = rms_levels(raw / 32768.0)
+            return sound
+
+        def cache_sounds(sounds):
+            """Writes the decoded sounds out so the next launch can skip decoding."""
+            raw = [
+                np.frombuffer(sound.get_raw(), dtype=np.int16).reshape(-1, 2)
+                for sound in sounds
+            ]
+            sample_bank.build_cache(raw)
 
+        self.sample_loader = sample_bank.LazySampleLoader(
+            load_sound,
+            on_complete=cache_sounds if cached_samples is None else None,
+        )
+        # Nearest to the middle of each hand's octave first.
+        self.sample_loader.start(
+            [(self.left_oct + 1) * 12 + 6, (self.right_oct + 1) * 12 + 6]
+        )
 
-def draw_hands(rightOct, leftOct, rightHand, leftHand):
-    # left hand
-    pygame.draw.rect(
-        screen, "dark gray", [(leftOct * 245) - 175, HEIGHT - 60, 245, 30], 0, 4
-    )
-    pygame.draw.rect(
-        screen, "black", [(leftOct * 245) - 175, HEIGHT - 60, 245, 30], 4, 4
-    )
-    text = small_font.render(leftHand[0], True, "white")
-    screen.blit(text, ((leftOct * 245) - 165, HEIGHT - 55))
-    text = small_font.render(leftHand[2], True, "white")
-    screen.blit(text, ((leftOct * 245) - 130, HEIGHT - 55))
-    text = small_font.render(leftHand[4], True, "white")
-    screen.blit(text, ((leftOct * 245) - 95, HEIGHT - 55))
-    text = small_font.render(leftHand[5], True, "white")
-    screen.blit(text, ((leftOct * 245) - 60, HEIGHT - 55))
-    text = small_font.render(leftHand[7], True, "white")
-    screen.blit(text, ((leftOct * 245) - 25, HEIGHT - 55))
-    text = small_font.render(leftHand[9], True, "white")
-    screen.blit(text, ((leftOct * 245) + 10, HEIGHT - 55))
-    text = small_font.render(leftHand[11], True, "white")
-    screen.blit(text, ((leftOct * 245) + 45, HEIGHT - 55))
-    text = small_font.render(leftHand[1], True, "black")
-    screen.blit(text, ((leftOct * 245) - 148, HEIGHT - 55))
-    text = small_font.render(leftHand[3], True, "black")
-    screen.blit(text, ((leftOct * 245) - 113, HEIGHT - 55))
-    text = small_font.render(leftHand[6], True, "black")
-    screen.blit(text, ((leftOct * 245) - 43, HEIGHT - 55))
-    text = small_font.render(leftHand[8], True, "black")
-    screen.blit(text, ((leftOct * 245) - 8, HEIGHT - 55))
-    text = small_font.render(leftHand[10], True, "black")
-    screen.blit(text, ((leftOct * 245) + 27, HEIGHT - 55))
-    # right hand
-    pygame.draw.rect(
-        screen, "dark gray", [(rightOct * 245) - 175, HEIGHT - 60, 245, 30], 0, 4
-    )
-    pygame.draw.rect(
-        screen, "black", [(rightOct * 245) - 175, HEIGHT - 60, 245, 30], 4, 4
-    )
-    text = small_font.render(rightHand[0], True, "white")
-    screen.blit(text, ((rightOct * 245) - 165, HEIGHT - 55))
-    text = small_font.render(rightHand[2], True, "white")
-    screen.blit(text, ((rightOct * 245) - 130, HEIGHT - 55))
-    text = small_font.render(rightHand[4], True, "white")
-    screen.blit(text, ((rightOct * 245) - 95, HEIGHT - 55))
-    text = small_font.render(rightHand[5], True, "white")
-    screen.blit(text, ((rightOct * 245) - 60, HEIGHT - 55))
-    text = small_font.render(rightHand[7], True, "white")
-    screen.blit(text, ((rightOct * 245) - 25, HEIGHT - 55))
-    text = small_font.render(rightHand[9], True, "white")
-    screen.blit(text, ((rightOct * 245) + 10, HEIGHT - 55))
-    text = small_font.render(rightHand[11], True, "white")
-    screen.blit(text, ((rightOct * 245) + 45, HEIGHT - 55))
-    text = small_font.render(rightHand[1], True, "black")
-    screen.blit(text, ((rightOct * 245) - 148, HEIGHT - 55))
-    text = small_font.render(rightHand[3], True, "black")
-    screen.blit(text, ((rightOct * 245) - 113, HEIGHT - 55))
-    text = small_font.render(rightHand[6], True, "black")
-    screen.blit(text, ((rightOct * 245) - 43, HEIGHT - 55))
-    text = small_font.render(rightHand[8], True, "black")
-    screen.blit(text, ((rightOct * 245) - 8, HEIGHT - 55))
-    text = small_font.render(rightHand[10], True, "black")
-    screen.blit(text, ((rightOct * 245) + 27, HEIGHT - 55))
-
-
-def draw_title_bar():
-    instruction_text = medium_font.render(
-        "Up/Down Arrows Change Left Hand", True, "black"
-    )
-    screen.blit(instruction_text, (WIDTH - 500, 10))
-    instruction_text2 = medium_font.render(
-        "Left/Right Arrows Change Right Hand", True, "black"
-    )
-    screen.blit(instruction_text2, (WIDTH - 500, 50))
-
-    # --- Updated text label ---
-    instruction_text3 = medium_font.render("Spacebar to Play/Pause/Seek", True, "black")
-    screen.blit(instruction_text3, (WIDTH - 500, 90))
-    # --------------------------
-
-    img = pygame.transform.scale(pygame.image.load("assets/logo.png"), [150, 150])
-    screen.blit(img, (0, -34))
-    title_text = font.render("A Project of the Resonance Committee.", True, "white")
-    screen.blit(title_text, (298, 18))
-    title_text = font.render("A Project of the Resonance Committee.", True, "black")
-    screen.blit(title_text, (300, 20))
-
-
-
-run = True
-keys_pressed = set()
-while run:
-    left_dict = {
-        "Z": f"C{left_oct}",
-        "S": f"C#{left_oct}",
-        "X": f"D{left_oct}",
-        "D": f"D#{left_oct}",
-        "C": f"E{left_oct}",
-        "V": f"F{left_oct}",
-        "G": f"F#{left_oct}",
-        "B": f"G{left_oct}",
-        "H": f"G#{left_oct}",
-        "N": f"A{left_oct}",
-        "J": f"A#{left_oct}",
-        "M": f"B{left_oct}",
-    }
-    right_dict = {
-        "R": f"C{right_oct}",
-        "5": f"C#{right_oct}",
-        "T": f"D{right_oct}",
-        "6": f"D#{right_oct}",
-        "Y": f"E{right_oct}",
-        "U": f"F{right_oct}",
-        "8": f"F#{right_oct}",
-        "I": f"G{right_oct}",
-        "9": f"G#{right_oct}",
-        "O": f"A{right_oct}",
-        "0": f"A#{right_oct}",
-        "P": f"B{right_oct}",
-    }
-    timer.tick(fps)
-    screen.fill("gray")
-
-    # --- Prune dead channels ---
-    g_active_channels = [ch for ch in g_active_channels if ch.get_busy()]
-
-    # --- MIDI Playback Logic ---
-    if playback_active and current_msg_index < len(playback_messages):
-        now_ms = pygame.time.get_ticks() - playback_start_time
-
-        while current_msg_index < len(playback_messages):
-            msg_time_ms, index, note_type, velocity = playback_messages[
-                current_msg_index
-            ]
-            if now_ms >= msg_time_ms:
-                sound_to_play = None
-                if note_type == "black":
-                    sound_to_play = black_sounds[index]
-                    active_blacks.append([index, 30])
-                else:
-                    sound_to_play = white_sounds[index]
-                    active_whites.append([index, 30])
+    def init_playback(self):
+        self.player = PlaybackThread(
+            self.play_midi_note, self.scheduler, self.onset_stats, self.release_voice
+        )
+        self.player.start()
+        self.set_speed(self.args.speed)
+        self.highlight_queues = [self.player.highlights]
+        # Hand the GIL over more often so the playback thread is not stalled
+        # for a full default 5 ms switch interval behind the renderer.
+        sys.setswitchinterval(0.001)
+
+    def init_playlist(self):
+        """Starts preparing the first song in the background."""
+        paths = [self.midi_file_path]
+        repeat = self.args.playlist is not None
+        if repeat:
+            sources = self.args.playlist or [PLAYLIST_DIR]
+            paths = playlist_paths(sources) or paths
+            if paths == [self.midi_file_path]:
+                print(f"No MIDI files in {', '.join(sources)}")
+        # A single song is prepared on a thread: starting a worker process
+        # for it would cost more than it saves.
+        self.playlist = Playlist(
+            paths,
+            self.sample_lengths_ms,
+            repeat=repeat,
+            stream=self.args.stream,
+            worker=repeat,
+        )
+        self.playlist.prepare(0)
 
-                if sound_to_play:
-                    play_note_with_limiter(sound_to_play, velocity)
+    def init_midi_input(self):
+        from midi_input import LOOPBACK_PORT, LiveInput, input_names, probe_loopback
 
-                current_msg_index += 1
+        live_input = LiveInput(self.play_live_note, self.release_voice)
+        try:
+            if self.args.midi_probe:
+                live_input.open(LOOPBACK_PORT, virtual=True)
             else:
-                # This note is in the future, stop checking for now
-                break
+                live_input.open(self.args.midi_in or None)
+        except ImportError as e:
+            print(
+                f"Could not open MIDI input ({e}); its backend comes with the "
+                "midi extra: uv sync --extra midi"
+            )
+            return
+        except Exception as e:
+            print(f"Could not open MIDI input ({e}); ports: {input_names()}")
+            return
+        print(f"Listening for MIDI on {live_input.port.name}")
+        self.live_input = live_input
+        self.highlight_queues.append(live_input.highlights)
+
+        if self.args.midi_probe:
+
+            def run_probe():
+                try:
+                    probe_loopback()
+                except Exception as e:
+                    print(f"Latency probe failed: {e}")
+                self.input_latency.report()
+
+            threading.Thread(target=run_probe, name="midi-probe", daemon=True).start()
+
+    def init_ui(self):
+        args = self.args
+        if args.perf or args.perf_log or args.perf_trace:
+            perf = PerfRecorder(args.perf_log, args.perf_trace)
+            self.perf = perf
+            self.perf_hud_visible = args.perf
+            # Timed by rebinding, so without --perf the hot path stays untouched.
+            self.draw_piano = perf.timed("draw_piano", self.draw_piano)
+            self.draw_hands = perf.timed("draw_hands", self.draw_hands)
+            self.draw_title_bar = perf.timed("draw_title_bar", self.draw_title_bar)
+            self.waterfall.draw = perf.timed("draw_waterfall", self.waterfall.draw)
+            # draw_piano only works out what changed; the keys are drawn by
+            # repaint() and shown by present(), which are most of the cost.
+            self.repaint = perf.timed("repaint", self.repaint)
+            self.present = perf.timed("present", self.present)
+            perf.total("draw_keyboard", ("draw_piano", "repaint", "present"))
+
+        if args.play_for is not None:
+            if self.load_song(self.playlist.position, self.playback_start_time):
+                self.midi_loaded = True
+                self.player.resume()
+            self.quit_at = time.perf_counter() + args.play_for
+
+    def shutdown(self):
+        if self.player is not None:
+            self.player.stop()
+        if self.playlist is not None:
+            self.playlist.close()
+        if self.perf is not None:
+            self.perf.close()
+        if self.live_input is not None:
+            self.live_input.close()
+        if self.input_latency is not None:
+            self.input_latency.report()
+        print(f"Surface cache: {self.surface_cache.stats()}")
+        print(f"Limiter: {self.limiter_stats.report()}")
+        if self.engine is not None:
+            print(f"Audio ({self.profile.name}): {self.engine.audio_stats.report()}")
+            self.engine.close()
+        pygame.quit()
+
+    # --- Sound ---
+    def output_latency_ms(self):
+        """What is still to play once a note has been mixed."""
+        if self.engine is not None:
+            # The limiter's look-ahead delay, then the device buffer.
+            engine = self.engine
+            return buffer_ms(engine.limiter.lookahead + engine.buffer_frames)
+        return buffer_ms(self.profile.mixer_buffer)
+
+    def load_song(self, index, start_ms=0.0):
+        """
+        Loads playlist song index into the player at start_ms, waiting for
+        the worker if it has not prepared the song yet. In playlist mode a
+        song that cannot be loaded is dropped from the playlist.
+        """
+        playlist = self.playlist
+        player = self.player
+        path = playlist.paths[index]
+        try:
+            song = playlist.take(index)
+        except Exception as e:
+            print(f"Error loading MIDI file: {e}")
+            if playlist.repeat:
+                playlist.drop(index)
+            return False
+
+        playlist.position = index
+        if isinstance(song, MidiStream):
+            # Playback starts as soon as the first chunks are parsed.
+            player.load_stream(song)
+            player.seek(start_ms)
+            print(f"Streaming {path}")
+        else:
+            events, releases, timeline = song
+            player.load(events, releases, timeline.note_ends, timeline)
+            player.seek(start_ms)
+            self.prioritize_samples(events)
+            print(f"Loaded {len(events)} notes from {path}")
+        playlist.queued = None
+        playlist.prepare(playlist.next_index())
+        return True
+
+    def set_speed(self, speed):
+        """Sets the playback speed, kept within SPEED_MIN and SPEED_MAX."""
+        speed = round(min(max(speed, SPEED_MIN), SPEED_MAX), 2)
+        if speed != self.player.speed:
+            self.player.set_speed(speed)
+            print(f"Playback speed {speed:.0%}")
+
+    def prioritize_samples(self, events):
+        if self.sample_loader is not None:
+            # Queue the song's notes ahead of the rest, in order of first use.
+            used, first_use = np.unique(events.sample, return_index=True)
+            self.sample_loader.prioritize(used[np.argsort(first_use)].tolist())
+
+    def update_playlist(self):
+        """
+        Follows the playback thread onto the song it switched to, plays the
+        pending song once the worker has it ready, and queues the next one.
+        """
+        playlist = self.playlist
+        player = self.player
+        if playlist.queued is not None and player.queued is None:
+            playlist.position, playlist.queued = playlist.queued, None
+            print(f"Now playing {playlist.paths[playlist.position]}")
+            playlist.prepare(playlist.next_index())
+
+        following = playlist.next_index()
+        if (
+            self.midi_loaded
+            and self.pending_song is None
+            and following is not None
+            and playlist.queued is None
+        ):
+            if player.finished and not player.active:
+                # The song ended before the next one was ready to be queued.
+                self.pending_song = following
+            elif playlist.ready(following):
+                self.queue_song(following)
+
+        index = self.pending_song
+        if index is not None and playlist.ready(index):
+            self.pending_song = None
+            start_ms = 0.0 if self.midi_loaded else self.playback_start_time
+            if self.load_song(index, start_ms):
+                self.midi_loaded = True
+                position_ms = player.resume()
+                print(f"Playing from {position_ms / 1000.0:.2f}s...")
+            elif playlist.repeat and len(playlist):
+                # Go on with the song that took the failed one's place.
+                self.pending_song = index % len(playlist)
+                playlist.prepare(self.pending_song)
+
+    def queue_song(self, index):
+        """Has the player go on to playlist song index once the current one ends."""
+        playlist = self.playlist
+        path = playlist.paths[index]
+        try:
+            song = playlist.take(index)
+        except Exception as e:
+            print(f"Error loading {path}: {e}")
+            playlist.drop(index)
+            playlist.prepare(playlist.next_index())
+            return
+        if not isinstance(song, MidiStream):
+            self.prioritize_samples(song[0])
+        self.player.queue(song)
+        playlist.queued = index
+
+    def play_note_with_limiter(
+        self,
+        sound_to_play,
+        velocity,
+        at_frame=None,
+        offset_ms=0,
+        hold_ms=None,
+        stamp=None,
+    ):
+        """
+        Plays a sound with a more granular "soft" dynamic limiter.
+        Assumes g_active_channels has been pruned *outside* this function.
+        With the NumPy engine, sound_to_play is a sample bank index instead,
+        at_frame optionally schedules it at an exact stream frame, and only the
+        velocity sets its gain: the engine limits its summed output itself.
+        offset_ms starts the sound part-way in, e.g. for notes held across a seek.
+        hold_ms, if given, releases the note that long after its start.
+        stamp is the perf_counter() time of the live input that played the note.
+        Returns the voice that release_voice() fades out, or None if the note
+        was dropped or the engine releases it by itself.
+        """
+        engine = self.engine
+        if engine is not None:
+            volume = velocity_volume(velocity)
+            release = None
+            if hold_ms is not None:
+                release = round(hold_ms * sample_bank.SAMPLE_RATE / 1000)
+            if at_frame is not None:
+                engine.schedule(sound_to_play, volume, at_frame, release)
+                return None
+            offset = int(offset_ms * sample_bank.SAMPLE_RATE / 1000)
+            voice = engine.play(sound_to_play, volume, offset, release, stamp)
+            return voice if release is None else None
+
+        levels = self.sound_levels.get(sound_to_play)
+        frequency, size, channels = mixer.get_init()
+        start_frame = int(offset_ms * frequency / 1000)
+        if offset_ms > 0:
+            frame_bytes = abs(size) // 8 * channels
+            raw = sound_to_play.get_raw()
+            skip = start_frame * frame_bytes
+            if skip >= len(raw):
+                return None
+            sound_to_play = mixer.Sound(buffer=raw[skip:])
+
+        with self.channels_lock:
+            final_volume = note_volume(len(self.g_active_channels), velocity)
+
+            channel = next((ch for ch in self.channel_pool if not ch.get_busy()), None)
+            if channel is None:
+                channel = self.steal_channel(frequency)
+            if channel is None:
+                print("WARNING: No free channels, note dropped.")
+                self.limiter_stats.dropped_notes += 1
+                return None
+            channel.set_volume(final_volume)
+            channel.play(sound_to_play)
+            if stamp is not None and self.input_latency is not None:
+                self.input_latency.add((time.perf_counter() - stamp) * 1000)
+            if channel not in self.g_active_channels:
+                self.g_active_channels.append(channel)
+            # A new tuple for every play, so release_voice() can tell whether
+            # the channel still plays this note: a key's notes share a Sound.
+            voice = (levels, time.perf_counter(), start_frame, final_volume)
+            self.channel_voices[channel] = voice
+            return channel, voice
+
+    def steal_channel(self, frequency):
+        """
+        Stops and returns the channel whose sound is least audible right now
+        (see quietest_voice), or None if none is known. Needs channels_lock.
+        """
+        candidates = [ch for ch in self.g_active_channels if ch in self.channel_voices]
+        if not candidates:
+            return None
+        now = time.perf_counter()
+        levels, positions, gains = [], [], []
+        for channel in candidates:
+            level, started, start_frame, volume = self.channel_voices[channel]
+            levels.append(level)
+            positions.append(start_frame + int((now - started) * frequency))
+            gains.append(volume)
+        channel = candidates[quietest_voice(levels, positions, gains)]
+        channel.stop()
+        self.limiter_stats.stolen_voices += 1
+        return channel
+
+    def release_voice(self, voice):
+        """Fades out a play_note_with_limiter voice, unless its channel moved on."""
+        if self.engine is not None:
+            self.engine.release(voice)
+            return
+        channel, played = voice
+        with self.channels_lock:
+            if self.channel_voices.get(channel) is played:
+                channel.fadeout(RELEASE_MS)
+
+    def note_sound(self, key):
+        """
+        The sound for a piano key: a sample bank index for the NumPy engine,
+        otherwise a mixer.Sound (loaded on the spot if the background loader
+        has not reached it yet).
+        """
+        sample_id = int(midi_events.KEY_SAMPLE[key])
+        if self.engine is not None:
+            return sample_id
+        return self.sample_loader.get(sample_id)
+
+    def play_midi_note(self, key, velocity, hold_ms, at_frame=None, offset_ms=0):
+        """Called from the playback thread for every due (or held) MIDI note."""
+        return self.play_note_with_limiter(
+            self.note_sound(key),
+            velocity,
+            at_frame,
+            offset_ms,
+            hold_ms,
+        )
 
-        if current_msg_index >= len(playback_messages):
-            print("Playback finished.")
-            playback_active = False
-            playback_start_time = 0
+    def play_live_note(self, key, velocity, stamp):
+        """Called from the MIDI input thread for every note played on a controller."""
+        return self.play_note_with_limiter(self.note_sound(key), velocity, stamp=stamp)
+
+    # --- Drawing ---
+    def draw_keyboard(self, surface):
+        """Draws the unlit keys and their labels. Only used to build the background."""
+        for i, rect in enumerate(self.white_keys):
+            pygame.draw.rect(surface, "white", rect, 0, 2)
+            pygame.draw.rect(surface, "black", rect, 2, 2)
+            key_label = self.surface_cache.text(
+                self.small_font, self.white_notes[i], "black"
+            )
+            surface.blit(key_label, (rect.x + 3, HEIGHT - 20))
+        for i, rect in enumerate(self.black_keys):
+            pygame.draw.rect(surface, "black", rect, 0, 2)
+            key_label = self.surface_cache.text(
+                self.real_small_font, self.black_labels[i], "white"
+            )
+            surface.blit(key_label, (rect.x + 2, HEIGHT - 120))
+
+    def timeline_x(self, time_ms):
+        duration_ms = self.player.duration_ms
+        fraction = time_ms / duration_ms if duration_ms else 0.0
+        return TIMELINE_RECT.x + int(TIMELINE_RECT.w * min(max(fraction, 0.0), 1.0))
+
+    def timeline_time(self, x):
+        fraction = (x - TIMELINE_RECT.x) / TIMELINE_RECT.w
+        return min(max(fraction, 0.0), 1.0) * self.player.duration_ms
+
+    def draw_timeline(self, surface):
+        """Song progress bar, with the loop section (if any) marked in white."""
+        player = self.player
+        # A streamed song's length is only known once it has been parsed.
+        if not player.duration_ms:
+            return
+        bar = TIMELINE_RECT
+        pygame.draw.rect(surface, "dark gray", bar, 0, 3)
+        if player.loop is not None:
+            x0 = self.timeline_x(player.loop[0])
+            x1 = self.timeline_x(player.loop[1])
+            pygame.draw.rect(surface, "white", [x0, bar.y, x1 - x0, bar.h])
+        x = self.timeline_x(player.current_ms())
+        pygame.draw.rect(surface, "green", [bar.x, bar.y, x - bar.x, bar.h], 0, 3)
+        pygame.draw.rect(surface, "black", bar, 1, 3)
+
+    def audio_status_text(self):
+        engine = self.engine
+        parts = [f"Audio: {self.profile.name}"]
+        if engine is not None:
+            stats = engine.audio_stats
+            parts += [
+                f"buffer {engine.buffer_frames}",
+                f"output {self.output_latency_ms():.1f} ms",
+                f"underruns {stats.underruns}",
+                f"mix max {stats.max_mix_ms:.1f} ms",
+            ]
+        else:
+            parts += [
+                f"mixer buffer {self.profile.mixer_buffer}",
+                f"output {self.output_latency_ms():.1f} ms",
+                f"{self.profile.channels} channels",
+            ]
+        if self.player.speed != 1.0:
+            parts.append(f"speed {self.player.speed:.0%}")
+        input_latency = self.input_latency
+        if input_latency is not None and input_latency.latencies_ms:
+            latencies = input_latency.latencies_ms
+            parts.append(f"input to audio {sum(latencies) / len(latencies):.1f} ms")
+        return " | ".join(parts)
+
+    def draw_audio_status(self, surface):
+        # The text changes all the time, so it is not worth caching.
+        text = self.real_small_font.render(self.audio_status, True, "black")
+        surface.blit(text, AUDIO_STATUS_RECT.topleft)
+
+    def record_perf_frame(self, frame_ms):
+        """Closes the frame in the perf recorder with this frame's counters."""
+        engine = self.engine
+        player = self.player
+        if engine is not None:
+            voices = engine.active_voices
+            gain = engine.limiter.gain
+        else:
+            voices = len(self.g_active_channels)
+            gain = limiter_factor(voices)
+        notes = player.notes_dispatched
+        self.perf.end_frame(
+            frame_ms,
+            self.timer.get_rawtime(),
+            {
+                "notes": notes - self.perf_notes_seen,
+                "voices": voices,
+                "limiter": gain,
+                "dropped": self.limiter_stats.dropped_notes,
+                "lag_ms": player.max_lag_ms,
+            },
+        )
+        self.perf_notes_seen = notes
+        player.max_lag_ms = 0.0
+
+    def draw_perf_hud(self, surface):
+        # Rendered once per refresh: the waterfall under it repaints every frame.
+        if self.perf_hud_panel is None:
+            lines = self.perf.hud_lines()
+            height = min(12 + PERF_HUD_LINE_HEIGHT * len(lines), PERF_HUD_RECT.h)
+            panel = pygame.Surface((PERF_HUD_RECT.w, height), pygame.SRCALPHA)
+            panel.fill((0, 0, 0, 170))
+            for i, line in enumerate(lines):
+                text = self.small_font.render(line, True, "white")
+                panel.blit(text, (8, 6 + PERF_HUD_LINE_HEIGHT * i))
+            self.perf_hud_panel = panel
+        surface.blit(self.perf_hud_panel, PERF_HUD_RECT)
+
+    def repaint(self, rects):
+        """Recomposites every layer inside the given screen rects."""
+        screen = self.screen
+        for rect in rects:
+            screen.set_clip(rect)
+            # The waterfall is opaque, so what it covers needs no background.
+            if not WATERFALL_RECT.contains(rect):
+                screen.blit(self.background, rect, rect)
+            if rect.colliderect(WATERFALL_RECT):
+                self.waterfall.draw(screen, self.waterfall_ms)
+            for key, level in self.lit.items():
+                if self.highlight_rects[key].colliderect(rect):
+                    color = HIGHLIGHT_COLORS[level]
+                    pygame.draw.rect(screen, color, self.highlight_rects[key], 2, 2)
+            if rect.collidelist(self.hand_rects) != -1:
+                self.draw_hands(
+                    self.right_oct, self.left_oct, self.right_hand, self.left_hand
+                )
+            if rect.colliderect(TIMELINE_RECT):
+                self.draw_timeline(screen)
+            if rect.colliderect(AUDIO_STATUS_RECT):
+                self.draw_audio_status(screen)
+            if self.perf_hud_visible and rect.colliderect(PERF_HUD_RECT):
+                self.draw_perf_hud(screen)
+            if rect.collidelist(self.title_rects) != -1:
+                self.draw_title_bar(screen)
+        screen.set_clip(None)
+
+    def highlight(self, key, velocity):
+        self.highlight_frames[key] = HIGHLIGHT_FRAMES
+        self.highlight_velocity[key] = velocity
+        self.lighting.add(key)
+
+    def draw_piano(self):
+        """
+        Advances the highlight countdowns and returns the rects of the keys
+        whose highlight level changed this frame.
+        """
+        frames = self.highlight_frames
+        velocity = self.highlight_velocity
+        lit = {}
+        for key in self.lighting:
+            # Rounded up, so a key stays visibly lit until its last frame.
+            lit[key] = -(
+                -HIGHLIGHT_LEVELS
+                * velocity[key]
+                * frames[key]
+                // (127 * HIGHLIGHT_FRAMES)
+            )
+            frames[key] -= 1
+        self.lighting = {key for key in self.lighting if frames[key] > 0}
+        dirty = [
+            self.highlight_rects[key]
+            for key in lit.keys() | self.lit.keys()
+            if lit.get(key) != self.lit.get(key)
+        ]
+        self.lit = lit
+        return dirty
+
+    def draw_hands(self, rightOct, leftOct, rightHand, leftHand):
+        screen = self.screen
+        text_of = self.surface_cache.text
+        small_font = self.small_font
+        # left hand
+        pygame.draw.rect(
+            screen, "dark gray", [(leftOct * 245) - 175, HEIGHT - 60, 245, 30], 0, 4
+        )
+        pygame.draw.rect(
+            screen, "black", [(leftOct * 245) - 175, HEIGHT - 60, 245, 30], 4, 4
+        )
+        text = text_of(small_font, leftHand[0], "white")
+        screen.blit(text, ((leftOct * 245) - 165, HEIGHT - 55))
+        text = text_of(small_font, leftHand[2], "white")
+        screen.blit(text, ((leftOct * 245) - 130, HEIGHT - 55))
+        text = text_of(small_font, leftHand[4], "white")
+        screen.blit(text, ((leftOct * 245) - 95, HEIGHT - 55))
+        text = text_of(small_font, leftHand[5], "white")
+        screen.blit(text, ((leftOct * 245) - 60, HEIGHT - 55))
+        text = text_of(small_font, leftHand[7], "white")
+        screen.blit(text, ((leftOct * 245) - 25, HEIGHT - 55))
+        text = text_of(small_font, leftHand[9], "white")
+        screen.blit(text, ((leftOct * 245) + 10, HEIGHT - 55))
+        text = text_of(small_font, leftHand[11], "white")
+        screen.blit(text, ((leftOct * 245) + 45, HEIGHT - 55))
+        text = text_of(small_font, leftHand[1], "black")
+        screen.blit(text, ((leftOct * 245) - 148, HEIGHT - 55))
+        text = text_of(small_font, leftHand[3], "black")
+        screen.blit(text, ((leftOct * 245) - 113, HEIGHT - 55))
+        text = text_of(small_font, leftHand[6], "black")
+        screen.blit(text, ((leftOct * 245) - 43, HEIGHT - 55))
+        text = text_of(small_font, leftHand[8], "black")
+        screen.blit(text, ((leftOct * 245) - 8, HEIGHT - 55))
+        text = text_of(small_font, leftHand[10], "black")
+        screen.blit(text, ((leftOct * 245) + 27, HEIGHT - 55))
+        # right hand
+        pygame.draw.rect(
+            screen, "dark gray", [(rightOct * 245) - 175, HEIGHT - 60, 245, 30], 0, 4
+        )
+        pygame.draw.rect(
+            screen, "black", [(rightOct * 245) - 175, HEIGHT - 60, 245, 30], 4, 4
+        )
+        text = text_of(small_font, rightHand[0], "white")
+        screen.blit(text, ((rightOct * 245) - 165, HEIGHT - 55))
+        text = text_of(small_font, rightHand[2], "white")
+        screen.blit(text, ((rightOct * 245) - 130, HEIGHT - 55))
+        text = text_of(small_font, rightHand[4], "white")
+        screen.blit(text, ((rightOct * 245) - 95, HEIGHT - 55))
+        text = text_of(small_font, rightHand[5], "white")
+        screen.blit(text, ((rightOct * 245) - 60, HEIGHT - 55))
+        text = text_of(small_font, rightHand[7], "white")
+        screen.blit(text, ((rightOct * 245) - 25, HEIGHT - 55))
+        text = text_of(small_font, rightHand[9], "white")
+        screen.blit(text, ((rightOct * 245) + 10, HEIGHT - 55))
+        text = text_of(small_font, rightHand[11], "white")
+        screen.blit(text, ((rightOct * 245) + 45, HEIGHT - 55))
+        text = text_of(small_font, rightHand[1], "black")
+        screen.blit(text, ((rightOct * 245) - 148, HEIGHT - 55))
+        text = text_of(small_font, rightHand[3], "black")
+        screen.blit(text, ((rightOct * 245) - 113, HEIGHT - 55))
+        text = text_of(small_font, rightHand[6], "black")
+        screen.blit(text, ((rightOct * 245) - 43, HEIGHT - 55))
+        text = text_of(small_font, rightHand[8], "black")
+        screen.blit(text, ((rightOct * 245) - 8, HEIGHT - 55))
+        text = text_of(small_font, rightHand[10], "black")
+        screen.blit(text, ((rightOct * 245) + 27, HEIGHT - 55))
+
+    def draw_title_bar(self, surface):
+        """Draws the title bar and returns the rects it covers."""
+        text_of = self.surface_cache.text
+        rects = []
+        instruction_text = text_of(
+            self.medium_font, "Up/Down Arrows Change Left Hand", "black"
+        )
+        rects.append(surface.blit(instruction_text, (WIDTH - 500, 10)))
+        instruction_text2 = text_of(
+            self.medium_font, "Left/Right Arrows Change Right Hand", "black"
+        )
+        rects.append(surface.blit(instruction_text2, (WIDTH - 500, 50)))
 
-    # --- Drawing Functions ---
-    white_keys, black_keys, active_whites, active_blacks = draw_piano(
-        active_whites, active_blacks
-    )
-    draw_hands(right_oct, left_oct, right_hand, left_hand)
-    draw_title_bar()
+        # --- Updated text label ---
+        instruction_text3 = text_of(
+            self.medium_font, "Spacebar to Play/Pause/Seek", "black"
+        )
+        rects.append(surface.blit(instruction_text3, (WIDTH - 500, 90)))
+        # --------------------------
 
-    # --- Event Loop ---
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT:
-            run = False
+        img = self.surface_cache.image("assets/logo.png", (150, 150))
+        rects.append(surface.blit(img, (0, -34)))
+        title_text = text_of(
+            self.font, "A Project of the Resonance Committee.", "white"
+        )
+        rects.append(surface.blit(title_text, (298, 18)))
+        title_text = text_of(
+            self.font, "A Project of the Resonance Committee.", "black"
+        )
+        rects.append(surface.blit(title_text, (300, 20)))
+        return rects
+
+    # --- Main loop ---
+    def main_loop(self):
+        run = True
+        while run:
+            frame_ms = self.timer.tick(FPS)
+            if self.perf is not None:
+                self.record_perf_frame(frame_ms)
+            if self.quit_at is not None and time.perf_counter() >= self.quit_at:
+                run = False
+            self.update_playlist()
+            self.draw_frame()
+
+            # --- Event Loop ---
+            if self.perf is not None:
+                self.perf.begin("event_loop")
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    run = False
+                self.handle_event(event)
+            if self.perf is not None:
+                self.perf.end("event_loop")
+
+    def draw_frame(self):
+        # --- Prune dead channels ---
+        with self.channels_lock:
+            self.g_active_channels[:] = [
+                ch for ch in self.g_active_channels if ch.get_busy()
+            ]
+            for channel in [ch for ch in self.channel_voices if not ch.get_busy()]:
+                del self.channel_voices[channel]
+
+        # --- Key highlights from the playback thread and MIDI input ---
+        for highlights in self.highlight_queues:
+            while highlights:
+                self.highlight(*highlights.popleft())
+
+        # --- Drawing Functions ---
+        player = self.player
+        dirty = self.draw_piano()
+        now_hand_rects = [
+            pygame.Rect((octave * 245) - 175, HEIGHT - 60, 245, 30)
+            for octave in (self.left_oct, self.right_oct)
+        ]
+        if now_hand_rects != self.hand_rects:
+            dirty += self.hand_rects + now_hand_rects
+            self.hand_rects = now_hand_rects
+        now_ms = player.current_ms()
+        now_timeline = (
+            player.duration_ms,
+            self.timeline_x(now_ms),
+            player.loop,
+        )
+        if now_timeline != self.timeline_state:
+            dirty.append(TIMELINE_RECT)
+            self.timeline_state = now_timeline
+        # The waterfall only needs redrawing once it has moved a whole pixel.
+        waterfall = self.waterfall
+        waterfall.set_song(player.timeline, player.releases)
+        now_waterfall = (waterfall.timeline, waterfall.offset(now_ms))
+        if now_waterfall != self.waterfall_state:
+            dirty.append(WATERFALL_RECT)
+            self.waterfall_state = now_waterfall
+            self.waterfall_ms = now_ms
+        if self.buffer_tuner is not None:
+            self.buffer_tuner.update()
+            if self.input_latency is not None:
+                self.input_latency.output_ms = self.output_latency_ms()
+        now_audio_status = self.audio_status_text()
+        if now_audio_status != self.audio_status:
+            dirty.append(AUDIO_STATUS_RECT)
+            self.audio_status = now_audio_status
+        if self.perf_hud_visible and self.perf.frames % PERF_HUD_REFRESH_FRAMES == 0:
+            self.perf_hud_panel = None
+            dirty.append(PERF_HUD_RECT)
+        if self.full_redraw:
+            self.repaint([self.screen.get_rect()])
+            self.present()
+            self.full_redraw = False
+        elif dirty:
+            self.repaint(dirty)
+            self.present(dirty)
+
+    def present(self, rects=None):
+        """Puts the given screen rects (by default the whole screen) on display."""
+        if rects is None:
+            pygame.display.flip()
+        else:
+            pygame.display.update(rects)
+
+    def key_at(self, pos):
+        """The piano key at a screen position, or None."""
+        x, y = pos
+        if not (KEY_TOP <= y < HEIGHT and 0 <= x < len(WHITE_KEYS) * WHITE_KEY_WIDTH):
+            return None
+        if y < KEY_TOP + BLACK_KEY_HEIGHT:
+            # The black key (if any) that starts inside the white key to the left.
+            white, into = divmod(x - BLACK_KEY_OFFSET, WHITE_KEY_WIDTH)
+            if (
+                white >= 0
+                and into < BLACK_KEY_WIDTH
+                and self.black_key_after[white] >= 0
+            ):
+                return self.black_key_after[white]
+        return WHITE_KEYS[x // WHITE_KEY_WIDTH]
+
+    def play_key(self, key):
+        """Plays a piano key at full velocity and lights it up."""
+        self.play_note_with_limiter(self.note_sound(key), 127)
+        self.highlight(key, 127)
+
+    def handle_event(self, event):
+        player = self.player
+        if event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):
+            self.full_redraw = True
+
+        # --- Timeline scrubbing ---
+        if event.type == pygame.MOUSEBUTTONDOWN and player.duration_ms:
+            if TIMELINE_RECT.collidepoint(event.pos):
+                self.scrubbing = True
+        if self.scrubbing and event.type in (
+            pygame.MOUSEBUTTONDOWN,
+            pygame.MOUSEMOTION,
+        ):
+            # Held notes are only restarted once the mouse is released.
+            player.seek(self.timeline_time(event.pos[0]), restart_held=False)
+        if self.scrubbing and event.type == pygame.MOUSEBUTTONUP:
+            self.scrubbing = False
+            player.seek(self.timeline_time(event.pos[0]))
 
         if event.type == pygame.MOUSEBUTTONDOWN:
-            black_key = False
-            for i in range(len(black_keys)):
-                if black_keys[i].collidepoint(event.pos):
-                    play_note_with_limiter(black_sounds[i], 127)
-                    black_key = True
-                    active_blacks.append([i, 30])
-            for i in range(len(white_keys)):
-                if white_keys[i].collidepoint(event.pos) and not black_key:
-                    play_note_with_limiter(white_sounds[i], 127)
-                    active_whites.append([i, 30])
+            key = self.key_at(event.pos)
+            if key is not None:
+                self.play_key(key)
 
         if event.type == pygame.KEYDOWN:
             key = event.unicode.upper()
-            if key not in keys_pressed:
-                keys_pressed.add(key)
-                if key in left_dict:
-                    if left_dict[key][1] == "#":
-                        index = black_labels.index(left_dict[key])
-                        play_note_with_limiter(black_sounds[index], 127)
-                        active_blacks.append([index, 30])
-                    else:
-                        index = white_notes.index(left_dict[key])
-                        play_note_with_limiter(white_sounds[index], 127)
-                        active_whites.append([index, 30])
-                if key in right_dict:
-                    if right_dict[key][1] == "#":
-                        index = black_labels.index(right_dict[key])
-                        play_note_with_limiter(black_sounds[index], 127)
-                        active_blacks.append([index, 30])
-                    else:
-                        index = white_notes.index(right_dict[key])
-                        play_note_with_limiter(white_sounds[index], 127)
-                        active_whites.append([index, 30])
+            if key not in self.keys_pressed:
+                self.keys_pressed.add(key)
+                left_key = LEFT_HAND_KEYS[self.left_oct].get(key)
+                if left_key is not None:
+                    self.play_key(left_key)
+                right_key = RIGHT_HAND_KEYS[self.right_oct].get(key)
+                if right_key is not None:
+                    self.play_key(right_key)
 
         if event.type == pygame.KEYUP:
             key = event.unicode.upper()
-            if key in keys_pressed:
-                keys_pressed.remove(key)
+            if key in self.keys_pressed:
+                self.keys_pressed.remove(key)
 
         if event.type == pygame.KEYDOWN:
-            # --- THIS IS THE FIXED PLAY/PAUSE/SEEK LOGIC ---
-            if event.key == pygame.K_SPACE:
-                # 1. Load MIDI on first press
-                if not midi_loaded:
-                    print(f"Loading {midi_file_path}...")
-                    if load_midi_file(midi_file_path):
-                        print("MIDI file loaded.")
-                        midi_loaded = True
-                    else:
-                        print(f"Could not load {midi_file_path}")
-                        continue  # Skip if load failed
-
-                # 2. Toggle Play/Pause/Restart logic
-                if midi_loaded:
-                    if not playback_active:
-                        # --- We are PAUSED or STOPPED, so let's PLAY ---
-                        playback_active = True
-
-                        # Check if we're at the beginning or end (i.e., NOT paused)
-                        if current_msg_index == 0 or current_msg_index >= len(
-                            playback_messages
-                        ):
-                            # START or RESTART
-                            START_MS = playback_start_time
-
-                            print(
-                                f"Starting/Restarting playback from {START_MS / 1000.0:.2f}s..."
-                            )
-
-                            # A) SEEK: Find the correct note index to start from
-                            current_msg_index = find_first_note_after(START_MS)
-
-                            # B) SET TIME: Adjust start time to match the seek time
-                            playback_start_time = pygame.time.get_ticks() - START_MS
-
-                        else:
-                            # RESUME (we were paused mid-song)
-                            # Get the timestamp of the note we paused at
-                            msg_time_ms_to_resume_at = playback_messages[
-                                current_msg_index
-                            ][0]
-
-                            # Adjust start_time so 'now_ms' matches the note's time
-                            playback_start_time = (
-                                pygame.time.get_ticks() - msg_time_ms_to_resume_at
-                            )
-                            print(
-                                f"Resuming playback from {msg_time_ms_to_resume_at / 1000.0:.2f}s"
-                            )
-
-                    else:
-                        # --- We are PLAYING, so let's PAUSE ---
-                        print("Pausing playback.")
-                        playback_active = False
-                        # current_msg_index automatically becomes our "bookmark"
-            # ----------------------------------------------------
-
-            # Octave controls
-            if event.key == pygame.K_RIGHT:
-                if right_oct < 8:
-                    right_oct += 1
-            if event.key == pygame.K_LEFT:
-                if right_oct > 0:
-                    right_oct -= 1
-            if event.key == pygame.K_UP:
-                if left_oct < 8:
-                    left_oct += 1
-            if event.key == pygame.K_DOWN:
-                if left_oct > 0:
-                    left_oct -= 1
-
-    pygame.display.flip()
-pygame.quit()
+            self.handle_command_key(event)
+
+    def handle_command_key(self, event):
+        player = self.player
+        # --- THIS IS THE FIXED PLAY/PAUSE/SEEK LOGIC ---
+        if event.key == pygame.K_SPACE:
+            # 1. Load MIDI on first press; update_playlist() starts it as
+            # soon as the worker has it ready.
+            if not self.midi_loaded:
+                playlist = self.playlist
+                if not len(playlist):
+                    print(f"Could not load {self.midi_file_path}")
+                    return
+                # Sent to the worker unless it has it already, say after
+                # the song first asked for failed and was dropped.
+                playlist.prepare(playlist.position)
+                if not playlist.ready(playlist.position):
+                    print(f"Loading {playlist.paths[playlist.position]}...")
+                self.pending_song = playlist.position
+                return
+
+            # 2. Toggle Play/Pause/Restart logic
+            if self.midi_loaded:
+                if not player.active:
+                    # --- We are PAUSED or STOPPED, so let's PLAY ---
+                    if player.finished:
+                        # RESTART from the top once a song ended
+                        player.seek(0)
+
+                    # The first load already sought to playback_start_time;
+                    # after that, play from wherever we paused or sought to.
+                    position_ms = player.resume()
+                    print(f"Playing from {position_ms / 1000.0:.2f}s...")
+
+                else:
+                    # --- We are PLAYING, so let's PAUSE ---
+                    print("Pausing playback.")
+                    player.pause()
+                    if self.onset_stats is not None:
+                        self.onset_stats.report()
+        # ----------------------------------------------------
+
+        # Seek (Shift+Left/Right) and loop ([ start, ] end, \ clear)
+        shift_held = event.mod & pygame.KMOD_SHIFT
+        if self.midi_loaded:
+            if shift_held and event.key == pygame.K_RIGHT:
+                player.seek(player.current_ms() + SEEK_STEP_MS)
+            if shift_held and event.key == pygame.K_LEFT:
+                player.seek(player.current_ms() - SEEK_STEP_MS)
+            if event.key == pygame.K_LEFTBRACKET:
+                self.loop_start_ms = player.current_ms()
+                print(f"Loop start at {self.loop_start_ms / 1000.0:.2f}s")
+            if event.key == pygame.K_RIGHTBRACKET:
+                player.set_loop(self.loop_start_ms, player.current_ms())
+                if player.loop is not None:
+                    print(
+                        f"Looping {player.loop[0] / 1000.0:.2f}s-{player.loop[1] / 1000.0:.2f}s"
+                    )
+            if event.key == pygame.K_BACKSLASH:
+                player.set_loop(0, 0)
+                print("Loop cleared.")
+
+        # Playback speed (+ faster, - slower, Backspace back to the tempo)
+        if event.key in (pygame.K_EQUALS, pygame.K_PLUS, pygame.K_KP_PLUS):
+            self.set_speed(player.speed + SPEED_STEP)
+        if event.key in (pygame.K_MINUS, pygame.K_KP_MINUS):
+            self.set_speed(player.speed - SPEED_STEP)
+        if event.key == pygame.K_BACKSPACE:
+            self.set_speed(1.0)
+
+        # Playlist (Page Down next song, Page Up previous)
+        if event.key in (pygame.K_PAGEDOWN, pygame.K_PAGEUP) and self.playlist.repeat:
+            step = 1 if event.key == pygame.K_PAGEDOWN else -1
+            index = self.playlist.next_index(step=step)
+            if index is not None:
+                print(f"Skipping to {self.playlist.paths[index]}")
+                player.pause()
+                self.playlist.prepare(index)
+                self.pending_song = index
+
+        # Octave controls
+        if event.key == pygame.K_RIGHT and not shift_held:
+            if self.right_oct < 8:
+                self.right_oct += 1
+        if event.key == pygame.K_LEFT and not shift_held:
+            if self.right_oct > 0:
+                self.right_oct -= 1
+        if event.key == pygame.K_UP:
+            if self.left_oct < 8:
+                self.left_oct += 1
+        if event.key == pygame.K_DOWN:
+            if self.left_oct > 0:
+                self.left_oct -= 1
+        if event.key == pygame.K_F3 and self.perf is not None:
+            self.perf_hud_visible = not self.perf_hud_visible
+            self.full_redraw = True
+
+
+if __name__ == "__main__":
+    Arpeggio(parse_args()).run()
@@ -0,0 +1,275 @@
+import glob
+import hashlib
+import os
+
+import numpy as np
+
+import piano_lists as pl
+
+# --- Parsed-file cache ---
+# Flattened, tempo-resolved NoteEvents keyed by the MIDI file's content and
+# PARSER_VERSION (bump it whenever parsing changes). Each entry is one flat
+# .npy blob holding the columns back to back, opened memory-mapped. The
+# least recently used entries are evicted past MIDI_CACHE_MAX_BYTES.
+MIDI_CACHE_DIR = ".cache/midi"
+MIDI_CACHE_MAX_BYTES = 64 * 1024 * 1024
+PARSER_VERSION = 2
+
+SUSTAIN_PEDAL = 64  # control change number
+NUM_CHANNELS = 16
+
+NOTE_NAMES = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
+
+# --- Piano keys ---
+# Keys are numbered 0 (A0) to 87 (C8), i.e. the MIDI note number minus 21.
+FIRST_KEY_NOTE = 21
+NUM_KEYS = len(pl.piano_notes)
+
+KEY_IS_BLACK = np.array([name.endswith("#") for name in pl.piano_notes])
+# Index of each key into white_notes or black_notes.
+KEY_INDEX = np.where(
+    KEY_IS_BLACK, np.cumsum(KEY_IS_BLACK) - 1, np.cumsum(~KEY_IS_BLACK) - 1
+)
+# Sample id of each key (see sample_bank: white keys first, then black).
+KEY_SAMPLE = np.where(KEY_IS_BLACK, len(pl.white_notes) + KEY_INDEX, KEY_INDEX)
+
+
+def midi_to_note_name(midi_num):
+    if not (0 <= midi_num <= 127):
+        return None
+    octave = (midi_num // 12) - 1
+    note_index = midi_num % 12
+    note_name = NOTE_NAMES[note_index]
+    return f"{note_name}{octave}"
+
+
+class NoteEvents:
+    """
+    Time-sorted notes stored as parallel NumPy columns: time_ms and end_ms
+    (float64), key (uint8 piano key number) and velocity (uint8), 18 bytes
+    per note. end_ms is when the key is let go, held on by the sustain
+    pedal, or inf if the file never releases it.
+    """
+
+    def __init__(self, time_ms=(), end_ms=(), key=(), velocity=()):
+        self.time_ms = np.asarray(time_ms, dtype=np.float64)
+        self.end_ms = np.asarray(end_ms, dtype=np.float64)
+        self.key = np.asarray(key, dtype=np.uint8)
+        self.velocity = np.asarray(velocity, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.time_ms)
+
+    def __getitem__(self, index):
+        """The notes selected by a slice or index array, as NoteEvents."""
+        return NoteEvents(
+            self.time_ms[index],
+            self.end_ms[index],
+            self.key[index],
+            self.velocity[index],
+        )
+
+    @classmethod
+    def concatenate(cls, parts):
+        return cls(
+            np.concatenate([part.time_ms for part in parts]),
+            np.concatenate([part.end_ms for part in parts]),
+            np.concatenate([part.key for part in parts]),
+            np.concatenate([part.velocity for part in parts]),
+        )
+
+    @property
+    def sample(self):
+        """Sample id of every note."""
+        return KEY_SAMPLE[self.key]
+
+    @property
+    def nbytes(self):
+        return (
+            self.time_ms.nbytes
+            + self.end_ms.nbytes
+            + self.key.nbytes
+            + self.velocity.nbytes
+        )
+
+    def to_bytes(self):
+        """The columns packed back to back as one uint8 array."""
+        return np.concatenate(
+            [
+                self.time_ms.view(np.uint8),
+                self.end_ms.view(np.uint8),
+                self.key,
+                self.velocity,
+            ]
+        )
+
+    @classmethod
+    def from_bytes(cls, blob):
+        """Views the columns of a to_bytes() array without copying."""
+        n = len(blob) // 18
+        return cls(
+            blob[: 8 * n].view(np.float64),
+            blob[8 * n : 16 * n].view(np.float64),
+            blob[16 * n : 17 * n],
+            blob[17 * n :],
+        )
+
+
+class NoteTracker:
+    """
+    Pairs note_ons with their note_off (or note_on with velocity 0) and the
+    sustain pedal. Every note_on becomes a [time, end, note, velocity] list
+    appended to `notes`; end stays inf until the key is let go and, if the
+    pedal is down by then, the pedal is lifted.
+    """
+
+    def __init__(self, notes=None):
+        self.notes = [] if notes is None else notes
+        # (channel, note) -> entries still held down, oldest first.
+        self._held = {}
+        self._pedal_down = [False] * NUM_CHANNELS
+        # Per channel, entries let go while the pedal was down.
+        self._sustained = [[] for _ in range(NUM_CHANNELS)]
+
+    def note_on(self, time, channel, note, velocity):
+        """Returns the new entry, or None for a note_on with velocity 0."""
+        if velocity == 0:
+            self.note_off(time, channel, note)
+            return None
+        entry = [time, np.inf, note, velocity]
+        self._held.setdefault((channel, note), []).append(entry)
+        self.notes.append(entry)
+        return entry
+
+    def note_off(self, time, channel, note):
+        holding = self._held.get((channel, note))
+        if holding:
+            entry = holding.pop(0)
+            if self._pedal_down[channel]:
+                self._sustained[channel].append(entry)
+            else:
+                self.end_note(entry, time)
+
+    def control_change(self, time, channel, control, value):
+        if control != SUSTAIN_PEDAL:
+            return
+        down = value >= 64
+        if self._pedal_down[channel] and not down:
+            for entry in self._sustained[channel]:
+                self.end_note(entry, time)
+            self._sustained[channel].clear()
+        self._pedal_down[channel] = down
+
+    def end_note(self, entry, time):
+        """Called when a note stops being held, by its key or the pedal."""
+        entry[1] = time
+
+    def copy(self, notes, copy_entry):
+        """
+        A tracker in the same state, appending to notes, with every entry it
+        holds replaced by copy_entry(entry).
+        """
+        tracker = NoteTracker(notes)
+        tracker._held = {
+            key: [copy_entry(entry) for entry in held]
+            for key, held in self._held.items()
+            if held
+        }
+        tracker._pedal_down = list(self._pedal_down)
+        tracker._sustained = [
+            [copy_entry(entry) for entry in sustained] for sustained in self._sustained
+        ]
+        return tracker
+
+
+def parse_midi_file(filepath):
+    """
+    Flattens a MIDI file into NoteEvents, one per note_on on a piano key.
+    A note ends at its note_off (or note_on with velocity 0), or at the
+    next sustain pedal release if the pedal is down by then.
+    Raises whatever mido raises if the file cannot be read.
+    """
+    # Imported here: mido takes longer to import than a cached file to load.
+    import mido
+
+    mid = mido.MidiFile(filepath)
+
+    tracker = NoteTracker()
+    current_time_sec = 0.0
+
+    for msg in mid:
+        current_time_sec += msg.time
+        if msg.type == "note_on":
+            tracker.note_on(current_time_sec, msg.channel, msg.note, msg.velocity)
+        elif msg.type == "note_off":
+            tracker.note_off(current_time_sec, msg.channel, msg.note)
+        elif msg.type == "control_change":
+            tracker.control_change(
+                current_time_sec, msg.channel, msg.control, msg.value
+            )
+
+    notes = np.array(tracker.notes, dtype=np.float64).reshape(-1, 4)
+    keys = notes[:, 2].astype(np.int16) - FIRST_KEY_NOTE
+    on_piano = (keys >= 0) & (keys < NUM_KEYS)
+    notes = notes[on_piano]
+    return NoteEvents(
+        notes[:, 0] * 1000, notes[:, 1] * 1000, keys[on_piano], notes[:, 3]
+    )
+
+
+def _cache_key(filepath):
+    with open(filepath, "rb") as f:
+        digest = hashlib.sha1(f.read())
+    digest.update(f"parser-{PARSER_VERSION}".encode())
+    return digest.hexdigest()
+
+
+def evict_midi_cache(cache_dir=MIDI_CACHE_DIR, max_bytes=MIDI_CACHE_MAX_BYTES):
+    """Deletes the least recently used entries until the cache fits max_bytes."""
+    entries = []
+    for path in glob.glob(f"{cache_dir}/*.npy"):
+        # Another process's entry still being written, about to be renamed.
+        if path.endswith(".tmp.npy"):
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+def load_midi_events(filepath, cache_dir=MIDI_CACHE_DIR):
+    """
+    parse_midi_file(filepath), served from the parsed-file cache when this
+    exact file was parsed before.
+    """
+    key = _cache_key(filepath)
+    path = f"{cache_dir}/{key}.npy"
+    try:
+        blob = np.load(path, mmap_mode="r")
+        # Hits count as uses for the LRU eviction.
+        os.utime(path)
+        return NoteEvents.from_bytes(blob)
+    except (OSError, ValueError):
+        pass
+
+    events = parse_midi_file(filepath)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary name first so a reader never sees half an entry.
+        tmp_path = f"{cache_dir}/{key}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, events.to_bytes())
+        os.replace(tmp_path, path)
+        evict_midi_cache(cache_dir)
+    except OSError as e:
+        print(f"Could not write MIDI cache: {e}")
+    return events
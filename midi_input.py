@@ -0,0 +1,99 @@
+"""
+Live MIDI input from a hardware or virtual controller.
+
+mido calls back on its own thread for every incoming message, and notes go
+straight to the sound engine from there instead of waiting for the next
+frame of the event loop. Note-offs and the sustain pedal are paired the
+same way as in MIDI files (midi_events.NoteTracker).
+
+Opening ports needs a mido backend, python-rtmidi, installed with the
+project's midi extra (uv sync --extra midi).
+"""
+
+import time
+from collections import deque
+
+import mido
+
+from midi_events import FIRST_KEY_NOTE, NUM_KEYS, NoteTracker
+from playback import HIGHLIGHT_QUEUE_SIZE
+
+# Virtual port that --midi-probe opens and plays its test notes into.
+LOOPBACK_PORT = "Arpeggio Loopback"
+PROBE_NOTES = 40
+PROBE_INTERVAL_SEC = 0.1
+PROBE_NOTE = 60  # middle C
+
+
+def input_names():
+    """Names of the MIDI input ports, or [] if none can be listed."""
+    try:
+        return mido.get_input_names()
+    except Exception as e:
+        print(f"Could not list MIDI inputs: {e}")
+        return []
+
+
+class LiveInput(NoteTracker):
+    def __init__(self, play_note, release_note):
+        """
+        play_note(key, velocity, stamp) plays a note that arrived at
+        perf_counter() time stamp and returns a voice for release_note(voice)
+        once the key (and the sustain pedal) is let go, or None.
+        """
+        # Entries only matter while their key is held, so none are kept.
+        super().__init__(deque(maxlen=0))
+        self.play_note = play_note
+        self.release_note = release_note
+        self.port = None
+        # (key, velocity) of every note played, drained by the UI.
+        self.highlights = deque(maxlen=HIGHLIGHT_QUEUE_SIZE)
+
+    def open(self, name=None, virtual=False):
+        """
+        Starts listening on input port `name` (the default one if None), or
+        on a new virtual port of that name. Raises whatever the backend raises.
+        """
+        self.port = mido.open_input(name, virtual=virtual, callback=self._on_message)
+
+    def close(self):
+        if self.port is not None:
+            self.port.close()
+            self.port = None
+
+    def _on_message(self, msg):
+        stamp = time.perf_counter()
+        if msg.type == "note_on":
+            entry = self.note_on(stamp, msg.channel, msg.note, msg.velocity)
+            if entry is None:
+                return
+            key = msg.note - FIRST_KEY_NOTE
+            voice = None
+            if 0 <= key < NUM_KEYS:
+                voice = self.play_note(key, msg.velocity, stamp)
+                self.highlights.append((key, msg.velocity))
+            entry.append(voice)
+        elif msg.type == "note_off":
+            self.note_off(stamp, msg.channel, msg.note)
+        elif msg.type == "control_change":
+            self.control_change(stamp, msg.channel, msg.control, msg.value)
+
+    def end_note(self, entry, time):
+        voice = entry[4]
+        if voice is not None:
+            self.release_note(voice)
+
+
+def probe_loopback(
+    notes=PROBE_NOTES, interval_sec=PROBE_INTERVAL_SEC, port_name=LOOPBACK_PORT
+):
+    """
+    Plays test notes into the virtual input port_name, for the receiving
+    LiveInput to time. Blocks until the last note has been let go.
+    """
+    with mido.open_output(port_name) as port:
+        for _ in range(notes):
+            port.send(mido.Message("note_on", note=PROBE_NOTE, velocity=100))
+            time.sleep(interval_sec / 2)
+            port.send(mido.Message("note_off", note=PROBE_NOTE))
+            time.sleep(interval_sec / 2)
@@ -0,0 +1,433 @@
+"""
+Streaming MIDI playback for files too large to load up front.
+
+mido.MidiFile decodes every track into Message objects before anything can
+play, so the stream reads the Standard MIDI File itself: one generator per
+MTrk chunk decodes events straight out of a memory-mapped file, the tracks
+are merged on the fly by tick with heapq.merge, and notes are handed out
+in NoteEvents chunks as soon as nothing later in the file can change their
+release. A producer thread keeps only a few chunks queued ahead of
+playback, so memory stays flat however long the file is.
+
+Every CHECKPOINT_MS of song time the parser leaves a ParseCheckpoint: where
+each track's reader is and its running status, the tempo, and the notes
+still held or ringing. A seek or loop wrap resumes from the nearest one
+before it instead of reading the file again from the start.
+"""
+
+import bisect
+import heapq
+import mmap
+import queue
+import threading
+from collections import deque
+
+import numpy as np
+
+from midi_events import FIRST_KEY_NOTE, KEY_SAMPLE, NUM_KEYS, NoteEvents, NoteTracker
+from voices import MAX_VOICES_PER_KEY, RELEASE_MS
+
+CHUNK_MS = 1000
+# Song time between parse checkpoints.
+CHECKPOINT_MS = 5000
+# Chunks queued ahead of playback, and how many must be ready to start.
+QUEUE_CHUNKS = 8
+START_CHUNKS = 2
+# Files at least this large are streamed instead of loaded.
+STREAM_MIN_BYTES = 4 * 1024 * 1024
+
+DEFAULT_TEMPO = 500000  # microseconds per beat
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+CONTROL_CHANGE = 0xB0
+META = 0xFF
+META_TEMPO = 0x51
+# Data bytes after each channel message status (high nibble) and after
+# each system common status.
+DATA_BYTES = {
+    0x80: 2,
+    0x90: 2,
+    0xA0: 2,
+    0xB0: 2,
+    0xC0: 1,
+    0xD0: 1,
+    0xE0: 2,
+    0xF1: 1,
+    0xF2: 2,
+    0xF3: 1,
+}
+
+
+def _read_varlen(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, pos
+
+
+def read_track(data, pos, end, tick=0, last_status=None):
+    """
+    Yields (tick, status, data1, data2, pos, last_status) for the note,
+    control change and tempo events of one MTrk chunk, from byte pos on.
+    status is the channel message status byte, or META for a tempo change
+    with the tempo in data1; pos and last_status are where the next event
+    starts and the running status there, to resume reading from.
+    """
+    while pos < end:
+        delta, pos = _read_varlen(data, pos)
+        tick += delta
+        status = data[pos]
+        if status < 0x80:
+            # Running status: the byte just read is already data.
+            if last_status is None:
+                raise OSError("running status without last_status")
+            status = last_status
+        else:
+            pos += 1
+            # Meta events don't set running status (the same as mido).
+            if status != META:
+                last_status = status
+
+        if status == META:
+            meta_type = data[pos]
+            length, pos = _read_varlen(data, pos + 1)
+            pos += length
+            if meta_type == META_TEMPO and length == 3:
+                tempo = (data[pos - 3] << 16) | (data[pos - 2] << 8) | data[pos - 1]
+                yield tick, META, tempo, 0, pos, last_status
+        elif status in (0xF0, 0xF7):
+            length, pos = _read_varlen(data, pos)
+            pos += length
+        else:
+            kind = status & 0xF0 if status < 0xF0 else status
+            pos += DATA_BYTES.get(kind, 0)
+            if kind in (NOTE_ON, NOTE_OFF, CONTROL_CHANGE):
+                yield tick, status, data[pos - 2], data[pos - 1], pos, last_status
+
+
+class MessageReader:
+    """
+    Iterates over (time_sec, status, data1, data2) for every track of a
+    Standard MIDI File in playback order, with tempo changes resolved.
+    position() is where it has got to, for a later reader to resume from.
+    """
+
+    def __init__(self, data, position=None):
+        """position is a position() of an earlier reader of the same data."""
+        if data[:4] != b"MThd":
+            raise OSError("no MThd header at start of file")
+        header_size = int.from_bytes(data[4:8], "big")
+        self.division = int.from_bytes(data[12:14], "big")
+        if self.division & 0x8000:
+            raise OSError("SMPTE time division is not supported")
+        self.data = data
+
+        if position is not None:
+            tracks, self._tempo = position
+            self._tracks = list(tracks)
+            return
+        # Per track (pos, end, tick, last_status) after its last event read.
+        self._tracks = []
+        pos = 8 + header_size
+        while pos + 8 <= len(data):
+            size = int.from_bytes(data[pos + 4 : pos + 8], "big")
+            if data[pos : pos + 4] == b"MTrk":
+                end = min(pos + 8 + size, len(data))
+                self._tracks.append((pos + 8, end, 0, None))
+            pos += 8 + size
+        # (tick, seconds) of the last tempo change, and seconds per tick.
+        self._tempo = (0, 0.0, DEFAULT_TEMPO * 1e-6 / self.division)
+
+    def position(self):
+        return list(self._tracks), self._tempo
+
+    def __iter__(self):
+        tracks = self._tracks
+        readers = [
+            self._read(i, pos, end, tick, last_status)
+            for i, (pos, end, tick, last_status) in enumerate(tracks)
+        ]
+        tempo_tick, tempo_sec, scale = self._tempo
+        # Ties keep track order, like mido.merge_tracks.
+        for tick, i, status, data1, data2, pos, last_status in heapq.merge(
+            *readers, key=lambda e: e[0]
+        ):
+            tracks[i] = (pos, tracks[i][1], tick, last_status)
+            time_sec = tempo_sec + (tick - tempo_tick) * scale
+            if status == META:
+                tempo_tick = tick
+                tempo_sec = time_sec
+                scale = data1 * 1e-6 / self.division
+                self._tempo = (tempo_tick, tempo_sec, scale)
+            yield time_sec, status, data1, data2
+
+    def _read(self, i, pos, end, tick, last_status):
+        for event in read_track(self.data, pos, end, tick, last_status):
+            yield (event[0], i, *event[1:])
+
+
+class ParseCheckpoint:
+    """
+    stream_notes() state at song time time_ms, to resume from. Resuming
+    yields the same notes as going on would have, except for the ones that
+    fell silent before time_ms.
+    """
+
+    def __init__(self, time_ms, position, state, ringing):
+        self.time_ms = time_ms
+        # MessageReader.position().
+        self.position = position
+        # (notes, tracker, recent) of stream_notes, copied.
+        self.state = state
+        # The notes already yielded that still sound after time_ms.
+        self.ringing = ringing
+
+
+def stream_notes(
+    data,
+    sample_lengths_ms,
+    max_per_key=MAX_VOICES_PER_KEY,
+    checkpoint=None,
+    on_checkpoint=None,
+):
+    """
+    Yields (time_ms, end_ms, key, velocity, release_ms) for every note on a
+    piano key in time order, each as soon as its release is final: once the
+    file has been read up to it, nothing can steal or release the note any
+    earlier. release_ms follows voices.release_times; end_ms is still inf
+    for a note whose sample ran out before the file let it go.
+    sample_lengths_ms is indexed by key.
+
+    Parsing resumes from checkpoint if given, and on_checkpoint(checkpoint)
+    is called with a new ParseCheckpoint every CHECKPOINT_MS.
+    """
+    if checkpoint is None:
+        messages = MessageReader(data)
+        notes = deque()
+        tracker = NoteTracker(notes)
+        # Per key, the latest max_per_key notes; [time, end, note, velocity,
+        # steal] entries, steal being when a newer note takes over the voice.
+        recent = [deque(maxlen=max_per_key) for _ in range(NUM_KEYS)]
+        ringing = []
+        next_checkpoint_ms = CHECKPOINT_MS
+    else:
+        messages = MessageReader(data, checkpoint.position)
+        # Copied again, so the checkpoint can be resumed from any number of
+        # times.
+        notes, tracker, recent = _copy_state(*checkpoint.state)
+        ringing = list(checkpoint.ringing)
+        next_checkpoint_ms = checkpoint.time_ms + CHECKPOINT_MS
+        for _, note in ringing:
+            yield note
+
+    def release_of(entry):
+        key = entry[2] - FIRST_KEY_NOTE
+        natural_end = entry[0] * 1000 + sample_lengths_ms[key]
+        return min(entry[1] * 1000, entry[4], natural_end)
+
+    def ready(now_ms):
+        while notes and (now_ms is None or release_of(notes[0]) <= now_ms):
+            entry = notes.popleft()
+            key = entry[2] - FIRST_KEY_NOTE
+            note = (entry[0] * 1000, entry[1] * 1000, key, entry[3], release_of(entry))
+            if on_checkpoint is not None:
+                silent_ms = min(note[4] + RELEASE_MS, note[0] + sample_lengths_ms[key])
+                ringing.append((silent_ms, note))
+            yield note
+
+    for time_sec, status, data1, data2 in messages:
+        kind = status & 0xF0
+        channel = status & 0x0F
+        if kind == NOTE_ON:
+            entry = tracker.note_on(time_sec, channel, data1, data2)
+            if entry is not None:
+                key = data1 - FIRST_KEY_NOTE
+                if not 0 <= key < NUM_KEYS:
+                    # Only tracked so its note_off pairs up; never played.
+                    notes.remove(entry)
+                    continue
+                entry.append(np.inf)
+                if max_per_key > 0:
+                    if len(recent[key]) == max_per_key:
+                        stolen = recent[key][0]
+                        stolen[4] = min(stolen[4], time_sec * 1000)
+                    recent[key].append(entry)
+        elif kind == NOTE_OFF:
+            tracker.note_off(time_sec, channel, data1)
+        elif kind == CONTROL_CHANGE:
+            tracker.control_change(time_sec, channel, data1, data2)
+        else:
+            continue
+        now_ms = time_sec * 1000
+        yield from ready(now_ms)
+        if on_checkpoint is not None and now_ms >= next_checkpoint_ms:
+            ringing = [
+                (silent_ms, note) for silent_ms, note in ringing if silent_ms > now_ms
+            ]
+            on_checkpoint(
+                ParseCheckpoint(
+                    now_ms,
+                    messages.position(),
+                    _copy_state(notes, tracker, recent),
+                    list(ringing),
+                )
+            )
+            next_checkpoint_ms = now_ms + CHECKPOINT_MS
+    yield from ready(None)
+
+
+def _copy_state(notes, tracker, recent):
+    """
+    A copy of stream_notes' (notes, tracker, recent) sharing no note entry
+    with it; an entry in several of them stays one entry in the copy.
+    """
+    copies = {}
+
+    def copy_entry(entry):
+        new = copies.get(id(entry))
+        if new is None:
+            new = copies[id(entry)] = entry.copy()
+        return new
+
+    notes = deque(map(copy_entry, notes))
+    tracker = tracker.copy(notes, copy_entry)
+    recent = [deque(map(copy_entry, d), maxlen=d.maxlen) for d in recent]
+    return notes, tracker, recent
+
+
+class MidiStream:
+    """
+    Parses a MIDI file on a producer thread a few chunks ahead of playback.
+    get() hands out (NoteEvents, releases, parsed_ms) chunks in order, then
+    None; no note after the chunk's own starts before parsed_ms.
+    """
+
+    def __init__(self, filepath, sample_lengths_ms, chunk_ms=CHUNK_MS):
+        self.filepath = filepath
+        self.chunk_ms = chunk_ms
+        # sample_lengths_ms is in sample id order; the parser wants it per key.
+        self.key_lengths_ms = np.asarray(sample_lengths_ms)[KEY_SAMPLE].tolist()
+        # Song time of the last note, or 0 until the producer has got there.
+        self.duration_ms = 0.0
+        self._held = (0, [])
+        self._queue = queue.Queue(QUEUE_CHUNKS)
+        self._generation = 0
+        self._done = threading.Event()
+        # ParseCheckpoints left by every pass so far, in time order, and
+        # their times.
+        self._checkpoints = []
+        self._checkpoint_ms = []
+
+    def start(self, position_ms=0.0):
+        """(Re)starts parsing from position_ms, dropping whatever was queued."""
+        self._generation += 1
+        self._queue = queue.Queue(QUEUE_CHUNKS)
+        self._done = threading.Event()
+        threading.Thread(
+            target=self._produce,
+            args=(self._generation, self._queue, self._done, position_ms),
+            name="midi-stream",
+            daemon=True,
+        ).start()
+
+    def stop(self):
+        self._generation += 1
+
+    @property
+    def held(self):
+        """
+        (time_ms, key, velocity, release_ms) of the notes still sounding at
+        the start position; complete once ready().
+        """
+        generation, held = self._held
+        return held if generation == self._generation else []
+
+    def ready(self):
+        """Whether enough is buffered (or the whole rest of the song) to play."""
+        return self._queue.qsize() >= START_CHUNKS or self._done.is_set()
+
+    def get(self):
+        """The next chunk, None at the end, or raises queue.Empty if not parsed yet."""
+        return self._queue.get_nowait()
+
+    def _put(self, generation, chunk_queue, item):
+        while generation == self._generation:
+            try:
+                chunk_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, generation, chunk_queue, done, position_ms):
+        try:
+            with (
+                open(self.filepath, "rb") as f,
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data,
+            ):
+                self._produce_chunks(generation, chunk_queue, data, position_ms)
+        except (OSError, ValueError, IndexError) as e:
+            print(f"Error streaming MIDI file: {e}")
+        self._put(generation, chunk_queue, None)
+        done.set()
+
+    def _add_checkpoint(self, generation, checkpoint):
+        # A pass resumed from a checkpoint only adds the ones past the last.
+        if generation == self._generation and (
+            not self._checkpoint_ms or checkpoint.time_ms > self._checkpoint_ms[-1]
+        ):
+            self._checkpoints.append(checkpoint)
+            self._checkpoint_ms.append(checkpoint.time_ms)
+
+    def _produce_chunks(self, generation, chunk_queue, data, position_ms):
+        held = []
+        started = False
+        last_ms = 0.0
+        chunk = []
+        chunk_end = (position_ms // self.chunk_ms + 1) * self.chunk_ms
+        # The last checkpoint at or before position_ms, if any.
+        i = bisect.bisect_right(self._checkpoint_ms, position_ms)
+        checkpoint = self._checkpoints[i - 1] if i else None
+        notes = stream_notes(
+            data,
+            self.key_lengths_ms,
+            checkpoint=checkpoint,
+            on_checkpoint=lambda c: self._add_checkpoint(generation, c),
+        )
+        for note in notes:
+            if generation != self._generation:
+                return
+            time_ms, _, key, velocity, release_ms = note
+            last_ms = time_ms
+            if time_ms < position_ms:
+                natural_end = time_ms + self.key_lengths_ms[key]
+                if min(release_ms + RELEASE_MS, natural_end) > position_ms:
+                    held.append((time_ms, key, velocity, release_ms))
+                continue
+            if not started:
+                self._held = (generation, held)
+                started = True
+            if time_ms >= chunk_end:
+                if chunk and not self._put(
+                    generation, chunk_queue, _pack(chunk, time_ms)
+                ):
+                    return
+                chunk = []
+                chunk_end = (time_ms // self.chunk_ms + 1) * self.chunk_ms
+            chunk.append(note)
+        if not started:
+            self._held = (generation, held)
+        if generation == self._generation:
+            self.duration_ms = last_ms
+        if chunk:
+            self._put(generation, chunk_queue, _pack(chunk, float("inf")))
+
+
+def _pack(chunk, parsed_ms):
+    columns = np.array(chunk, dtype=np.float64).reshape(-1, 5)
+    events = NoteEvents(columns[:, 0], columns[:, 1], columns[:, 2], columns[:, 3])
+    return events, columns[:, 4], parsed_ms
@@ -0,0 +1,465 @@
+"""
+NumPy mixing engine: an alternative to pygame.mixer Channels.
+
+All samples live in one preallocated bank and every active voice is summed
+into a single SDL output stream block by block, so polyphony is bounded by
+CPU time instead of the fixed set_num_channels() pool. The sum goes through
+a look-ahead limiter on its real level instead of being scaled per note.
+"""
+
+import ctypes
+import ctypes.util
+import glob
+import itertools
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+import pygame
+from pygame._sdl2.audio import AUDIO_F32, AudioDevice, get_audio_device_names
+
+import sample_bank
+import voices
+from audio_profiles import AudioStats
+from limiter import MAX_CHANNELS, BlockLimiter, LimiterStats, rms_levels
+
+BLOCK_SIZE = 512
+# Release position of a voice that is never released.
+NO_RELEASE = np.iinfo(np.int64).max // 2
+# The bank holds int16 samples; the mix is scaled to [-1, 1) once per block.
+INT16_SCALE = np.float32(1 / 32768)
+
+
+def _load_sdl():
+    """
+    The SDL2 library pygame runs on, or None if it cannot be found. Wheels
+    bundle it next to the package; builds against a system SDL link that.
+    """
+    base = os.path.dirname(pygame.__file__)
+    paths = (
+        glob.glob(f"{base}.libs/libSDL2-2*.so*")
+        + glob.glob(f"{base}/.dylibs/libSDL2*.dylib")
+        + glob.glob(f"{base}/SDL2.dll")
+    )
+    system = ctypes.util.find_library("SDL2")
+    if system is not None:
+        paths.append(system)
+    for path in paths:
+        try:
+            return ctypes.CDLL(path)
+        except OSError:
+            pass
+    return None
+
+
+_sdl = _load_sdl()
+
+
+class MixEngine:
+    def __init__(
+        self,
+        samples,
+        block_size=BLOCK_SIZE,
+        capacity=256,
+        max_voices=MAX_CHANNELS,
+        sources=None,
+    ):
+        """
+        samples are int16 (frames, channels) arrays with one or two channels
+        (see sample_bank.load_sample_bank) in sample id order. sources
+        (see sample_bank.sparse_sources) plays sample ids from other roots
+        at a pitch ratio; only the roots need a sample, the rest may be None.
+        """
+        # The largest block mix_into() takes, and the device buffer, which
+        # set_buffer() can change; a larger buffer is mixed in several blocks.
+        self.block_size = block_size
+        self.buffer_frames = block_size
+        self.max_voices = max_voices
+        if sources is None:
+            sources = [(sample_id, 1.0) for sample_id in range(len(samples))]
+        roots = sorted({root for root, _ in sources})
+        self._resampling = any(ratio != 1 for _, ratio in sources)
+        # A resampled block reads up to ratio times block_size frames.
+        pad = block_size
+        if self._resampling:
+            pad = int(np.ceil(block_size * max(ratio for _, ratio in sources))) + 1
+
+        # One flat int16 bank with silence around every root sample, so a
+        # block read that starts before a sample (a voice scheduled mid-block)
+        # or runs past its end needs no masking. Samples keep the cache's
+        # format, stereo ones interleaved L/R and mono ones with one value per
+        # frame, and are only turned into floats a block at a time.
+        padding = np.zeros(2 * pad, dtype=np.int16)
+        padded = [padding]
+        root_offsets = {}
+        start = len(padding)
+        for root in roots:
+            values = samples[root].reshape(-1)
+            if len(values) % 2:
+                # Every root starts on a whole stereo frame (see _frames).
+                values = np.append(values, np.int16(0))
+            root_offsets[root] = start
+            padded.append(values)
+            padded.append(padding)
+            start += len(values) + len(padding)
+        self._bank = np.concatenate(padded)
+        # The bank as one int32 per stereo frame, so a single gather reads
+        # both channels of a stereo root.
+        self._frames = self._bank.view(np.int32)
+        # Per sample id: where its root starts in the bank (in values, and in
+        # frames of _frames), whether it is mono, the root's frames per output
+        # frame, and its length in output frames.
+        self._offsets = np.array(
+            [root_offsets[root] for root, _ in sources], dtype=np.int64
+        )
+        self._frame_offsets = self._offsets // 2
+        self._mono = np.array([samples[root].shape[1] == 1 for root, _ in sources])
+        self._has_mono = bool(self._mono.any())
+        self._rates = np.array([ratio for _, ratio in sources])
+        self._lengths = np.array(
+            [int(len(samples[root]) / ratio) for root, ratio in sources],
+            dtype=np.int64,
+        )
+        self._ramp = np.arange(2 * block_size, dtype=np.int64)
+        self._frame_ramp = np.arange(block_size, dtype=np.int64)
+        self.release_frames = round(voices.RELEASE_MS * sample_bank.SAMPLE_RATE / 1000)
+        self._silence = np.zeros((block_size, 2), dtype=np.float32)
+
+        # RMS level of every block of every root, to judge how audible a
+        # voice still is when one has to be stolen.
+        levels = [rms_levels(samples[root], block_size) for root in roots]
+        counts = np.array([len(level) for level in levels])
+        slot = {root: i for i, root in enumerate(roots)}
+        root_slot = np.array([slot[root] for root, _ in sources])
+        self._levels = np.concatenate(levels)
+        self._level_counts = counts[root_slot]
+        self._level_offsets = (np.cumsum(counts) - counts)[root_slot]
+
+        self.stats = LimiterStats()
+        self.limiter = BlockLimiter(
+            block_size, sample_bank.SAMPLE_RATE, stats=self.stats
+        )
+
+        # Voice table, only touched from the audio callback.
+        self._voice_sample = np.zeros(capacity, dtype=np.int64)
+        self._voice_pos = np.zeros(capacity, dtype=np.int64)
+        self._voice_gain = np.zeros(capacity, dtype=np.float32)
+        # Sample position at which each voice starts its release fade.
+        self._voice_release = np.zeros(capacity, dtype=np.int64)
+        # Handle of each voice started by play(), 0 for scheduled ones.
+        self._voice_id = np.zeros(capacity, dtype=np.int64)
+        self._num_voices = 0
+        self._next_id = itertools.count(1)
+        # Work buffers of _read() for resampled voices, grown on demand.
+        self._scratch_src = np.empty(0)
+
+        # Notes handed over from the UI/MIDI thread, and None for every
+        # release_timed(); deque appends are atomic.
+        self._pending = deque()
+        # Handles of voices to release, see release().
+        self._releases = deque()
+        # (frame, sample_id, volume, release) in frame order, see schedule().
+        self._scheduled = deque()
+        self._scheduled_lock = threading.Lock()
+        self._device = None
+        self.frames_rendered = 0
+        self.audio_stats = AudioStats(block_size)
+        # Set to a scheduler.OnsetStats to record how late scheduled notes start.
+        self.onset_stats = None
+        # Set to a scheduler.LatencyStats to record how long after their input
+        # (play()'s stamp) live notes are mixed.
+        self.latency_stats = None
+
+    @property
+    def active_voices(self):
+        return self._num_voices + len(self._pending) + len(self._scheduled)
+
+    def play(self, sample_id, volume, offset=0, release=None, stamp=None):
+        """
+        Starts a voice at the beginning of the next block, offset frames in.
+        If release is given, the voice fades out from that sample position on.
+        stamp is the perf_counter() time of the input that asked for the note.
+        Returns a handle for release(), or None if the voice would be silent.
+        """
+        if release is None:
+            release = NO_RELEASE
+        if offset >= min(self._lengths[sample_id], release + self.release_frames):
+            return None
+        voice_id = next(self._next_id)
+        self._pending.append((sample_id, volume, offset, release, voice_id, stamp))
+        return voice_id
+
+    def release(self, voice_id):
+        """Fades out a voice from play() from the next block on."""
+        self._releases.append(voice_id)
+
+    def release_timed(self):
+        """
+        Fades out every voice given a release position (by play() or
+        schedule()) from the next block on. Voices started before this call
+        only: the ones play() starts afterwards are left alone, as are the
+        voices that wait for release().
+        """
+        # Queued with the notes, so the callback sees it in call order.
+        self._pending.append(None)
+
+    def schedule(self, sample_id, volume, frame, release=None):
+        """
+        Starts a voice exactly at stream frame `frame` (see frames_rendered),
+        releasing it `release` frames later if given.
+        Calls must come in non-decreasing frame order.
+        """
+        if release is None:
+            release = NO_RELEASE
+        with self._scheduled_lock:
+            self._scheduled.append((frame, sample_id, volume, release))
+
+    def cancel_scheduled(self):
+        """Drops every scheduled voice that has not started yet and returns how many."""
+        with self._scheduled_lock:
+            count = len(self._scheduled)
+            self._scheduled.clear()
+        return count
+
+    def start(self):
+        """Opens the output stream. Raises RuntimeError if no device can be opened."""
+        names = get_audio_device_names(False)
+        if not names:
+            raise RuntimeError("no audio output device available")
+        self._device = AudioDevice(
+            devicename=names[0],
+            iscapture=False,
+            frequency=sample_bank.SAMPLE_RATE,
+            audioformat=AUDIO_F32,
+            numchannels=2,
+            chunksize=self.buffer_frames,
+            allowed_changes=0,
+            callback=self._callback,
+        )
+        self._device.pause(0)
+
+    def close(self):
+        if self._device is None:
+            return
+        # AudioDevice.close() keeps the GIL while SDL waits for the audio
+        # thread, which may be waiting for the GIL to call back: pause the
+        # device through ctypes (which lets go of the GIL) first, so no
+        # callback is running or due by then.
+        if _sdl is not None:
+            _sdl.SDL_PauseAudioDevice(ctypes.c_uint32(self._device.deviceid), 1)
+        self._device.close()
+        self._device = None
+
+    def set_buffer(self, frames):
+        """Reopens the output stream with a buffer of frames."""
+        self.close()
+        self.buffer_frames = frames
+        # The limiter's delay follows the buffer down; its block is at most
+        # a buffer and at most block_size.
+        self.limiter = BlockLimiter(
+            min(frames, self.block_size), sample_bank.SAMPLE_RATE, stats=self.stats
+        )
+        self.audio_stats.restart(frames)
+        self.start()
+
+    def _callback(self, device, stream):
+        started = time.perf_counter()
+        self.audio_stats.callback_started(started)
+        out = np.frombuffer(stream, dtype=np.float32).reshape(-1, 2)
+        for start in range(0, len(out), self.block_size):
+            self.mix_into(out[start : start + self.block_size])
+        self.audio_stats.callback_finished(time.perf_counter() - started)
+
+    def _steal_if_full(self):
+        """
+        Once max_voices voices are held, fades out the least audible one
+        (gain times its sample's level at its position; oldest on ties).
+        Voices that are already fading out do not count.
+        """
+        n = self._num_voices
+        pos = self._voice_pos[:n]
+        held = np.flatnonzero(self._voice_release[:n] > pos)
+        if len(held) < self.max_voices:
+            return
+        sample = self._voice_sample[held]
+        root_pos = (pos[held] * self._rates[sample]).astype(np.int64)
+        block = np.clip(root_pos // self.block_size, 0, self._level_counts[sample] - 1)
+        estimate = (
+            self._voice_gain[held] * self._levels[self._level_offsets[sample] + block]
+        )
+        victim = held[np.lexsort((-pos[held], estimate))[0]]
+        self._voice_release[victim] = pos[victim]
+        self.stats.stolen_voices += 1
+
+    def _add_voice(self, sample_id, volume, pos, release, voice_id=0):
+        self._steal_if_full()
+        n = self._num_voices
+        if n == len(self._voice_sample):
+            self._grow()
+        self._voice_sample[n] = sample_id
+        self._voice_pos[n] = pos
+        self._voice_gain[n] = volume
+        self._voice_release[n] = release
+        self._voice_id[n] = voice_id
+        self._num_voices = n + 1
+
+    def _admit_pending(self, block_start, block_end):
+        while self._pending:
+            note = self._pending.popleft()
+            if note is None:
+                n = self._num_voices
+                timed = self._voice_release[:n] < NO_RELEASE
+                self._voice_release[:n][timed] = np.minimum(
+                    self._voice_release[:n][timed], self._voice_pos[:n][timed]
+                )
+                continue
+            sample_id, volume, offset, release, voice_id, stamp = note
+            self._add_voice(sample_id, volume, offset, release, voice_id)
+            if stamp is not None and self.latency_stats is not None:
+                self.latency_stats.add((time.perf_counter() - stamp) * 1000)
+
+        while self._releases:
+            voice_id = self._releases.popleft()
+            n = self._num_voices
+            for i in np.flatnonzero(self._voice_id[:n] == voice_id):
+                self._voice_release[i] = min(self._voice_release[i], self._voice_pos[i])
+
+        with self._scheduled_lock:
+            while self._scheduled and self._scheduled[0][0] < block_end:
+                frame, sample_id, volume, release = self._scheduled.popleft()
+                # A negative position delays the voice into the block; a note
+                # that arrived too late starts right away.
+                start = max(frame, block_start)
+                self._add_voice(sample_id, volume, block_start - start, release)
+                if self.onset_stats is not None:
+                    self.onset_stats.add(
+                        (start - frame) * 1000 / sample_bank.SAMPLE_RATE
+                    )
+
+    def _grow(self):
+        capacity = 2 * len(self._voice_sample)
+        for name in (
+            "_voice_sample",
+            "_voice_pos",
+            "_voice_gain",
+            "_voice_release",
+            "_voice_id",
+        ):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[: len(old)] = old
+            setattr(self, name, new)
+
+    def _read(self, sample, pos, frames):
+        """
+        The next `frames` frames of every voice, interleaved L/R, as a
+        (voices, 2 * frames) array in int16 units. Resampled voices are read
+        by linear interpolation between the root's frames.
+        """
+        if not self._resampling:
+            start = self._frame_offsets[sample] + pos
+            blocks = self._frames[start[:, None] + self._frame_ramp[:frames]]
+            blocks = blocks.view(np.int16)
+            if self._has_mono:
+                mono = np.flatnonzero(self._mono[sample])
+                start = self._offsets[sample[mono]] + pos[mono]
+                values = self._bank[start[:, None] + self._frame_ramp[:frames]]
+                blocks[mono] = np.repeat(values, 2, axis=1)
+            return blocks
+
+        # A block of a few hundred voices makes megabyte-sized temporaries,
+        # so the arithmetic runs in place in buffers kept between calls.
+        n = len(sample)
+        if len(self._scratch_src) < n * frames:
+            size = len(self._voice_sample) * self.block_size
+            self._scratch_src = np.empty(size)
+            self._scratch_floor = np.empty(size)
+            self._scratch_idx = np.empty(size, dtype=np.int64)
+            self._scratch_frac = np.empty(size, dtype=np.float32)
+            self._scratch_values = np.empty(size, dtype=np.int32)
+            self._scratch_left = np.empty((size, 2), dtype=np.float32)
+            self._scratch_right = np.empty((size, 2), dtype=np.float32)
+        shape = (n, frames)
+        src = self._scratch_src[: n * frames].reshape(shape)
+        floor = self._scratch_floor[: n * frames].reshape(shape)
+        idx = self._scratch_idx[: n * frames].reshape(shape)
+        frac = self._scratch_frac[: n * frames].reshape(shape)
+        values = self._scratch_values[: n * frames].reshape(shape)
+        left = self._scratch_left[: n * frames].reshape(n, frames, 2)
+        right = self._scratch_right[: n * frames].reshape(n, frames, 2)
+
+        # Position in the root of every frame, split into whole and fraction.
+        np.multiply(
+            pos[:, None] + self._frame_ramp[:frames],
+            self._rates[sample][:, None],
+            out=src,
+        )
+        np.floor(src, out=floor)
+        np.subtract(src, floor, out=frac, casting="same_kind")
+        np.add(floor, self._frame_offsets[sample][:, None], out=idx, casting="unsafe")
+        # np.take gathers far faster than _frames[idx]. The padding keeps
+        # every index of a stereo root in the bank, and "clip" (rather than
+        # checking them) lets take() write straight into out.
+        np.take(self._frames, idx, out=values, mode="clip")
+        np.copyto(left, values.view(np.int16).reshape(n, frames, 2))
+        idx += 1
+        np.take(self._frames, idx, out=values, mode="clip")
+        np.copyto(right, values.view(np.int16).reshape(n, frames, 2))
+        if self._has_mono:
+            # Mono roots have one value per frame, read for both channels.
+            mono = np.flatnonzero(self._mono[sample])
+            start = self._offsets[sample[mono]][:, None] + floor[mono].astype(np.int64)
+            left[mono] = self._bank[start][:, :, None]
+            right[mono] = self._bank[start + 1][:, :, None]
+        right -= left
+        # Per channel, as broadcasting frac over the last axis is slow.
+        right[:, :, 0] *= frac
+        right[:, :, 1] *= frac
+        right += left
+        return right.reshape(n, 2 * frames)
+
+    def mix_into(self, out):
+        """Renders the next len(out) frames (at most block_size) into out."""
+        frames = len(out)
+        block_start = self.frames_rendered
+        self._admit_pending(block_start, block_start + frames)
+        n = self._num_voices
+        self.frames_rendered += frames
+        if n == 0:
+            self.limiter.process(self._silence[:frames], out)
+            return
+
+        sample = self._voice_sample[:n]
+        pos = self._voice_pos[:n]
+        gain = self._voice_gain[:n]
+        release = self._voice_release[:n]
+        blocks = self._read(sample, pos, frames)
+        fading = release < pos + frames
+        if not fading.any():
+            mixed = gain @ blocks
+        else:
+            # Voices releasing in this block get a per-frame fade envelope;
+            # the rest still mix as one matrix-vector product.
+            steady = ~fading
+            mixed = gain[steady] @ blocks[steady]
+            t = (pos[fading] - release[fading])[:, None] + self._frame_ramp[:frames]
+            envelope = np.clip(1.0 - t / self.release_frames, 0.0, 1.0)
+            envelope = (gain[fading][:, None] * envelope).astype(np.float32)
+            tails = blocks[fading].reshape(-1, frames, 2)
+            mixed += (envelope[:, :, None] * tails).sum(axis=0).reshape(-1)
+        mixed *= INT16_SCALE
+        self.limiter.process(mixed.reshape(frames, 2), out)
+
+        pos += frames
+        alive = (pos < self._lengths[sample]) & (pos < release + self.release_frames)
+        if not alive.all():
+            keep = np.flatnonzero(alive)
+            m = len(keep)
+            self._voice_sample[:m] = sample[keep]
+            self._voice_pos[:m] = pos[keep]
+            self._voice_gain[:m] = gain[keep]
+            self._voice_release[:m] = release[keep]
+            self._voice_id[:m] = self._voice_id[keep]
+            self._num_voices = m
@@ -0,0 +1,161 @@
+"""
+Performance HUD: per-frame timings and counters for the render loop.
+
+A PerfRecorder only exists when one of --perf, --perf-log or --perf-trace
+is given. Functions are timed by rebinding their names to timed() wrappers
+at startup, so with instrumentation off nothing is wrapped, measured or
+stored.
+
+Every frame becomes one record (frame time, time per section, counters).
+The log is JSON Lines, one record per frame. The trace is a Chrome trace
+event file (chrome://tracing or https://ui.perfetto.dev) of the whole run,
+written on exit.
+"""
+
+import json
+import time
+from collections import deque
+
+# Frames the HUD averages over.
+HUD_HISTORY = 60
+# Section timings and counters shown per HUD line.
+HUD_SECTIONS_PER_LINE = 2
+HUD_COUNTERS_PER_LINE = 3
+
+
+class PerfRecorder:
+    def __init__(self, log_path=None, trace_path=None):
+        # Seconds spent in each section during the current frame.
+        self.sections = {}
+        # Name -> the sections whose sum is reported under it, see total().
+        self.totals = {}
+        self.history = deque(maxlen=HUD_HISTORY)
+        self.frames = 0
+        self.trace_path = trace_path
+        # (name, start, end) spans and (time, counters) samples of the run.
+        self._spans = [] if trace_path is not None else None
+        self._samples = [] if trace_path is not None else None
+        self._log = open(log_path, "w") if log_path is not None else None
+        self._open = {}
+        self._t0 = time.perf_counter()
+
+    def timed(self, name, func):
+        """func, adding the time of every call to this frame's `name` section."""
+
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._add(name, start, time.perf_counter())
+
+        return wrapper
+
+    def total(self, name, sections):
+        """Also reports the sum of sections (names) as `name`, every frame."""
+        self.totals[name] = tuple(sections)
+
+    def begin(self, name):
+        self._open[name] = time.perf_counter()
+
+    def end(self, name):
+        self._add(name, self._open.pop(name), time.perf_counter())
+
+    def _add(self, name, start, end):
+        self.sections[name] = self.sections.get(name, 0.0) + end - start
+        if self._spans is not None:
+            self._spans.append((name, start, end))
+
+    def end_frame(self, frame_ms, busy_ms, counters):
+        """
+        Closes the frame that began at the previous call. frame_ms is the
+        time since then as the clock saw it, busy_ms the part of it not spent
+        waiting for the frame rate; counters is a dict of numbers.
+        """
+        now = time.perf_counter()
+        record = {
+            "t": round(now - self._t0, 6),
+            "frame_ms": frame_ms,
+            "busy_ms": busy_ms,
+        }
+        for name, seconds in self.sections.items():
+            record[f"{name}_ms"] = seconds * 1000
+        for name, sections in self.totals.items():
+            seconds = sum(self.sections.get(section, 0.0) for section in sections)
+            record[f"{name}_ms"] = seconds * 1000
+        record.update(counters)
+        self.history.append(record)
+        self.frames += 1
+        if self._log is not None:
+            self._log.write(json.dumps(record) + "\n")
+        if self._samples is not None:
+            self._samples.append((now, counters))
+        self.sections = {}
+
+    def hud_lines(self):
+        """Averages (and the worst frame) over the last HUD_HISTORY frames."""
+        if not self.history:
+            return []
+        frames = list(self.history)
+        last = frames[-1]
+
+        def mean(key):
+            return sum(record.get(key, 0.0) for record in frames) / len(frames)
+
+        worst = max(record["frame_ms"] for record in frames)
+        lines = [
+            f"frame {mean('frame_ms'):.1f} ms (max {worst:.1f}), "
+            f"busy {mean('busy_ms'):.2f} ms",
+        ]
+        section_names = sorted(
+            {key for record in frames for key in record if key.endswith("_ms")}
+            - {"frame_ms", "busy_ms", "lag_ms"}
+        )
+        sections = [f"{name[:-3]} {mean(name):.2f}" for name in section_names]
+        counters = [
+            f"{key} {value:.2f}" if isinstance(value, float) else f"{key} {value}"
+            for key, value in last.items()
+            if key not in ("t", "frame_ms", "busy_ms") and key not in section_names
+        ]
+        # Packed a few to a line, so the panel stays short enough to fit
+        # above the keyboard.
+        for i in range(0, len(sections), HUD_SECTIONS_PER_LINE):
+            lines.append(", ".join(sections[i : i + HUD_SECTIONS_PER_LINE]) + " ms")
+        for i in range(0, len(counters), HUD_COUNTERS_PER_LINE):
+            lines.append(", ".join(counters[i : i + HUD_COUNTERS_PER_LINE]))
+        return lines
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        if self._spans is None:
+            return
+        events = []
+        for name, start, end in self._spans:
+            events.append(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": (start - self._t0) * 1e6,
+                    "dur": (end - start) * 1e6,
+                    "pid": 0,
+                    "tid": 0,
+                }
+            )
+        for now, counters in self._samples:
+            events.append(
+                {
+                    "name": "counters",
+                    "ph": "C",
+                    "ts": (now - self._t0) * 1e6,
+                    "pid": 0,
+                    "args": counters,
+                }
+            )
+        try:
+            with open(self.trace_path, "w") as f:
+                json.dump({"traceEvents": events}, f)
+            print(f"Wrote performance trace to {self.trace_path}")
+        except OSError as e:
+            print(f"Could not write performance trace: {e}")
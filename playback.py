@@ -0,0 +1,442 @@
+"""
+MIDI playback on a dedicated thread.
+
+The thread owns the note cursor and its own clock, so a slow frame no
+longer delays notes and a burst of notes no longer delays frames. Key
+highlights are handed back to the render loop through a bounded queue.
+
+A streamed song (midi_stream.MidiStream) is played chunk by chunk as the
+parser delivers it: the clock waits until the first chunks are buffered,
+and holds still again if playback ever catches up with the parser.
+
+The clock runs at `speed` times the song's tempo, which can change while
+playing: song times stay as parsed, only the clock's rate is changed,
+from the position it has reached.
+
+A song can be queued to follow the current one (playlist mode): the thread
+switches to it itself once the current song has finished, without waiting
+for the render loop, so one song runs straight into the next.
+"""
+
+import heapq
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import deque
+from queue import Empty
+
+import numpy as np
+
+from midi_events import NoteEvents
+from timeline import Timeline, find_first_note_after
+
+HIGHLIGHT_QUEUE_SIZE = 4096
+MAX_SLEEP_SEC = 0.005
+THREAD_NICE = -10
+
+
+def _raise_priority():
+    # Linux applies setpriority() to a single thread when given its native
+    # id. Lowering the nice value needs privileges, so this is best effort.
+    if not sys.platform.startswith("linux"):
+        return
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), THREAD_NICE)
+    except OSError:
+        pass
+
+
+class PlaybackThread(threading.Thread):
+    def __init__(self, play_note, scheduler=None, onset_stats=None, release_note=None):
+        """
+        play_note(key, velocity, hold_ms, at_frame, offset_ms) plays one note
+        that is released hold_ms after its start. at_frame is only set when a
+        NoteScheduler is given; offset_ms starts a note held across a seek
+        part-way in. hold_ms and offset_ms are real time, i.e. already scaled
+        by the playback speed. It returns a voice for release_note(voice) to fade out
+        once hold_ms has passed, or None if the voice releases itself.
+        """
+        super().__init__(name="midi-playback", daemon=True)
+        self.play_note = play_note
+        self.release_note = release_note
+        self.scheduler = scheduler
+        self.onset_stats = onset_stats
+        self.events = NoteEvents()
+        self.releases = np.zeros(0)
+        self.timeline = Timeline(self.events, [])
+        # The MidiStream being played, or None for a loaded song.
+        self.stream = None
+        # The song to switch to once this one has finished: (events,
+        # releases, timeline) or a MidiStream, or None.
+        self.queued = None
+        self.index = 0
+        self.active = False
+        # Song time to continue from while paused.
+        self.position_ms = 0.0
+        # (start_ms, end_ms) section to repeat, or None.
+        self.loop = None
+        # (key, velocity) of every dispatched note, drained by the UI.
+        # A full queue drops the oldest highlights, never notes.
+        self.highlights = deque(maxlen=HIGHLIGHT_QUEUE_SIZE)
+        # Notes dispatched so far, and the worst lag behind a note's time
+        # (now_ms - time_ms) since the UI last reset it, for the perf HUD.
+        self.notes_dispatched = 0
+        self.max_lag_ms = 0.0
+
+        # Song ms per real ms, and the perf_counter() time at which song
+        # time 0 was (or would have been) at the current speed.
+        self.speed = 1.0
+        self._start_time = 0.0
+        self._restart_held = False
+        # Streaming: waiting for the parser before the clock may run, the
+        # song time up to which every note is in self.events, and whether
+        # the stream has ended.
+        self._buffering = False
+        self._parsed_ms = float("inf")
+        self._stream_done = False
+        # (release_ms, order, voice) of the voices waiting for release_note.
+        self._voices = []
+        self._voice_order = itertools.count()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+
+    @property
+    def finished(self):
+        if self.stream is not None and not self._stream_done:
+            return False
+        return self.index >= len(self.events)
+
+    @property
+    def duration_ms(self):
+        """Song length, or 0 while a stream has not been parsed to the end."""
+        if self.stream is not None:
+            return self.stream.duration_ms
+        return self.timeline.duration_ms
+
+    def load(self, events, releases, note_ends, timeline=None):
+        """
+        releases[i] is the song time at which note i is released and
+        note_ends[i] the one at which it stops sounding. timeline is a
+        Timeline already built over them, if there is one.
+        """
+        if timeline is None:
+            timeline = Timeline(events, note_ends)
+        with self._lock:
+            self._set_active(False)
+            self._release_all()
+            self.queued = None
+            self._load(events, releases, timeline)
+
+    def load_stream(self, stream):
+        """Plays a MidiStream, which is (re)started from every seek."""
+        with self._lock:
+            self._set_active(False)
+            self._release_all()
+            self.queued = None
+            self._load_stream(stream)
+
+    def queue(self, song):
+        """
+        Plays song, (events, releases, timeline) or a MidiStream, as soon as
+        the current one has finished.
+        """
+        with self._lock:
+            self.queued = song
+
+    def seek(self, position_ms, restart_held=True):
+        """
+        Jumps to position_ms. Notes held at that point are restarted right
+        away when playing, or on resume when paused.
+        """
+        with self._lock:
+            if self.scheduler is not None:
+                self.scheduler.engine.cancel_scheduled()
+            self._seek(position_ms, restart_held)
+
+    def resume(self):
+        """Continues from position_ms and returns it."""
+        with self._lock:
+            self._start(self.position_ms)
+            if self._restart_held and not self._buffering:
+                self._notify_seek(self.position_ms)
+        return self.position_ms
+
+    def pause(self):
+        with self._lock:
+            self.position_ms = self.current_ms()
+            self._set_active(False)
+            self._release_all()
+            if self.scheduler is not None:
+                # Notes still waiting in the lookahead window are dispatched
+                # again on resume.
+                self.index -= self.scheduler.engine.cancel_scheduled()
+
+    def set_loop(self, start_ms, end_ms):
+        with self._lock:
+            self.loop = (start_ms, end_ms) if end_ms > start_ms else None
+
+    def set_speed(self, speed):
+        """Plays on at speed times the song's tempo from the current position."""
+        with self._lock:
+            if self.scheduler is not None:
+                self.scheduler.set_speed(speed)
+            else:
+                now_ms = self.now_ms()
+                self._start_time = time.perf_counter() - now_ms / 1000 / speed
+            self.speed = speed
+
+    def stop(self):
+        self._stopping = True
+        self._wake.set()
+
+    def now_ms(self):
+        """Song time up to which notes are due."""
+        if self.scheduler is not None:
+            return self.scheduler.horizon_ms()
+        return (time.perf_counter() - self._start_time) * 1000 * self.speed
+
+    def current_ms(self):
+        """Song time that is audible right now."""
+        if not self.active or self._buffering:
+            return self.position_ms
+        if self.scheduler is not None:
+            return self.scheduler.position_ms()
+        return (time.perf_counter() - self._start_time) * 1000 * self.speed
+
+    def _seek(self, position_ms, restart_held):
+        end_ms = self.duration_ms
+        if self.stream is not None and not end_ms:
+            end_ms = float("inf")
+        position_ms = max(0.0, min(position_ms, end_ms))
+        self._release_all()
+        if self.stream is not None:
+            # Parse again from the new position; the clock waits for it.
+            self.stream.start(position_ms)
+            self.events = NoteEvents()
+            self.releases = np.zeros(0)
+            self.index = 0
+            self._parsed_ms = position_ms
+            self._stream_done = False
+            self._buffering = True
+        else:
+            self.index = find_first_note_after(self.events, position_ms)
+        self.position_ms = position_ms
+        self._restart_held = restart_held
+        if self.active:
+            self._start(position_ms)
+            if restart_held and not self._buffering:
+                self._notify_seek(position_ms)
+
+    def _load(self, events, releases, timeline):
+        self._stop_stream()
+        self.events = events
+        self.releases = releases
+        self.timeline = timeline
+        self.index = 0
+        self.position_ms = 0.0
+        self.loop = None
+
+    def _load_stream(self, stream):
+        self._stop_stream()
+        self.stream = stream
+        self.timeline = Timeline(NoteEvents(), [])
+        self.loop = None
+        self._seek(0.0, restart_held=False)
+
+    def _play_queued(self):
+        """Switches to the queued song, starting it right away."""
+        song, self.queued = self.queued, None
+        if isinstance(song, tuple):
+            self._load(*song)
+            self._start(0.0)
+        else:
+            # Starts the clock too, once the stream has buffered.
+            self._load_stream(song)
+
+    def _stop_stream(self):
+        if self.stream is not None:
+            self.stream.stop()
+        self.stream = None
+        self._buffering = False
+        self._parsed_ms = float("inf")
+        self._stream_done = False
+
+    def _next_chunk(self):
+        """
+        Appends the stream's next chunk to self.events. Returns False if the
+        parser has not got there yet.
+        """
+        try:
+            chunk = self.stream.get()
+        except Empty:
+            return False
+        if chunk is None:
+            self._stream_done = True
+            self._parsed_ms = float("inf")
+            return True
+        events, releases, self._parsed_ms = chunk
+        # Drop the notes that have been played, but keep the ones pause()
+        # may still cancel from the scheduler, so its index math holds.
+        keep = self.index
+        if self.scheduler is not None:
+            keep = min(keep, find_first_note_after(self.events, self.current_ms()))
+        self.events = NoteEvents.concatenate([self.events[keep:], events])
+        self.releases = np.concatenate([self.releases[keep:], releases])
+        self.index -= keep
+        return True
+
+    def _notify_seek(self, position_ms):
+        """Restarts the notes still sounding at position_ms part-way in."""
+        self._restart_held = False
+        if self.stream is not None:
+            for time_ms, key, velocity, release_ms in self.stream.held:
+                self._play(
+                    time_ms, key, velocity, release_ms, offset_ms=position_ms - time_ms
+                )
+            return
+        for i in self.timeline.sounding_at(position_ms):
+            time_ms = float(self.events.time_ms[i])
+            self._play(
+                time_ms,
+                int(self.events.key[i]),
+                int(self.events.velocity[i]),
+                float(self.releases[i]),
+                offset_ms=position_ms - time_ms,
+            )
+
+    def _play(self, time_ms, key, velocity, release_ms, at_frame=None, offset_ms=0.0):
+        voice = self.play_note(
+            key,
+            velocity,
+            (release_ms - time_ms) / self.speed,
+            at_frame,
+            offset_ms / self.speed,
+        )
+        if voice is not None and self.release_note is not None:
+            heapq.heappush(self._voices, (release_ms, next(self._voice_order), voice))
+
+    def _release_voices(self, until_ms=float("inf")):
+        """Releases every waiting voice due by until_ms (by default all of them)."""
+        while self._voices and self._voices[0][0] <= until_ms:
+            _, _, voice = heapq.heappop(self._voices)
+            self.release_note(voice)
+
+    def _release_all(self):
+        """Releases every voice of the song, including the engine's timed ones."""
+        self._release_voices()
+        if self.scheduler is not None:
+            self.scheduler.engine.release_timed()
+
+    def _start(self, position_ms):
+        if self._buffering:
+            # _dispatch_due starts the clock once the stream is ready.
+            self._set_active(True)
+            return
+        self._start_time = time.perf_counter() - position_ms / 1000 / self.speed
+        if self.scheduler is not None:
+            self.scheduler.start(position_ms)
+        self._set_active(True)
+
+    def _set_active(self, active):
+        self.active = active
+        if active:
+            self._wake.set()
+        else:
+            self._wake.clear()
+
+    def run(self):
+        _raise_priority()
+        while not self._stopping:
+            self._wake.wait()
+            with self._lock:
+                delay = self._dispatch_due()
+            if delay > 0:
+                time.sleep(delay)
+
+    def _dispatch_due(self):
+        """Plays every note that is due and returns how long to sleep."""
+        if not self.active:
+            return 0
+        if self._buffering:
+            if not self.stream.ready():
+                return MAX_SLEEP_SEC
+            self._buffering = False
+            self._next_chunk()
+            self._start(self.position_ms)
+            if self._restart_held:
+                self._notify_seek(self.position_ms)
+            return 0
+
+        now_ms = self.now_ms()
+        loop_end_ms = self.loop[1] if self.loop is not None else float("inf")
+        if now_ms >= loop_end_ms:
+            # Notes already scheduled before the loop end still play out.
+            self._seek(self.loop[0], restart_held=True)
+            return 0
+
+        self._release_voices(now_ms)
+
+        if (
+            self.stream is not None
+            and self.index >= len(self.events)
+            and not self._stream_done
+            and not self._next_chunk()
+            and now_ms >= self._parsed_ms
+        ):
+            # Caught up with the parser: hold the clock until it has
+            # buffered enough again.
+            print(f"Stream buffering at {self._parsed_ms / 1000.0:.2f}s")
+            self.position_ms = self._parsed_ms
+            self._buffering = True
+            return MAX_SLEEP_SEC
+
+        # The due notes are one contiguous run of the sorted time column:
+        # up to and including now_ms, but before the loop end.
+        times = self.events.time_ms
+        stop = min(
+            int(np.searchsorted(times, now_ms, side="right")),
+            find_first_note_after(self.events, loop_end_ms),
+        )
+        due = slice(self.index, max(stop, self.index))
+        if due.stop > due.start:
+            self.notes_dispatched += due.stop - due.start
+            lag_ms = (now_ms - float(times[due.start])) / self.speed
+            self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+        for time_ms, key, velocity, release_ms in zip(
+            times[due].tolist(),
+            self.events.key[due].tolist(),
+            self.events.velocity[due].tolist(),
+            self.releases[due].tolist(),
+        ):
+            at_frame = None
+            if self.scheduler is not None:
+                at_frame = self.scheduler.frame_for(time_ms)
+            elif self.onset_stats is not None:
+                self.onset_stats.add((now_ms - time_ms) / self.speed)
+            self._play(time_ms, key, velocity, release_ms, at_frame)
+            self.highlights.append((key, velocity))
+            self.index += 1
+
+        # Keep running past the last note until every voice is released.
+        if self.finished and not self._voices:
+            if self.queued is not None:
+                self._play_queued()
+                return 0
+            print("Playback finished.")
+            self.position_ms = self.duration_ms
+            self._set_active(False)
+            if self.onset_stats is not None:
+                self.onset_stats.report()
+            return 0
+
+        if self.scheduler is not None:
+            return MAX_SLEEP_SEC
+        next_ms = min(loop_end_ms, self._parsed_ms)
+        if self.index < len(times):
+            next_ms = min(next_ms, float(times[self.index]))
+        if self._voices:
+            next_ms = min(next_ms, self._voices[0][0])
+        return min((next_ms - now_ms) / 1000 / self.speed, MAX_SLEEP_SEC)
@@ -0,0 +1,278 @@
+"""
+Playlist mode: MIDI files played back to back, like a jukebox.
+
+Songs are prepared in a worker process: parsed (through the parsed-file
+cache), their releases worked out and their Timeline built. For a large
+file that is seconds of pure Python, which on a thread would still hold
+the GIL against the render loop. The worker sends each song back as one
+flat uint8 array (pack_song), and the UI side only takes views into it, so
+a prepared song is handed to the playback thread at no cost. The next song
+is prepared while the current one plays, and the playback thread switches
+to it the moment the current one has finished. A single song (no
+--playlist) is prepared on a thread instead, which costs no process start.
+
+Files big enough to stream (midi_stream.STREAM_MIN_BYTES) are not prepared
+ahead; their stream starts parsing when their turn comes.
+"""
+
+import glob
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+
+import midi_events
+from midi_events import NoteEvents
+from midi_stream import STREAM_MIN_BYTES, MidiStream
+from timeline import Timeline
+from voices import release_times, sounding_ends
+
+PLAYLIST_DIR = "assets/MIDI"
+# The worker runs at a lower priority, so on a busy (or single) core it
+# gives way to the render loop and the audio and playback threads.
+WORKER_NICE = 10
+
+
+def playlist_paths(paths):
+    """The files in paths, with every directory replaced by its .mid files."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, "*.mid"))))
+        else:
+            files.append(path)
+    return files
+
+
+def _lower_priority():
+    # Best effort, as in playback._raise_priority(); os.nice() is POSIX only.
+    try:
+        os.nice(WORKER_NICE)
+    except (AttributeError, OSError):
+        pass
+
+
+def prepare_song(filepath, sample_lengths_ms):
+    """Parses filepath and builds everything playback needs, packed by pack_song()."""
+    events = midi_events.load_midi_events(filepath)
+    releases = release_times(events, sample_lengths_ms)
+    note_ends = sounding_ends(events, releases, sample_lengths_ms)
+    return pack_song(releases, Timeline(events, note_ends))
+
+
+def pack_song(releases, timeline):
+    """
+    One uint8 array: the note, checkpoint start and checkpoint note counts,
+    then releases, note ends, checkpoint starts and checkpoint notes, then
+    the events as NoteEvents.to_bytes(). Every 8-byte column stays aligned.
+    """
+    counts = np.array(
+        [
+            len(timeline.events),
+            len(timeline.checkpoint_starts),
+            len(timeline.checkpoint_notes),
+        ],
+        dtype=np.int64,
+    )
+    return np.concatenate(
+        [
+            counts.view(np.uint8),
+            np.asarray(releases, dtype=np.float64).view(np.uint8),
+            timeline.note_ends.view(np.uint8),
+            timeline.checkpoint_starts.view(np.uint8),
+            timeline.checkpoint_notes.view(np.uint8),
+            timeline.events.to_bytes(),
+        ]
+    )
+
+
+def unpack_song(blob):
+    """(events, releases, timeline) viewed out of a pack_song() array."""
+    notes, num_starts, num_checkpoint_notes = blob[:24].view(np.int64).tolist()
+    columns = []
+    pos = 24
+    for count, dtype in (
+        (notes, np.float64),
+        (notes, np.float64),
+        (num_starts, np.int64),
+        (num_checkpoint_notes, np.int64),
+    ):
+        columns.append(blob[pos : pos + 8 * count].view(dtype))
+        pos += 8 * count
+    releases, note_ends, starts, checkpoint_notes = columns
+    events = NoteEvents.from_bytes(blob[pos:])
+    timeline = Timeline(events, note_ends, checkpoints=(starts, checkpoint_notes))
+    return events, releases, timeline
+
+
+class Playlist:
+    """
+    The songs to play, in order, and the worker preparing them. Only the
+    UI thread uses it.
+    """
+
+    def __init__(
+        self, paths, sample_lengths_ms, repeat=True, stream=False, worker=True
+    ):
+        """
+        repeat starts over from the first song after the last one; stream
+        streams every song instead of only the large ones. Without worker,
+        songs are prepared on a thread instead of in a worker process.
+        """
+        self.paths = list(paths)
+        self.sample_lengths_ms = sample_lengths_ms
+        self.repeat = repeat
+        self.stream = stream
+        # Index of the song loaded (or to be loaded) into the player, and
+        # of the one queued to follow it, or None.
+        self.position = 0
+        self.queued = None
+        # Path -> Future of its prepare_song(), for the songs around the
+        # current one.
+        self._results = {}
+
+        # Starting the worker takes tens of milliseconds, so it is done on a
+        # thread; songs asked for before then are sent once it is up.
+        self._pool = None
+        self._pool_error = None
+        self._unsent = []
+        self._closed = False
+        self._lock = threading.Lock()
+        self.worker = worker
+        if worker:
+            threading.Thread(
+                target=self._start_pool, name="playlist", daemon=True
+            ).start()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def next_index(self, index=None, step=1):
+        """The song step places after index (default: the current one), or None."""
+        if not self.paths:
+            return None
+        index = (self.position if index is None else index) + step
+        if self.repeat:
+            return index % len(self.paths)
+        return index if 0 <= index < len(self.paths) else None
+
+    def streamed(self, index):
+        try:
+            return self.stream or os.path.getsize(self.paths[index]) >= STREAM_MIN_BYTES
+        except OSError:
+            # Left to fail, with its error, when it is loaded.
+            return False
+
+    def prepare(self, index):
+        """
+        Starts preparing song index in the worker, unless it streams or is
+        prepared already. Songs other than this one, the current one and the
+        queued one are let go.
+        """
+        if index is None:
+            return
+        keep = {
+            self.paths[i] for i in (index, self.position, self.queued) if i is not None
+        }
+        for path in list(self._results):
+            if path not in keep:
+                del self._results[path]
+        path = self.paths[index]
+        if path in self._results or self.streamed(index):
+            return
+        future = self._results[path] = Future()
+        if not self.worker:
+            threading.Thread(
+                target=self._prepare_here,
+                args=(path, future),
+                name="playlist",
+                daemon=True,
+            ).start()
+            return
+        with self._lock:
+            if self._pool is not None:
+                self._send(path, future)
+            elif self._pool_error is not None:
+                future.set_exception(self._pool_error)
+            else:
+                self._unsent.append((path, future))
+
+    def ready(self, index):
+        """Whether take(index) would return without waiting."""
+        if index is None:
+            return False
+        if self.streamed(index):
+            return True
+        future = self._results.get(self.paths[index])
+        return future is not None and future.done()
+
+    def take(self, index):
+        """
+        Song index, as (events, releases, timeline) or a MidiStream, waiting
+        for the worker if needed. Raises whatever parsing raised, and again
+        every time the song is taken until it is dropped.
+        """
+        path = self.paths[index]
+        if self.streamed(index):
+            return MidiStream(path, self.sample_lengths_ms)
+        self.prepare(index)
+        # A failed result is kept: ready() stays true for it, so asking
+        # again reports the error rather than waiting on a song nobody is
+        # preparing.
+        return unpack_song(self._results[path].result())
+
+    def drop(self, index):
+        """Takes song index (one that failed to load) out of the playlist."""
+        self._results.pop(self.paths.pop(index), None)
+        if self.queued == index:
+            self.queued = None
+        elif self.queued is not None and self.queued > index:
+            self.queued -= 1
+        if self.position > index:
+            self.position -= 1
+        if self.paths:
+            self.position %= len(self.paths)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            if self._pool is not None:
+                self._pool.terminate()
+
+    def _send(self, path, future):
+        self._pool.apply_async(
+            prepare_song,
+            (path, self.sample_lengths_ms),
+            callback=future.set_result,
+            error_callback=future.set_exception,
+        )
+
+    def _prepare_here(self, path, future):
+        try:
+            future.set_result(prepare_song(path, self.sample_lengths_ms))
+        except Exception as e:
+            future.set_exception(e)
+
+    def _start_pool(self):
+        # spawn, as forking a process that runs audio and playback threads
+        # is unsafe.
+        pool = error = None
+        try:
+            pool = multiprocessing.get_context("spawn").Pool(1, _lower_priority)
+        except OSError as e:
+            print(f"Could not start the playlist worker: {e}")
+            error = e
+        with self._lock:
+            if pool is None:
+                self._pool_error = error
+                for _, future in self._unsent:
+                    future.set_exception(error)
+            elif self._closed:
+                pool.terminate()
+            else:
+                self._pool = pool
+                for path, future in self._unsent:
+                    self._send(path, future)
+            self._unsent = []
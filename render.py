@@ -0,0 +1,171 @@
+"""
+Headless offline renderer: mixes MIDI files into WAVs without a display,
+a sound card or the real-time main loop.
+
+    python render.py song.mid -o song.wav
+    python render.py --all --out-dir renders
+"""
+
+import argparse
+import glob
+import heapq
+import os
+import time
+import wave
+
+import numpy as np
+
+import limiter
+import midi_events
+import sample_bank
+import voices
+
+SAMPLE_RATE = sample_bank.SAMPLE_RATE
+MIDI_DIR = "assets/MIDI"
+
+
+def render_events(events, white_samples, black_samples):
+    """
+    Mixes NoteEvents into a float32 (frames, 2) buffer the way the NumPy
+    engine plays them: velocity gain, the same releases as live playback,
+    the quietest voice stolen past MAX_CHANNELS, and the look-ahead limiter
+    on the sum. Returns (buffer, limiter.LimiterStats).
+    """
+    stats = limiter.LimiterStats()
+    if not len(events):
+        return np.zeros((0, 2), dtype=np.float32), stats
+
+    samples = white_samples + black_samples
+    levels = [limiter.rms_levels(sample) for sample in samples]
+    longest = max(len(sample) for sample in samples)
+    total_frames = int(events.time_ms[-1] * SAMPLE_RATE / 1000) + longest + 1
+    out = np.zeros((total_frames, 2), dtype=np.float32)
+
+    # Voices not yet released: id -> (start frame, sample id, data, volume),
+    # with (release frame, id) in a heap to expire them. Like in the engine,
+    # voices that are fading out do not count towards MAX_CHANNELS.
+    held = {}
+    voice_releases = []
+    starts = np.round(events.time_ms * SAMPLE_RATE / 1000).astype(np.int64)
+    lengths_ms = np.array([len(sample) * 1000 / SAMPLE_RATE for sample in samples])
+    releases = voices.release_times(events, lengths_ms)
+    holds = np.round((releases - events.time_ms) * SAMPLE_RATE / 1000).astype(np.int64)
+    fade_frames = round(voices.RELEASE_MS * SAMPLE_RATE / 1000)
+    for voice_id, (start, sample_id, velocity, hold) in enumerate(
+        zip(
+            starts.tolist(),
+            events.sample.tolist(),
+            events.velocity.tolist(),
+            holds.tolist(),
+        )
+    ):
+        sample = samples[sample_id]
+        if hold < len(sample):
+            sample = sample[: hold + fade_frames]
+            envelope = voices.release_envelope(len(sample), hold, fade_frames)
+            sample = sample * envelope[:, None]
+
+        while voice_releases and voice_releases[0][0] <= start:
+            held.pop(heapq.heappop(voice_releases)[1], None)
+        if len(held) >= limiter.MAX_CHANNELS:
+            _steal_voice(out, held, levels, start, fade_frames)
+            stats.stolen_voices += 1
+
+        volume = limiter.velocity_volume(velocity)
+        out[start : start + len(sample)] += sample * np.float32(volume)
+        held[voice_id] = (start, sample_id, sample, volume)
+        release = start + min(hold, len(sample))
+        heapq.heappush(voice_releases, (release, voice_id))
+
+    return _limit(out, stats), stats
+
+
+def _steal_voice(out, held, levels, now, fade_frames):
+    """Fades the least audible held voice out from frame `now` on."""
+    ids = list(held)
+    positions = [now - held[voice_id][0] for voice_id in ids]
+    victim = ids[
+        limiter.quietest_voice(
+            [levels[held[voice_id][1]] for voice_id in ids],
+            positions,
+            [held[voice_id][3] for voice_id in ids],
+        )
+    ]
+    start, _, sample, volume = held.pop(victim)
+    # Take back what was mixed in past `now`, except for the fade.
+    tail = sample[now - start :] * np.float32(volume)
+    fade = voices.release_envelope(len(tail), 0, fade_frames)
+    out[now : now + len(tail)] -= tail * (1.0 - fade)[:, None]
+
+
+def _limit(buffer, stats):
+    """Runs a whole buffer through a BlockLimiter, compensating its delay."""
+    block = limiter.LEVEL_BLOCK
+    padded = np.concatenate([buffer, np.zeros((block, 2), dtype=np.float32)])
+    limited = np.empty_like(padded)
+    block_limiter = limiter.BlockLimiter(block, SAMPLE_RATE, stats=stats)
+    for i in range(0, len(padded), block):
+        block_limiter.process(padded[i : i + block], limited[i : i + block])
+    return limited[block:]
+
+
+def write_wav(path, buffer):
+    pcm = np.clip(buffer * 32768.0, -32768, 32767).astype("<i2")
+    with wave.open(path, "wb") as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(pcm.tobytes())
+
+
+def render_file(midi_path, wav_path, white_samples, black_samples):
+    start = time.perf_counter()
+    events = midi_events.load_midi_events(midi_path)
+    buffer, stats = render_events(events, white_samples, black_samples)
+    write_wav(wav_path, buffer)
+    elapsed = time.perf_counter() - start
+
+    audio_sec = len(buffer) / SAMPLE_RATE
+    speed = audio_sec / elapsed if elapsed > 0 else float("inf")
+    print(
+        f"Rendered {midi_path} -> {wav_path}: {len(events)} notes, "
+        f"{audio_sec:.1f}s of audio in {elapsed:.2f}s ({speed:.0f}x real time)"
+    )
+    print(f"Limiter: {stats.report()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render MIDI files to WAV offline.")
+    parser.add_argument("files", nargs="*", help="MIDI files to render")
+    parser.add_argument("-o", "--output", help="output WAV (single input only)")
+    parser.add_argument(
+        "--all", action="store_true", help=f"render every file in {MIDI_DIR}"
+    )
+    parser.add_argument("--out-dir", default="renders", help="output directory")
+    args = parser.parse_args()
+
+    files = list(args.files)
+    if args.all:
+        files += sorted(glob.glob(f"{MIDI_DIR}/*.mid"))
+    if not files:
+        parser.error("no MIDI files given")
+    if args.output and len(files) > 1:
+        parser.error("--output only works with a single input file")
+
+    white_samples, black_samples = sample_bank.load_sample_bank()
+
+    for midi_path in files:
+        if args.output:
+            wav_path = args.output
+        else:
+            os.makedirs(args.out_dir, exist_ok=True)
+            name = os.path.splitext(os.path.basename(midi_path))[0]
+            wav_path = os.path.join(args.out_dir, f"{name}.wav")
+        try:
+            render_file(midi_path, wav_path, white_samples, black_samples)
+        except Exception as e:
+            print(f"Error rendering {midi_path}: {e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,403 @@
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import threading
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import piano_lists as pl
+
+SAMPLE_RATE = 44100
+NOTES_DIR = "assets/notes"
+
+# Sample ids: the 52 white keys first, then the 36 black keys.
+SAMPLE_NAMES = pl.white_notes + pl.black_notes
+
+# --- Preprocessed cache ---
+# The decoded bank in the mixer's native format (frequency, size, channels
+# as given to pygame.mixer.pre_init), compacted and packed into one flat
+# .npy that is opened memory-mapped, so later launches and other processes
+# skip WAV decoding and share the pages.
+CACHE_DIR = ".cache/samples"
+CACHE_FORMAT = (SAMPLE_RATE, -16, 2)
+CACHE_VERSION = 3
+
+# --- Compaction ---
+# Leading silence up to the first frame above SILENCE_LEVEL is cut (keeping
+# ONSET_PAD_FRAMES before it), and so is the tail from where every later
+# TAIL_BLOCK-frame block stays TAIL_DB below the loudest one, fading out over
+# TAIL_FADE_MS so the cut doesn't click. The bundled samples already stop 16
+# to 50 dB down, so a cut at TAIL_DB ends a note no more abruptly than they
+# do. (Against the peak frame instead, the hammer's click would set the
+# level and cut the treble notes to a fraction of a second.) Stereo samples
+# whose side signal is MONO_DB below the mid signal are stored with one
+# channel.
+SILENCE_LEVEL = 32  # about -60 dBFS
+ONSET_PAD_FRAMES = 64
+TAIL_BLOCK = 1024
+TAIL_DB = -35.0
+TAIL_FADE_MS = 100
+MONO_DB = -60.0
+
+# --- Sparse banks ---
+# A sparse bank only loads every Nth key's sample (the roots) and plays the
+# keys in between by resampling the nearest root. N is set per register,
+# given as a MIDI note range; 1 keeps every key.
+REGISTERS = {"bass": (21, 48), "middle": (48, 72), "treble": (72, 109)}
+
+NOTE_OFFSETS = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11}
+
+
+def sample_midi_number(sample_id):
+    """MIDI note number of a sample, parsed from names like "C4" or "Bb0"."""
+    name = SAMPLE_NAMES[sample_id]
+    offset = NOTE_OFFSETS[name[0]]
+    if name[1] == "b":
+        offset -= 1
+    octave = int(name[-1])
+    return (octave + 1) * 12 + offset
+
+
+def read_wav(path):
+    """Reads a 16-bit WAV into an int16 (frames, 2) array."""
+    with wave.open(path, "rb") as wav:
+        if wav.getsampwidth() != 2 or wav.getframerate() != SAMPLE_RATE:
+            raise ValueError(f"{path}: expected 16-bit {SAMPLE_RATE} Hz audio")
+        channels = wav.getnchannels()
+        data = np.frombuffer(wav.readframes(wav.getnframes()), dtype="<i2")
+    data = data.reshape(-1, channels).astype(np.int16)
+    if channels == 1:
+        data = np.repeat(data, 2, axis=1)
+    return data
+
+
+def load_wav(path):
+    """Reads a 16-bit stereo WAV into a float32 (frames, 2) array in [-1, 1)."""
+    return read_wav(path).astype(np.float32) / 32768.0
+
+
+def sample_lengths_ms(notes_dir=NOTES_DIR, cache_dir=CACHE_DIR, sources=None):
+    """
+    Duration of every sample in sample id order, as compacted in the cache
+    if it is there, else read from the WAV headers. With sparse_sources(),
+    keys played from another root last as long as it does resampled.
+    """
+    index = _read_index(notes_dir, cache_dir)
+    if index is not None:
+        lengths = [frames * 1000 / SAMPLE_RATE for _, frames, _ in index["samples"]]
+    else:
+        lengths = []
+        for name in SAMPLE_NAMES:
+            with wave.open(f"{notes_dir}/{name}.wav", "rb") as wav:
+                lengths.append(wav.getnframes() * 1000 / wav.getframerate())
+    if sources is not None:
+        lengths = [lengths[root] / ratio for root, ratio in sources]
+    return lengths
+
+
+def parse_sparse(spec):
+    """
+    Per-register steps from a step for every register (3 or "3") or from
+    "bass=4,middle=1,treble=3" (or the same as a dict); registers left out
+    keep every key. Raises ValueError for anything else.
+    """
+    if isinstance(spec, str) and "=" not in spec:
+        spec = int(spec)
+    if isinstance(spec, int):
+        spec = dict.fromkeys(REGISTERS, spec)
+    elif isinstance(spec, str):
+        spec = dict(part.split("=", 1) for part in spec.split(","))
+    steps = dict.fromkeys(REGISTERS, 1)
+    for register, step in spec.items():
+        if register.strip() not in REGISTERS or int(step) < 1:
+            raise ValueError(f"bad sparse sampling setting: {register}={step}")
+        steps[register.strip()] = int(step)
+    return steps
+
+
+def sparse_sources(steps):
+    """
+    For every sample id, (root sample id, pitch ratio) to play it from: the
+    key itself at 1.0 for roots, else the nearest root (the lower one on
+    ties) sped up or slowed down by the semitones in between.
+    """
+    by_note = {sample_midi_number(i): i for i in range(len(SAMPLE_NAMES))}
+    roots = sorted(
+        note
+        for register, (low, high) in REGISTERS.items()
+        for note in range(low, high, steps[register])
+        if note in by_note
+    )
+    sources = []
+    for sample_id in range(len(SAMPLE_NAMES)):
+        note = sample_midi_number(sample_id)
+        root = min(roots, key=lambda r: (abs(note - r), r))
+        sources.append((by_note[root], 2 ** ((note - root) / 12)))
+    return sources
+
+
+def _source_key(notes_dir):
+    stats = []
+    for name in SAMPLE_NAMES:
+        st = os.stat(f"{notes_dir}/{name}.wav")
+        stats.append([name, st.st_size, st.st_mtime_ns])
+    blob = json.dumps([CACHE_VERSION, CACHE_FORMAT, stats]).encode()
+    return hashlib.sha1(blob).hexdigest()
+
+
+def compact_sample(sample):
+    """
+    Trims an int16 (frames, 2) sample as described above. Returns an int16
+    (frames, channels) array with one or two channels.
+    """
+    loud = np.flatnonzero(np.abs(sample).max(axis=1) > SILENCE_LEVEL)
+    if not len(loud):
+        return np.zeros((1, 1), dtype=np.int16)
+    sample = sample[max(int(loud[0]) - ONSET_PAD_FRAMES, 0) :]
+
+    x = sample.astype(np.float32)
+    blocks = len(x) // TAIL_BLOCK
+    if blocks:
+        energy = np.square(x[: blocks * TAIL_BLOCK]).reshape(blocks, -1).mean(axis=1)
+        above = np.flatnonzero(energy >= energy.max() * 10 ** (TAIL_DB / 10))
+        # A sample still ringing in its last whole block is kept to the end.
+        if above[-1] < blocks - 1:
+            end = (int(above[-1]) + 1) * TAIL_BLOCK
+            x = x[:end]
+            fade = min(round(TAIL_FADE_MS * SAMPLE_RATE / 1000), end)
+            x[-fade:] *= np.linspace(1.0, 0.0, fade, dtype=np.float32)[:, None]
+
+    mid = (x[:, 0] + x[:, 1]) / 2
+    side = (x[:, 0] - x[:, 1]) / 2
+    if np.dot(side, side) <= np.dot(mid, mid) * 10 ** (MONO_DB / 10):
+        x = mid[:, None]
+    return np.round(x).astype(np.int16)
+
+
+def as_stereo(sample):
+    """An int16 (frames, 2) view or copy of a cached sample."""
+    if sample.shape[1] == 1:
+        return np.repeat(sample, 2, axis=1)
+    return sample
+
+
+def compaction_report(raw_samples, samples):
+    """Per-note and total lines comparing raw stereo samples to compacted ones."""
+    lines = []
+    total_before = total_after = 0
+    for name, raw, sample in zip(SAMPLE_NAMES, raw_samples, samples, strict=True):
+        before, after = raw.nbytes, sample.nbytes
+        total_before += before
+        total_after += after
+        lines.append(
+            f"{name:>3}: {len(raw) / SAMPLE_RATE:5.2f} s -> "
+            f"{len(sample) / SAMPLE_RATE:5.2f} s, "
+            f"{'mono  ' if sample.shape[1] == 1 else 'stereo'} "
+            f"{before / 1024:7.0f} KB -> {after / 1024:7.0f} KB "
+            f"({1 - after / before:.1%} saved)"
+        )
+    lines.append(
+        f"Sample bank: {total_before / 2**20:.1f} MB -> {total_after / 2**20:.1f} "
+        f"MB ({1 - total_after / total_before:.1%} saved)"
+    )
+    return lines
+
+
+def _read_index(notes_dir, cache_dir):
+    """The cache's index, or None if there is no cache or the WAVs changed."""
+    try:
+        with open(f"{cache_dir}/index.json") as f:
+            index = json.load(f)
+        if index["key"] != _source_key(notes_dir):
+            return None
+    except (OSError, ValueError, KeyError):
+        return None
+    return index
+
+
+def open_cache(notes_dir=NOTES_DIR, cache_dir=CACHE_DIR):
+    """
+    Returns the cached samples as memory-mapped int16 (frames, channels)
+    arrays in sample id order, or None if there is no cache or the WAVs
+    changed. as_stereo() turns mono ones back into two channels.
+    """
+    index = _read_index(notes_dir, cache_dir)
+    if index is None:
+        return None
+    try:
+        bank = np.load(f"{cache_dir}/bank.npy", mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    return [
+        bank[offset : offset + frames * channels].reshape(frames, channels)
+        for offset, frames, channels in index["samples"]
+    ]
+
+
+def write_cache(samples, notes_dir=NOTES_DIR, cache_dir=CACHE_DIR):
+    """
+    Packs compacted int16 (frames, channels) samples in sample id order into
+    the cache, as one flat array indexed by [offset, frames, channels].
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    index = {"key": _source_key(notes_dir), "samples": []}
+    offset = 0
+    for sample in samples:
+        frames, channels = sample.shape
+        index["samples"].append([offset, frames, channels])
+        offset += frames * channels
+
+    # Write to temporary names first so a reader never sees half a cache.
+    bank = np.concatenate([sample.reshape(-1) for sample in samples])
+    np.save(f"{cache_dir}/bank.tmp.npy", bank)
+    with open(f"{cache_dir}/index.tmp.json", "w") as f:
+        json.dump(index, f)
+    os.replace(f"{cache_dir}/bank.tmp.npy", f"{cache_dir}/bank.npy")
+    os.replace(f"{cache_dir}/index.tmp.json", f"{cache_dir}/index.json")
+
+
+def build_cache(raw_samples, notes_dir=NOTES_DIR, cache_dir=CACHE_DIR):
+    """
+    Compacts raw int16 (frames, 2) samples and writes them to the cache.
+    Returns the compacted samples, even if the cache could not be written.
+    """
+    samples = [compact_sample(sample) for sample in raw_samples]
+    try:
+        write_cache(samples, notes_dir, cache_dir)
+    except OSError as e:
+        print(f"Could not write sample cache: {e}")
+        return samples
+    print(compaction_report(raw_samples, samples)[-1])
+    return samples
+
+
+def read_wavs(notes_dir=NOTES_DIR, sample_ids=None):
+    if sample_ids is None:
+        sample_ids = range(len(SAMPLE_NAMES))
+    paths = [f"{notes_dir}/{SAMPLE_NAMES[i]}.wav" for i in sample_ids]
+    with ThreadPoolExecutor() as pool:
+        return list(pool.map(read_wav, paths))
+
+
+def load_raw_samples(notes_dir=NOTES_DIR, sample_ids=None):
+    """
+    Samples as compacted int16 (frames, channels) arrays in sample id order,
+    from the cache if possible, else from the WAVs (building the cache).
+    If sample_ids is given, the other entries are None and, without a
+    cache, only those WAVs are read.
+    """
+    samples = open_cache(notes_dir)
+    if samples is None and sample_ids is None:
+        samples = build_cache(read_wavs(notes_dir), notes_dir)
+    elif samples is None:
+        samples = [None] * len(SAMPLE_NAMES)
+        for sample_id, raw in zip(
+            sample_ids, read_wavs(notes_dir, sample_ids), strict=True
+        ):
+            samples[sample_id] = compact_sample(raw)
+    if sample_ids is not None:
+        wanted = set(sample_ids)
+        samples = [s if i in wanted else None for i, s in enumerate(samples)]
+    return samples
+
+
+def load_sample_bank(notes_dir=NOTES_DIR, sample_ids=None):
+    """
+    Returns (white_samples, black_samples), indexed like white_notes/black_notes,
+    as the compacted int16 (frames, channels) arrays of load_raw_samples().
+    If sample_ids is given, only those are loaded and the rest are None.
+    """
+    samples = load_raw_samples(notes_dir, sample_ids)
+    return samples[: len(pl.white_notes)], samples[len(pl.white_notes) :]
+
+
+class LazySampleLoader:
+    """
+    Loads samples on a small thread pool while the window is already running,
+    most urgent first. get() loads a sample that is not there yet on the spot.
+    """
+
+    def __init__(self, load_one, workers=4, on_complete=None):
+        """
+        load_one(sample_id) returns the loaded sample. on_complete(samples)
+        runs on a thread of its own once every sample is loaded.
+        """
+        self.samples = [None] * len(SAMPLE_NAMES)
+        self.on_complete = on_complete
+        self._load_one = load_one
+        self._workers = workers
+        self._heap = []
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+        self._sample_locks = [threading.Lock() for _ in SAMPLE_NAMES]
+        self._remaining = len(SAMPLE_NAMES)
+
+    def start(self, center_notes):
+        """Queues every sample, nearest to any MIDI note in center_notes first."""
+        with self._lock:
+            for sample_id in range(len(SAMPLE_NAMES)):
+                midi_number = sample_midi_number(sample_id)
+                distance = min(abs(midi_number - center) for center in center_notes)
+                heapq.heappush(self._heap, (distance, next(self._order), sample_id))
+        for i in range(self._workers):
+            threading.Thread(
+                target=self._work, name=f"sample-loader-{i}", daemon=True
+            ).start()
+
+    def prioritize(self, sample_ids):
+        """Moves sample_ids ahead of everything still queued, in the given order."""
+        with self._lock:
+            for sample_id in sample_ids:
+                if self.samples[sample_id] is None:
+                    heapq.heappush(self._heap, (-1, next(self._order), sample_id))
+
+    def get(self, sample_id):
+        sample = self.samples[sample_id]
+        if sample is None:
+            sample = self._load(sample_id)
+        return sample
+
+    @property
+    def loaded(self):
+        return len(SAMPLE_NAMES) - self._remaining
+
+    def _load(self, sample_id):
+        done = False
+        with self._sample_locks[sample_id]:
+            if self.samples[sample_id] is None:
+                self.samples[sample_id] = self._load_one(sample_id)
+                with self._lock:
+                    self._remaining -= 1
+                    done = self._remaining == 0
+        if done and self.on_complete is not None:
+            # Not on this thread: get() runs on whichever thread needs the
+            # sample, the playback thread among them (holding its lock), and
+            # compacting and writing the cache takes seconds.
+            threading.Thread(
+                target=self.on_complete,
+                args=(self.samples,),
+                name="sample-cache",
+                daemon=True,
+            ).start()
+        return self.samples[sample_id]
+
+    def _work(self):
+        while True:
+            with self._lock:
+                if not self._heap:
+                    return
+                _, _, sample_id = heapq.heappop(self._heap)
+            if self.samples[sample_id] is None:
+                self._load(sample_id)
+
+
+if __name__ == "__main__":
+    # Builds the cache from the WAVs and reports what compaction saved.
+    raw_samples = read_wavs()
+    samples = [compact_sample(sample) for sample in raw_samples]
+    write_cache(samples)
+    print("\n".join(compaction_report(raw_samples, samples)))
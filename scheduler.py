@@ -0,0 +1,106 @@
+"""
+Sample-accurate note scheduling for the NumPy mixing engine.
+
+Song time (ms) is mapped onto the engine's stream frame counter, so notes
+are handed over a short lookahead window early with exact frame offsets and
+their onsets no longer depend on when the render loop happens to wake up.
+The mapping runs at `speed` song ms per real ms, anchored at one frame.
+"""
+
+import sample_bank
+
+SAMPLE_RATE = sample_bank.SAMPLE_RATE
+LOOKAHEAD_MS = 50
+
+
+class NoteScheduler:
+    def __init__(self, engine, lookahead_ms=LOOKAHEAD_MS):
+        self.engine = engine
+        self.lookahead_frames = round(lookahead_ms * SAMPLE_RATE / 1000)
+        self.anchor_frame = 0
+        self.anchor_ms = 0.0
+        self.speed = 1.0
+
+    def start(self, position_ms):
+        """Song time position_ms will sound one lookahead window from now."""
+        self.anchor_frame = self.engine.frames_rendered + self.lookahead_frames
+        self.anchor_ms = position_ms
+
+    def set_speed(self, speed):
+        """
+        Changes the speed from the lookahead horizon on, so the notes
+        already scheduled keep their frames and the next ones follow on.
+        """
+        self.anchor_ms = self.horizon_ms()
+        self.anchor_frame = self.engine.frames_rendered + self.lookahead_frames
+        self.speed = speed
+
+    def frame_for(self, time_ms):
+        """The stream frame at which a note at song time time_ms must start."""
+        return self.anchor_frame + round(
+            (time_ms - self.anchor_ms) / self.speed * SAMPLE_RATE / 1000
+        )
+
+    def position_ms(self):
+        """The song time the stream is playing right now."""
+        elapsed = self.engine.frames_rendered - self.anchor_frame
+        return self.anchor_ms + elapsed * 1000 / SAMPLE_RATE * self.speed
+
+    def horizon_ms(self):
+        """Every note before this song time should already be scheduled."""
+        horizon = self.engine.frames_rendered + self.lookahead_frames
+        return self.anchor_ms + (
+            (horizon - self.anchor_frame) * 1000 / SAMPLE_RATE * self.speed
+        )
+
+
+class OnsetStats:
+    """Collects how late notes start relative to their MIDI timestamps."""
+
+    def __init__(self):
+        self.errors_ms = []
+
+    def add(self, error_ms):
+        self.errors_ms.append(error_ms)
+
+    def report(self):
+        if not self.errors_ms:
+            print("No note onsets measured.")
+            return
+        errors = sorted(self.errors_ms)
+        n = len(errors)
+        mean = sum(errors) / n
+        p95 = errors[int(0.95 * (n - 1))]
+        print(
+            f"Onset error vs MIDI timestamps over {n} notes: "
+            f"mean {mean:.2f} ms, p95 {p95:.2f} ms, max {errors[-1]:.2f} ms"
+        )
+
+
+class LatencyStats:
+    """
+    Collects the time from live input to audio start. output_ms is the part
+    of the path that cannot be timed (the output buffer still to play after a
+    note has been mixed) and is added to every measurement.
+    """
+
+    def __init__(self, output_ms=0.0):
+        self.output_ms = output_ms
+        self.latencies_ms = []
+
+    def add(self, latency_ms):
+        self.latencies_ms.append(latency_ms + self.output_ms)
+
+    def report(self):
+        if not self.latencies_ms:
+            print("No input latency measured.")
+            return
+        latencies = sorted(self.latencies_ms)
+        n = len(latencies)
+        mean = sum(latencies) / n
+        p95 = latencies[int(0.95 * (n - 1))]
+        print(
+            f"Input to audio latency over {n} notes: mean {mean:.2f} ms, "
+            f"p95 {p95:.2f} ms, max {latencies[-1]:.2f} ms "
+            f"(incl. {self.output_ms:.1f} ms output buffer)"
+        )
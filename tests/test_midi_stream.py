@@ -0,0 +1,137 @@
+"""
+The streaming parser against the mido one, on every bundled MIDI file. Run
+from the repository root, which python -m puts on the import path:
+
+    python -m unittest discover tests
+"""
+
+import glob
+import os
+import queue
+import time
+import unittest
+
+import numpy as np
+
+import midi_events
+import sample_bank
+from midi_stream import RELEASE_MS, MidiStream, stream_notes
+from voices import release_times
+
+MIDI_FILES = sorted(glob.glob("assets/MIDI/*.mid"))
+# Song positions the seek tests start from.
+SEEK_POSITIONS_MS = [0.0, 3000.0, 12345.0, 61000.0]
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def silent_ms(note, key_lengths_ms):
+    time_ms, _, key, _, release_ms = note
+    return min(release_ms + RELEASE_MS, time_ms + key_lengths_ms[key])
+
+
+def parse_with_checkpoints(data, key_lengths_ms):
+    """
+    (notes, checkpoints) of a whole stream_notes() pass, checkpoints as
+    (checkpoint, how many notes came before it).
+    """
+    notes = []
+    checkpoints = []
+
+    def on_checkpoint(checkpoint):
+        checkpoints.append((checkpoint, len(notes)))
+
+    for note in stream_notes(data, key_lengths_ms, on_checkpoint=on_checkpoint):
+        notes.append(note)  # noqa: PERF402, on_checkpoint counts them
+    return notes, checkpoints
+
+
+def drain(stream, position_ms):
+    """(held, notes) a MidiStream plays from position_ms."""
+    stream.start(position_ms)
+    notes = []
+    while True:
+        try:
+            chunk = stream.get()
+        except queue.Empty:
+            time.sleep(0.001)
+            continue
+        if chunk is None:
+            return sorted(stream.held), notes
+        events, releases, _ = chunk
+        notes.extend(
+            zip(
+                events.time_ms.tolist(),
+                events.key.tolist(),
+                events.velocity.tolist(),
+                releases.tolist(),
+            )
+        )
+
+
+class StreamNotesTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.sample_lengths_ms = np.array(sample_bank.sample_lengths_ms())
+        cls.key_lengths_ms = cls.sample_lengths_ms[midi_events.KEY_SAMPLE].tolist()
+
+    def test_matches_mido_parse(self):
+        self.assertEqual(len(MIDI_FILES), 11)
+        for path in MIDI_FILES:
+            with self.subTest(path=path):
+                events = midi_events.parse_midi_file(path)
+                releases = release_times(events, self.sample_lengths_ms)
+                notes = list(stream_notes(read(path), self.key_lengths_ms))
+                self.assertEqual(len(notes), len(events))
+                time_ms, end_ms, key, velocity, release_ms = (
+                    np.array(column) for column in zip(*notes)
+                )
+                np.testing.assert_allclose(time_ms, events.time_ms, atol=1e-6)
+                # A note whose sample runs out first is handed out before its
+                # end is known, and keeps end_ms inf.
+                known = np.isfinite(end_ms)
+                np.testing.assert_allclose(
+                    end_ms[known], events.end_ms[known], atol=1e-6
+                )
+                self.assertTrue(
+                    np.all(release_ms[~known] <= events.end_ms[~known] + 1e-6)
+                )
+                np.testing.assert_array_equal(key, events.key)
+                np.testing.assert_array_equal(velocity, events.velocity)
+                np.testing.assert_allclose(release_ms, releases, atol=1e-6)
+
+    def test_resume_from_checkpoints(self):
+        for path in MIDI_FILES:
+            with self.subTest(path=path):
+                data = read(path)
+                notes, checkpoints = parse_with_checkpoints(data, self.key_lengths_ms)
+                self.assertTrue(checkpoints)
+                for checkpoint, yielded in checkpoints:
+                    # Everything after the checkpoint, and whatever before
+                    # it still sounds.
+                    expected = [
+                        note
+                        for note in notes[:yielded]
+                        if silent_ms(note, self.key_lengths_ms) > checkpoint.time_ms
+                    ] + notes[yielded:]
+                    resumed = list(
+                        stream_notes(data, self.key_lengths_ms, checkpoint=checkpoint)
+                    )
+                    self.assertEqual(resumed, expected)
+
+    def test_seek_from_checkpoint(self):
+        path = max(MIDI_FILES, key=os.path.getsize)
+        resumed = MidiStream(path, self.sample_lengths_ms)
+        drain(resumed, 0.0)
+        self.assertTrue(resumed._checkpoints)
+        for position_ms in SEEK_POSITIONS_MS:
+            with self.subTest(position_ms=position_ms):
+                fresh = MidiStream(path, self.sample_lengths_ms)
+                self.assertEqual(drain(resumed, position_ms), drain(fresh, position_ms))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+"""
+Random-access index over time-sorted NoteEvents.
+
+Seeking is a binary search on the event timestamps. Periodic checkpoints
+record which notes are still sounding, so the notes held at any position
+can be found without replaying the song from the start.
+"""
+
+import heapq
+from array import array
+
+import numpy as np
+
+CHECKPOINT_INTERVAL_MS = 1000
+
+
+def find_first_note_after(events, time_ms):
+    """Finds the index of the first note at or after time_ms."""
+    return int(np.searchsorted(events.time_ms, time_ms, side="left"))
+
+
+class Timeline:
+    def __init__(
+        self, events, note_ends, interval_ms=CHECKPOINT_INTERVAL_MS, checkpoints=None
+    ):
+        """
+        note_ends[i] is the song time at which note i stops sounding.
+        checkpoints is the (checkpoint_starts, checkpoint_notes) pair of an
+        earlier Timeline over the same notes, which is then not rebuilt.
+        """
+        self.events = events
+        self.note_ends = np.asarray(note_ends, dtype=np.float64)
+        self.interval_ms = interval_ms
+        if checkpoints is not None:
+            self.checkpoint_starts, self.checkpoint_notes = checkpoints
+            return
+
+        # Checkpoint k holds the indices of the notes that started before
+        # k * interval_ms and are still sounding at that time, stored flat:
+        # checkpoint_notes[checkpoint_starts[k]:checkpoint_starts[k + 1]].
+        starts = array("q", [0])
+        notes = array("q")
+        sounding = []
+        times = events.time_ms.tolist()
+        ends = self.note_ends.tolist()
+        i = 0
+        end_ms = max(ends, default=0)
+        for k in range(int(end_ms // interval_ms) + 1):
+            t = k * interval_ms
+            while i < len(times) and times[i] < t:
+                heapq.heappush(sounding, (ends[i], i))
+                i += 1
+            while sounding and sounding[0][0] <= t:
+                heapq.heappop(sounding)
+            notes.extend(sorted(idx for _, idx in sounding))
+            starts.append(len(notes))
+        self.checkpoint_starts = np.frombuffer(starts, dtype=np.int64)
+        self.checkpoint_notes = np.frombuffer(notes, dtype=np.int64)
+
+    @property
+    def duration_ms(self):
+        return float(self.events.time_ms[-1]) if len(self.events) else 0.0
+
+    def index_at(self, time_ms):
+        return find_first_note_after(self.events, time_ms)
+
+    def sounding_at(self, time_ms):
+        """Indices of the notes that started before time_ms and still sound then."""
+        starts = self.checkpoint_starts
+        if time_ms <= 0 or len(starts) < 2:
+            return []
+        k = min(int(time_ms // self.interval_ms), len(starts) - 2)
+        checkpoint = self.checkpoint_notes[starts[k] : starts[k + 1]]
+        held = checkpoint[self.note_ends[checkpoint] > time_ms]
+        start = self.index_at(k * self.interval_ms)
+        stop = self.index_at(time_ms)
+        tail = np.flatnonzero(self.note_ends[start:stop] > time_ms) + start
+        return np.concatenate([held, tail]).tolist()
+
+    def overlapping(self, start_ms, end_ms):
+        """
+        Indices of the notes sounding at any time in [start_ms, end_ms): the
+        ones held at start_ms, then the ones starting inside the window.
+        """
+        held = np.asarray(self.sounding_at(start_ms), dtype=np.intp)
+        starting = np.arange(self.index_at(start_ms), self.index_at(end_ms))
+        return np.concatenate([held, starting])
@@ -0,0 +1,53 @@
+"""
+Voice lifecycle: when each note is released and stops sounding.
+
+A note is released when its key is let go (NoteEvents.end_ms, which already
+includes the sustain pedal), or earlier when MAX_VOICES_PER_KEY newer notes
+on the same key have taken over its voice. A released voice fades out over
+RELEASE_MS instead of ringing to the end of its sample.
+"""
+
+import numpy as np
+
+import sample_bank
+
+RELEASE_MS = 150
+MAX_VOICES_PER_KEY = 2
+
+
+def release_times(events, sample_lengths_ms, max_per_key=MAX_VOICES_PER_KEY):
+    """
+    Song time at which every note starts to fade out. sample_lengths_ms is
+    an array of sample durations in sample id order; a note whose sample runs
+    out first is never released.
+    """
+    release = np.minimum(
+        events.end_ms, events.time_ms + sample_lengths_ms[events.sample]
+    )
+    if max_per_key > 0 and len(events) > max_per_key:
+        # Group the notes by key (stable, so each key stays time-sorted): a
+        # note is stolen by the max_per_key-th later note on the same key.
+        order = np.argsort(events.key, kind="stable")
+        keys = events.key[order]
+        same_key = keys[max_per_key:] == keys[:-max_per_key]
+        stolen = order[:-max_per_key][same_key]
+        thief = order[max_per_key:][same_key]
+        release[stolen] = np.minimum(release[stolen], events.time_ms[thief])
+    return release
+
+
+def sounding_ends(events, releases, sample_lengths_ms):
+    """Song time at which every note falls silent, release fade included."""
+    natural_end = events.time_ms + sample_lengths_ms[events.sample]
+    return np.minimum(releases + RELEASE_MS, natural_end)
+
+
+def release_envelope(length, release_pos, fade_frames=None):
+    """
+    float32 gain per frame for a voice of `length` frames released at frame
+    release_pos: 1 until the release, then a linear fade to 0.
+    """
+    if fade_frames is None:
+        fade_frames = round(RELEASE_MS * sample_bank.SAMPLE_RATE / 1000)
+    t = np.arange(length, dtype=np.float32) - np.float32(release_pos)
+    return np.clip(1.0 - t / np.float32(fade_frames), 0.0, 1.0)
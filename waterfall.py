@@ -0,0 +1,165 @@
+"""
+Falling-notes view: the notes of the next few seconds of the song, moving
+down onto the keys that will play them.
+
+The song is cut into slices of SLICE_HEIGHT pixels. A slice is drawn once
+into its own surface, from the notes the timeline reports as overlapping
+its time span (no other note is looked at), and kept until it has scrolled
+past the keyboard. A frame only blits the handful of slices in view, so its
+cost depends on neither the length nor the density of the song.
+
+Drawing a slice is bounded too: the notes are reduced to a grid of one
+cell per key and pixel row (holding the loudest velocity there), which
+precomputed column maps turn into the slice's pixels in one array write.
+"""
+
+import numpy as np
+import pygame
+
+import midi_events
+
+WINDOW_MS = 3000
+SLICE_HEIGHT = 24
+
+BACKGROUND_COLOR = (35, 35, 35)
+# Faint line at the left edge of every C, to find the octaves by.
+GUIDE_COLOR = (60, 60, 60)
+# Green of a note, from the first value at velocity 0 to the second at 127;
+# notes on black keys are darker.
+WHITE_NOTE_GREEN = (110, 255)
+BLACK_NOTE_GREEN = (70, 180)
+
+
+class Waterfall:
+    def __init__(self, rect, key_x, key_width, guide_x, window_ms=WINDOW_MS):
+        """
+        rect is where the view goes on screen. key_x and key_width give every
+        piano key's column, guide_x the x of every octave line.
+        """
+        self.rect = rect
+        # Pixels per ms, and the song time one slice covers.
+        self.scale = rect.h / window_ms
+        self.slice_ms = SLICE_HEIGHT / self.scale
+        self.blank = pygame.Surface((rect.w, SLICE_HEIGHT))
+        self.blank.fill(BACKGROUND_COLOR)
+        for x in guide_x:
+            self.blank.fill(GUIDE_COLOR, (x, 0, 1, SLICE_HEIGHT))
+
+        # The white and the black key column under every pixel column. Where
+        # there is none it is NUM_KEYS, the grid's always empty column, or
+        # for white keys NUM_KEYS + 1 on an octave line.
+        keys = midi_events.NUM_KEYS
+        self.white_columns = np.full(rect.w, keys)
+        self.white_columns[list(guide_x)] = keys + 1
+        self.black_columns = np.full(rect.w, keys)
+        for key in range(keys):
+            columns = (
+                self.black_columns
+                if midi_events.KEY_IS_BLACK[key]
+                else self.white_columns
+            )
+            columns[key_x[key] : key_x[key] + key_width[key]] = key
+        # Mapped pixel value of a note by velocity + 1; 0 (no note) is the
+        # background for white keys.
+        self.white_palette, self.black_palette = (
+            np.array(
+                [self.blank.map_rgb(BACKGROUND_COLOR)]
+                + [
+                    self.blank.map_rgb((0, dim + (bright - dim) * velocity // 127, 0))
+                    for velocity in range(128)
+                ],
+                dtype=np.uint32,
+            )
+            for dim, bright in (WHITE_NOTE_GREEN, BLACK_NOTE_GREEN)
+        )
+        self.guide_pixel = self.blank.map_rgb(GUIDE_COLOR)
+
+        self.timeline = None
+        self.ends = None
+        # Slice number -> its surface, for the slices in or near the view.
+        self.slices = {}
+        self.slices_drawn = 0
+
+    def offset(self, now_ms):
+        """How far the song has scrolled at now_ms, in whole pixels."""
+        return round(now_ms * self.scale)
+
+    def set_song(self, timeline, releases):
+        """Shows the notes of timeline, each ending at its release."""
+        if timeline is self.timeline:
+            return
+        self.timeline = timeline
+        ends = timeline.note_ends
+        if len(releases) == len(ends):
+            ends = np.minimum(releases, ends)
+        self.ends = ends
+        self.slices.clear()
+
+    def draw(self, surface, now_ms):
+        """Blits the slices in view at song time now_ms into the view's rect."""
+        rect = self.rect
+        offset = self.offset(now_ms)
+        first = offset // SLICE_HEIGHT
+        last = (offset + rect.h) // SLICE_HEIGHT
+        for k in [k for k in self.slices if not first <= k <= last]:
+            del self.slices[k]
+
+        clip = surface.get_clip()
+        surface.set_clip(clip.clip(rect))
+        for k in range(first, last + 1):
+            image = self.slices.get(k)
+            if image is None:
+                image = self.slices[k] = self._draw_slice(k)
+            y = rect.bottom + offset - (k + 1) * SLICE_HEIGHT
+            surface.blit(image, (rect.x, y))
+        surface.set_clip(clip)
+
+    def _draw_slice(self, k):
+        """
+        Slice k, covering song pixels k * SLICE_HEIGHT up to the next slice,
+        later times higher up.
+        """
+        self.slices_drawn += 1
+        timeline = self.timeline
+        if timeline is None or not len(timeline.events):
+            return self.blank.copy()
+        start_ms = k * self.slice_ms
+        notes = timeline.overlapping(start_ms, start_ms + self.slice_ms)
+        if not len(notes):
+            return self.blank.copy()
+
+        events = timeline.events
+        # Every note's span in song pixels, with the top pixel left out so
+        # that repeated notes on a key stay apart, but at least one high.
+        low = np.round(events.time_ms[notes] * self.scale).astype(np.int64)
+        high = np.round(self.ends[notes] * self.scale).astype(np.int64) - 1
+        high = np.maximum(high, low + 1)
+        top = np.maximum((k + 1) * SLICE_HEIGHT - high, 0)
+        rows = np.minimum((k + 1) * SLICE_HEIGHT - low, SLICE_HEIGHT) - top
+        visible = rows > 0
+        top, rows = top[visible], rows[visible]
+        keys = events.key[notes][visible]
+        velocity = events.velocity[notes][visible] + 1
+
+        # The loudest note in every cell of the row x key grid.
+        first_row = np.repeat(top - np.cumsum(rows) + rows, rows)
+        row = first_row + np.arange(len(first_row))
+        grid = np.zeros((SLICE_HEIGHT, midi_events.NUM_KEYS + 1), dtype=np.uint8)
+        np.maximum.at(grid, (row, np.repeat(keys, rows)), np.repeat(velocity, rows))
+
+        # Colours per cell, then per pixel column: black-key notes go over
+        # white-key ones, which go over the background.
+        white = np.empty((SLICE_HEIGHT, midi_events.NUM_KEYS + 2), dtype=np.uint32)
+        white[:, :-1] = self.white_palette[grid]
+        white[:, -1] = self.guide_pixel
+        black = self.black_palette[grid]
+        black_key = self.black_columns
+        # A copy of the blank slice has the format the palettes were mapped
+        # for. Its pixels are (x, y), so they are filled through .T.
+        image = self.blank.copy()
+        pixels = pygame.surfarray.pixels2d(image).T
+        pixels[:] = np.where(
+            grid[:, black_key] > 0, black[:, black_key], white[:, self.white_columns]
+        )
+        del pixels
+        return image